@@ -0,0 +1,76 @@
+"""
+Setup shared by the benchmarks: their options, the checkout measured, the
+synthesized MP4s and the stub backend serving them
+"""
+import os
+import sys
+import time
+import tempfile
+from optparse import OptionParser
+
+from tests.fakes import make_mp4, FakeBackend
+
+
+def option_parser(description, usage='%prog [options]', samples=None):
+    # Options every benchmark takes, -n only with a default amount of video
+    # samples for the MP4 it synthesizes
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option('--tree',
+                      help='checkout whose swiftmp4 package is measured')
+    if samples is not None:
+        parser.add_option('-n', '--samples', type='int', default=samples,
+                          help='video samples of the MP4 '
+                               '[default: %default]')
+    return parser
+
+
+def checkout(tree=None):
+    # Measures the swiftmp4 package of tree, i.e. a worktree of an older
+    # revision, instead of the one of the current checkout. Nothing may
+    # import swiftmp4 before, including tests.test_middleware.
+    if tree:
+        sys.path.insert(0, os.path.abspath(tree))
+    import swiftmp4
+    print 'swiftmp4 from %s' % os.path.dirname(os.path.abspath(
+        swiftmp4.__file__))
+
+
+def require_eventlet():
+    # Without a hub nothing runs concurrently, so there is nothing to measure
+    try:
+        import eventlet
+    except ImportError:
+        sys.exit('eventlet is not installed')
+    return eventlet
+
+
+def mp4_file(samples):
+    # Writes a synthesized MP4 to a temporary file, returns its path
+    (fd, path) = tempfile.mkstemp(suffix='.mp4')
+    os.write(fd, make_mp4(samples=samples))
+    os.close(fd)
+    return path
+
+
+def stub_backend(samples, **kwargs):
+    # A FakeBackend serving a synthesized MP4, kwargs set its latency
+    return FakeBackend(make_mp4(samples=samples), **kwargs)
+
+
+def timed(func, *args):
+    # Returns the result of func and the seconds it took
+    began = time.time()
+    result = func(*args)
+    return (result, time.time() - began)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def latencies(values):
+    # Summarizes latencies in seconds
+    return 'p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+        percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000,
+        max(values) * 1000)
@@ -0,0 +1,95 @@
+"""
+Gap between the metadata and the first media bytes of a seek
+
+Seeks through the middleware into a synthesized MP4 served by a slow stub
+backend, one with a latency ahead of every response, another one ahead of
+the first chunk of its body and a limited rate. The client takes its time
+writing out the metadata like a slow connection would, then the wait for
+the first mdat chunk is the gap reported, next to the time to the first
+byte. Run it from the top of a checkout, against the middleware of that
+checkout or of another one:
+
+    python -m benchmarks.header_gap
+    python -m benchmarks.header_gap --tree ../before --latency 0.1
+
+Needs eventlet, without it nothing is fetched ahead.
+"""
+import sys
+
+from benchmarks.common import option_parser, checkout, require_eventlet, \
+    stub_backend, timed, latencies
+
+
+def seek(app, query, client_rate):
+    # Returns the time to the first byte and the gap in between the end of
+    # the metadata and the first mdat chunk, in seconds
+    eventlet = require_eventlet()
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c/o.mp4',
+           'QUERY_STRING': query}
+    response = {}
+
+    def start_response(status, headers, *args):
+        response['status'] = int(status.split()[0])
+
+    def first_chunk():
+        body = iter(app(env, start_response))
+        return (body, next(body))
+
+    ((body, header), first_byte) = timed(first_chunk)
+    assert response['status'] == 200, response['status']
+    # Writing the metadata out to the client
+    eventlet.sleep(float(len(header)) / client_rate)
+    (chunk, gap) = timed(next, body)
+    # Hanging up, the rest of the media is of no interest
+    body.close()
+    return (first_byte, gap)
+
+
+def main(argv=None):
+    parser = option_parser('Reports the gap in between the metadata and '
+                           'the media data of seeks against a slow backend.',
+                           samples=20000)
+    parser.add_option('-s', '--seeks', type='int', default=20,
+                      help='seeks made [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.05,
+                      help='backend latency in seconds [default: %default]')
+    parser.add_option('-k', '--seek-latency', type='float', default=0.02,
+                      help='backend latency in seconds ahead of the first '
+                           'chunk of a body [default: %default]')
+    parser.add_option('-r', '--rate', type='int', default=20 * 1024 * 1024,
+                      help='backend rate in bytes per second '
+                           '[default: %default]')
+    parser.add_option('-c', '--client-rate', type='int',
+                      default=2 * 1024 * 1024,
+                      help='client rate in bytes per second '
+                           '[default: %default]')
+    (options, args) = parser.parse_args(argv)
+    require_eventlet()
+    checkout(options.tree)
+    from swiftmp4.middleware import SwiftMp4Middleware
+
+    backend = stub_backend(options.samples, latency=options.latency,
+                           seek_latency=options.seek_latency,
+                           rate=options.rate)
+    # Trees that predate reading ahead only fetch once the metadata is sent
+    modes = [('sequential', {})]
+    if hasattr(SwiftMp4Middleware(backend, {}), 'read_ahead_chunks'):
+        modes = [('read_ahead_chunks=0', {'read_ahead_chunks': '0'}),
+                 ('read_ahead_chunks=4', {'read_ahead_chunks': '4'})]
+    seconds = options.samples // 25
+    for mode, conf in modes:
+        app = SwiftMp4Middleware(backend, dict(conf,
+                                               metadata_cache_size='0'))
+        results = []
+        for index in xrange(options.seeks):
+            start = 1 + index * seconds // options.seeks
+            results.append(seek(app, 'start=%d' % start, options.client_rate))
+        first_bytes = [first_byte for first_byte, gap in results]
+        gaps = [gap for first_byte, gap in results]
+        print '%s: first byte %s' % (mode, latencies(first_bytes))
+        print '%s: gap %s' % (mode, latencies(gaps))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Latency of unrelated requests while seeks are in flight
+
+Runs concurrent seeks into a long synthesized MP4 through the middleware,
+next to a steady stream of plain GETs of a small Object, all on one eventlet
+hub like a proxy worker. Every seek is a short clip and parses its metadata
+from scratch. The latency of the plain GETs is reported for the metadata
+work done inline, in between cooperative checkpoints and in the worker
+pool:
+
+    python -m benchmarks.hub_latency
+    python -m benchmarks.hub_latency --samples 120000 --concurrency 16
+    python -m benchmarks.hub_latency --no-numpy
+
+Needs eventlet, without a hub there is nothing to stall.
+"""
+import sys
+
+from benchmarks.common import option_parser, checkout, require_eventlet, \
+    stub_backend, timed, latencies
+from tests.fakes import FakeBackend
+
+MODES = [
+    ('inline', {}),
+    ('checkpoints', {'metadata_checkpoint_entries': '4096'}),
+    ('workers', {'metadata_workers': '4'}),
+]
+
+
+def run(app, options):
+    # Returns the seconds taken by all the seeks and the latencies of the
+    # plain GETs made meanwhile
+    eventlet = require_eventlet()
+    from tests.test_middleware import request
+    plain_latencies = []
+    done = []
+
+    def plain():
+        while not done:
+            (response, elapsed) = timed(request, app, '', '/v1/a/c/small')
+            plain_latencies.append(elapsed)
+            eventlet.sleep(options.interval)
+
+    def seek(index):
+        # Short clips, the metadata work outweighs streaming them
+        start = 1 + index % options.starts
+        status = request(app, 'start=%d&end=%d' % (start, start + 2))[0]
+        assert status == 200, status
+
+    def seeks():
+        pool = eventlet.GreenPool(options.concurrency)
+        for index in xrange(options.seeks):
+            pool.spawn_n(seek, index)
+        pool.waitall()
+
+    prober = eventlet.spawn(plain)
+    (result, elapsed) = timed(seeks)
+    done.append(True)
+    prober.wait()
+    return (elapsed, plain_latencies)
+
+
+def main(argv=None):
+    parser = option_parser('Reports the latency of plain GETs made while '
+                           'seeks are in flight.', samples=60000)
+    parser.add_option('-s', '--seeks', type='int', default=200,
+                      help='seeks made [default: %default]')
+    parser.add_option('-c', '--concurrency', type='int', default=8,
+                      help='seeks in flight at a time [default: %default]')
+    parser.add_option('--starts', type='int', default=2000,
+                      help='seek starts are spread over that many seconds '
+                           '[default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.002,
+                      help='backend latency in seconds [default: %default]')
+    parser.add_option('--no-numpy', action='store_true', default=False,
+                      help='parse without numpy even where it is installed')
+    parser.add_option('-i', '--interval', type='float', default=0.005,
+                      help='seconds in between plain GETs '
+                           '[default: %default]')
+    (options, args) = parser.parse_args(argv)
+    require_eventlet()
+    if options.no_numpy:
+        sys.modules['numpy'] = None
+    checkout(options.tree)
+    from swiftmp4.middleware import SwiftMp4Middleware
+
+    video = stub_backend(options.samples, latency=options.latency)
+    small = FakeBackend('x' * 1024, latency=options.latency)
+
+    def backend(env, start_response):
+        if env['PATH_INFO'].endswith('.mp4'):
+            return video(env, start_response)
+        return small(env, start_response)
+
+    print '%d seeks, %d at a time, into %d bytes' % (
+        options.seeks, options.concurrency, len(video.data))
+    for mode, conf in MODES:
+        app = SwiftMp4Middleware(backend, dict(
+            conf, metadata_cache_size='0', coalesce_requests='false'))
+        (elapsed, plain_latencies) = run(app, options)
+        print '%s: %.1f seeks/s, %d plain GETs, latency %s' % (
+            mode, options.seeks / elapsed, len(plain_latencies),
+            latencies(plain_latencies))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Memory held by the parse tree of a single seek
+
+Parses MP4s the way a seek does and reports the bytes reachable from the
+resulting atom tree, leaving out the source file and whatever it reads
+from. Run it from the top of a checkout, against the atoms of that
+checkout or of another one:
+
+    python -m benchmarks.parse_memory
+    python -m benchmarks.parse_memory --tree ../before master.mp4
+
+Without sources MP4s of 1000, 10000 and 60000 video samples are
+synthesized.
+"""
+import os
+import sys
+import types
+
+from benchmarks.common import option_parser, checkout, mp4_file
+
+SAMPLES = (1000, 10000, 60000)
+
+
+def deep_size(root):
+    # Returns (bytes, objects) reachable from root, file-like objects and
+    # everything shared by the whole process are not part of it
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or \
+                isinstance(obj, (type, types.ModuleType, types.FunctionType,
+                                 types.MethodType, file)) or \
+                (hasattr(obj, 'read') and hasattr(obj, 'seek')):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in ('__dict__', '__weakref__') and \
+                        hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return (size, len(seen))
+
+
+def count_atoms(atom):
+    return 1 + sum(count_atoms(child) for child in
+                   getattr(atom, 'children', None) or [])
+
+
+def measure(StreamMp4, path, start, lazy):
+    # Parses path as a seek to start would, returns (bytes, objects, atoms)
+    if lazy is None:
+        mp4 = StreamMp4(path, None, start)
+    else:
+        mp4 = StreamMp4(path, None, start, lazy=lazy)
+    try:
+        mp4._parseMp4()
+        atoms = mp4.getAtoms()
+        (size, objects) = deep_size(atoms)
+        return (size, objects, count_atoms(atoms))
+    finally:
+        mp4.source_file.close()
+
+
+def main(argv=None):
+    parser = option_parser('Reports the memory held by the parse tree of a '
+                           'seek into every source MP4.',
+                           usage='%prog [options] [SOURCE ...]')
+    parser.add_option('-s', '--start', default='1',
+                      help='start of the seek in seconds [default: %default]')
+    (options, args) = parser.parse_args(argv)
+    checkout(options.tree)
+    from swiftmp4.streaming.StreamMp4 import StreamMp4
+
+    # Trees that predate lazy parsing only parse eagerly
+    modes = [('eager', None)]
+    if 'lazy' in StreamMp4.__init__.im_func.func_code.co_varnames:
+        modes = [('eager', False), ('lazy', True)]
+
+    sources = [(path, os.path.basename(path)) for path in args]
+    temp_paths = []
+    if not sources:
+        for samples in SAMPLES:
+            temp_paths.append(mp4_file(samples))
+            sources.append((temp_paths[-1], '%d samples' % samples))
+    try:
+        for path, name in sources:
+            for mode, lazy in modes:
+                (size, objects, atoms) = measure(StreamMp4, path,
+                                                 options.start, lazy)
+                print '%s, %s: %d atoms, %d objects, %d bytes ' \
+                      '(%.1f KB)' % (name, mode, atoms, objects, size,
+                                     size / 1024.0)
+    finally:
+        for path in temp_paths:
+            os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Throughput of a seek with the mdat range fetched as parallel segments
+
+Streams seeks through the middleware out of a synthesized MP4 served by a
+stub backend with a latency ahead of every response and a limited rate per
+response, like a single object server connection. The mdat range is
+fetched with a single request and as segments with several of them in
+flight:
+
+    python -m benchmarks.segment_throughput
+    python -m benchmarks.segment_throughput --segment-size 4194304
+
+Needs eventlet, without it segments are fetched one by one.
+"""
+import sys
+
+from benchmarks.common import option_parser, checkout, require_eventlet, \
+    stub_backend, timed
+
+PARALLELISM = (1, 2, 4, 8)
+
+
+def run(app, seeks):
+    # Returns the bytes streamed by seeks
+    from tests.test_middleware import request
+    streamed = 0
+    for start in seeks:
+        (status, headers, body) = request(app, 'start=%d' % start)
+        assert status == 200, status
+        streamed += len(body)
+    return streamed
+
+
+def main(argv=None):
+    parser = option_parser('Reports the throughput of seeks with the mdat '
+                           'range fetched as a single request and as '
+                           'parallel segments.', samples=20000)
+    parser.add_option('-s', '--seeks', type='int', default=3,
+                      help='seeks made [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.02,
+                      help='backend latency in seconds [default: %default]')
+    parser.add_option('-r', '--rate', type='int', default=8 * 1024 * 1024,
+                      help='backend rate in bytes per second and response '
+                           '[default: %default]')
+    parser.add_option('--segment-size', type='int', default=1024 * 1024,
+                      help='bytes per segment [default: %default]')
+    parser.add_option('--segment-window', type='int', default=8,
+                      help='segments held ahead of the client '
+                           '[default: %default]')
+    (options, args) = parser.parse_args(argv)
+    require_eventlet()
+    checkout(options.tree)
+    from swiftmp4.middleware import SwiftMp4Middleware
+
+    backend = stub_backend(options.samples, latency=options.latency,
+                           rate=options.rate, chunk_size=65536)
+    seconds = options.samples // 25
+    seeks = [1 + index * seconds // (2 * options.seeks)
+             for index in xrange(options.seeks)]
+    modes = [('single request', {'segment_size': '0'})]
+    for parallelism in PARALLELISM:
+        modes.append(('segments, parallelism %d' % parallelism, {
+            'segment_size': str(options.segment_size),
+            'segment_parallelism': str(parallelism),
+            'segment_window': str(max(options.segment_window, parallelism))}))
+    for mode, conf in modes:
+        app = SwiftMp4Middleware(backend, conf)
+        (streamed, elapsed) = timed(run, app, seeks)
+        print '%s: %d bytes in %.2f s, %.1f MB/s' % (
+            mode, streamed, elapsed, streamed / elapsed / 1024 / 1024)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
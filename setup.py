@@ -26,4 +26,7 @@ setup(name='swiftmp4',
       packages=['swiftmp4', 'swiftmp4.streaming'],
       requires=['swift(>=1.4)'],
       entry_points={'paste.filter_factory':
-                        ['swiftmp4=swiftmp4.middleware:filter_factory']})
+                        ['swiftmp4=swiftmp4.middleware:filter_factory'],
+                    'console_scripts':
+                        ['swiftmp4-batch=swiftmp4.cli:main',
+                         'swiftmp4-sidecar=swiftmp4.sidecar:main']})
@@ -0,0 +1,173 @@
+"""
+Caching of parsed MP4 metadata for SwiftMp4Middleware
+"""
+import base64
+from collections import OrderedDict
+
+from swiftmp4.streaming.Helper import numpy
+from swiftmp4.streaming.StreamMp4 import SwiftMp4Segments
+from swiftmp4.streaming.StreamByteSource import ByteSourceFile
+
+
+def index_size(seek_index):
+    # Rough amount of bytes held by a SeekIndex
+    size = 0
+    for part in (seek_index.stts_index, seek_index.stsc_index,
+                 seek_index.stss_index, seek_index.ctts_index):
+        if part is None:
+            continue
+        if not isinstance(part, tuple):
+            part = (part,)
+        for values in part:
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                size += values.nbytes
+            elif hasattr(values, 'itemsize'):
+                size += values.itemsize * len(values)
+            else:
+                size += 8 * len(values)
+    return size
+
+
+class Mp4Metadata(object):
+    """
+    Start independent metadata of an MP4 Object: the byte ranges holding
+    its top level atoms and moov, and the seek index of every trak.
+    """
+    def __init__(self, etag, content_length, content_type, segments,
+                 seek_indexes=None, last_modified=None):
+        self.etag = etag
+        self.content_length = content_length
+        self.content_type = content_type
+        self.segments = segments
+        self.seek_indexes = seek_indexes
+        self.last_modified = last_modified
+        self.in_memcache = False
+        # ByteSource read on demand instead of segments, never cached
+        self.source = None
+    
+    def get_file(self):
+        # Every request gets its own file position over the shared ranges
+        if self.source is not None:
+            return ByteSourceFile(self.source)
+        source_file = SwiftMp4Segments(self.content_length)
+        for offset, data in self.segments:
+            source_file.add(offset, data)
+        return source_file
+    
+    def size(self):
+        size = sum(len(data) for offset, data in self.segments)
+        for seek_index in self.seek_indexes or []:
+            size += index_size(seek_index)
+        return size
+    
+    def to_memcache(self):
+        # Seek indexes are cheap to rebuild and not shared through memcache
+        return {'etag': self.etag,
+                'content_length': self.content_length,
+                'content_type': self.content_type,
+                'last_modified': self.last_modified,
+                'segments': [(offset, base64.b64encode(data))
+                             for offset, data in self.segments]}
+    
+    @classmethod
+    def from_memcache(cls, value):
+        segments = [(offset, base64.b64decode(data))
+                    for offset, data in value['segments']]
+        metadata = cls(value['etag'], value['content_length'],
+                       value['content_type'], segments,
+                       last_modified=value.get('last_modified'))
+        metadata.in_memcache = True
+        return metadata
+    
+
+
+class MetadataCache(object):
+    """
+    Two tier cache of Mp4Metadata keyed by Object path and ETag, a size
+    bounded in-process LRU backed by the optional swift.cache memcache.
+    """
+    def __init__(self, max_size=67108864, memcache_max_size=1048576,
+                 memcache_time=86400):
+        self.max_size = max_size
+        self.memcache_max_size = memcache_max_size
+        self.memcache_time = memcache_time
+        self.entries = OrderedDict()
+        self.etags = {}
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'memcache_hits': 0,
+                      'memcache_misses': 0, 'evictions': 0}
+    
+    def _memcache_key(self, path, etag):
+        return 'swiftmp4/metadata/%s/%s' % (path, etag)
+    
+    def get(self, path, etag, memcache=None):
+        if self.etags.get(path) not in (None, etag):
+            # The Object changed, drop what was cached for the old one
+            self._remove(path, self.etags[path])
+        key = (path, etag)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            self.stats['hits'] += 1
+            return entry[0]
+        self.stats['misses'] += 1
+        
+        if memcache is not None and self.memcache_max_size > 0:
+            value = memcache.get(self._memcache_key(path, etag))
+            if value is not None:
+                self.stats['memcache_hits'] += 1
+                metadata = Mp4Metadata.from_memcache(value)
+                self._store(path, metadata)
+                return metadata
+            self.stats['memcache_misses'] += 1
+        return None
+    
+    def peek(self, path):
+        # The in-process metadata of the last known version of the Object,
+        # without knowing whether it is still the current one. It only
+        # counts as a hit once verified.
+        key = (path, self.etags.get(path))
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[0]
+    
+    def verified(self, path):
+        # Counts the hit of peeked metadata once its ETag matched the
+        # current one of the Object
+        self.stats['hits'] += 1
+    
+    def put(self, path, metadata, memcache=None):
+        self._store(path, metadata)
+        if memcache is not None and self.memcache_max_size > 0 and \
+                not metadata.in_memcache:
+            value = metadata.to_memcache()
+            encoded_size = sum(len(data) for offset, data in value['segments'])
+            if encoded_size <= self.memcache_max_size:
+                memcache.set(self._memcache_key(path, metadata.etag), value,
+                             time=self.memcache_time)
+                metadata.in_memcache = True
+    
+    def _store(self, path, metadata):
+        size = metadata.size()
+        if size > self.max_size:
+            return
+        if self.etags.get(path) is not None:
+            self._remove(path, self.etags[path])
+        self.entries[(path, metadata.etag)] = (metadata, size)
+        self.etags[path] = metadata.etag
+        self.size += size
+        while self.size > self.max_size:
+            (old_path, old_etag), (old, old_size) = \
+                self.entries.popitem(last=False)
+            self.size -= old_size
+            del self.etags[old_path]
+            self.stats['evictions'] += 1
+    
+    def _remove(self, path, etag):
+        entry = self.entries.pop((path, etag), None)
+        if entry is not None:
+            self.size -= entry[1]
+        self.etags.pop(path, None)
+    
@@ -0,0 +1,200 @@
+"""
+Batch trimming of local MP4s
+
+Writes a copy of every source MP4 for every requested point, a start and
+an optional end in seconds, across a pool of processes:
+
+    swiftmp4-batch -p 0 -p 30:60 /path/to/output master.mp4 masters/
+    swiftmp4-batch -m manifest.txt /path/to/output
+
+A point of 0 writes a moov-first copy of the whole MP4. Directories are
+searched for .mp4 files. Every manifest line holds a source followed by
+its own points, lines without points use the -p ones. Outputs are named
+after their source and point, written through a temporary file and
+skipped while they are newer than their source.
+"""
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+
+from swiftmp4.streaming.StreamMp4 import StreamMp4
+
+
+def parse_point(point):
+    # Splits 'start[:end]' into (start, end), end being None if absent
+    if ':' in point:
+        (start, end) = point.split(':', 1)
+    else:
+        (start, end) = (point, None)
+    float(start)
+    if end is not None:
+        float(end)
+    return (start, end or None)
+
+
+def find_sources(path):
+    # Returns (source, name relative to path) of every MP4 in path
+    if not os.path.isdir(path):
+        return [(path, os.path.basename(path))]
+    sources = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.mp4'):
+                source = os.path.join(root, name)
+                sources.append((source, os.path.relpath(source, path)))
+    return sources
+
+
+def read_manifest(manifest, points):
+    # Returns (source, name, points) for every line of the manifest
+    entries = []
+    for line in open(manifest):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        line_points = [parse_point(point) for point in fields[1:]]
+        for source, name in find_sources(fields[0]):
+            entries.append((source, name, line_points or points))
+    return entries
+
+
+def output_path(output_dir, name, start, end):
+    # Names the output after its source and point, i.e. clip-30-60.mp4
+    (base, ext) = os.path.splitext(name)
+    suffix = '-%s' % start
+    if end is not None:
+        suffix += '-%s' % end
+    return os.path.join(output_dir, base + suffix + (ext or '.mp4'))
+
+
+def is_up_to_date(source, output):
+    return os.path.exists(output) and \
+        os.path.getmtime(output) >= os.path.getmtime(source)
+
+
+def run_job(job):
+    # Writes a single output, returns (job, error, timings, size)
+    (source, output, start, end) = job
+    timings = {}
+    try:
+        output_dir = os.path.dirname(output)
+        if output_dir and not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                # Created by another job in the meantime
+                if not os.path.isdir(output_dir):
+                    raise
+        (fd, temp_path) = tempfile.mkstemp(
+            dir=output_dir or '.', prefix='.' + os.path.basename(output),
+            suffix='.tmp')
+        os.close(fd)
+        # mkstemp only allows the owner in, use the usual mode instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0666 & ~umask)
+        try:
+            mp4 = StreamMp4(source, temp_path, start, lazy=True, end=end)
+            try:
+                began = time.time()
+                mp4._parseMp4()
+                timings['parse'] = time.time() - began
+                began = time.time()
+                mp4._updateAtoms()
+                timings['update'] = time.time() - began
+                began = time.time()
+                mp4._writeToStream()
+                timings['copy'] = time.time() - began
+            finally:
+                mp4.source_file.close()
+            os.rename(temp_path, output)
+        except:
+            os.unlink(temp_path)
+            raise
+        return (job, None, timings, os.path.getsize(output))
+    except Exception, e:
+        return (job, '%s: %s' % (e.__class__.__name__, e), timings, 0)
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog [options] OUTPUT_DIR [SOURCE ...]',
+        description='Writes a trimmed copy of every source MP4, or of every '
+                    'MP4 in every source directory, for every point.')
+    parser.add_option('-p', '--point', action='append', default=[],
+                      help='START[:END] in seconds, may be repeated')
+    parser.add_option('-m', '--manifest',
+                      help='file listing a source and its points per line')
+    parser.add_option('-j', '--jobs', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='amount of processes [default: %default]')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+                      help='also rewrite outputs that are up to date')
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error('OUTPUT_DIR is required')
+    try:
+        points = [parse_point(point) for point in options.point]
+    except ValueError:
+        parser.error('Points must be START[:END] in seconds')
+    output_dir = args[0]
+    
+    entries = []
+    if options.manifest:
+        try:
+            entries = read_manifest(options.manifest, points)
+        except ValueError:
+            parser.error('Points must be START[:END] in seconds')
+    for path in args[1:]:
+        for source, name in find_sources(path):
+            entries.append((source, name, points))
+    if not entries:
+        parser.error('No sources given')
+    
+    jobs = []
+    skipped = 0
+    for source, name, source_points in entries:
+        if not source_points:
+            parser.error('No points given for %s' % source)
+        for start, end in source_points:
+            output = output_path(output_dir, name, start, end)
+            if not options.force and is_up_to_date(source, output):
+                skipped += 1
+                continue
+            jobs.append((source, output, start, end))
+    
+    began = time.time()
+    written = 0
+    failed = 0
+    pool = multiprocessing.Pool(max(options.jobs, 1))
+    try:
+        for job, error, timings, size in pool.imap_unordered(run_job, jobs):
+            (source, output, start, end) = job
+            if error:
+                failed += 1
+                print '%s: failed, %s' % (output, error)
+                continue
+            written += size
+            print '%s: parse %.3fs update %.3fs copy %.3fs, %d bytes' % \
+                (output, timings['parse'], timings['update'],
+                 timings['copy'], size)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - began
+    
+    throughput = 0
+    if elapsed > 0:
+        throughput = written / elapsed / 1048576
+    print '%d written, %d up to date, %d failed, %d bytes in %.3fs ' \
+          '(%.1f MB/s)' % (len(jobs) - failed, skipped, failed, written,
+                           elapsed, throughput)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
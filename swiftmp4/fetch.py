@@ -0,0 +1,357 @@
+"""
+Backend fetching helpers for SwiftMp4Middleware
+
+ReadAhead keeps reading the mdat range response in its own greenthread
+while the rewritten metadata is still being written to the client, so the
+first media bytes are waiting by the time they are needed. It never holds
+more than depth chunks. Without eventlet the response is simply iterated.
+
+SegmentedFetch splits a long mdat range into segments that are requested
+concurrently, possibly from different object servers, and yields them
+back in order. Without eventlet the segments are requested one by one.
+
+RangeByteSource lets the parser read an Object directly, every read being
+a ranged request, usually behind a CachedByteSource.
+
+ByteRanges parses the multipart/byteranges body of a multi-range response
+while it streams in. MultiRangeFetch serves the media of such a response
+followed by the rest of the mdat range, which was requested in parallel
+through a Prefetch.
+"""
+import sys
+
+from swiftmp4.streaming.StreamByteSource import ByteSource
+
+try:
+    from eventlet import spawn
+    from eventlet.queue import Queue
+    from eventlet.semaphore import Semaphore
+except ImportError:
+    spawn = None
+    Queue = None
+    Semaphore = None
+
+
+def parse_content_range(value):
+    # Returns (start, stop, size) of a 'bytes start-end/size' Content-Range
+    (unit, value) = value.strip().split(' ', 1)
+    (span, size) = value.split('/', 1)
+    (start, end) = span.split('-', 1)
+    return (int(start), int(end) + 1, int(size))
+
+
+class ReadAhead(object):
+    """
+    Iterates over chunks, reading up to depth of them ahead of the consumer.
+    """
+    def __init__(self, chunks, depth):
+        self.chunks = chunks
+        self.queue = None
+        self.reader = None
+        if spawn is not None and depth > 0:
+            self.queue = Queue(depth)
+            self.reader = spawn(self._read)
+    
+    def _read(self):
+        # Queues every chunk followed by None, or the exception that ended
+        # the reading
+        try:
+            for chunk in self.chunks:
+                self.queue.put((chunk, None))
+        except Exception:
+            self.queue.put((None, sys.exc_info()))
+            return
+        self.queue.put(None)
+    
+    def __iter__(self):
+        if self.queue is None:
+            for chunk in self.chunks:
+                yield chunk
+            return
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (chunk, exc_info) = item
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield chunk
+    
+    def close(self):
+        # Stops reading ahead and closes the underlying response
+        if self.reader is not None:
+            self.reader.kill()
+            self.reader = None
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+    
+
+
+class SegmentedFetch(object):
+    """
+    Iterates over the chunks of an already requested first part followed
+    by the bytes from start up to stop, which are fetched as segments of
+    segment_size bytes. At most window segments are requested or held
+    ahead of the consumer and at most parallelism of them are requested
+    at a time. fetch(start, stop, *args) returns the data of a segment.
+    """
+    def __init__(self, first, start, stop, segment_size, parallelism,
+                 window, fetch, *args):
+        self.first = first
+        self.segments = [(offset, min(offset + segment_size, stop))
+                         for offset in xrange(start, stop, segment_size)]
+        self.window = max(window, 1)
+        self.fetch = fetch
+        self.args = args
+        self.semaphore = None
+        if Semaphore is not None:
+            self.semaphore = Semaphore(max(parallelism, 1))
+        self.pending = []
+        self.next = 0
+    
+    def _fetch(self, start, stop):
+        self.semaphore.acquire()
+        try:
+            return self.fetch(start, stop, *self.args)
+        finally:
+            self.semaphore.release()
+    
+    def _fill(self):
+        # Requests segments until window of them are pending
+        while len(self.pending) < self.window and \
+                self.next < len(self.segments):
+            (start, stop) = self.segments[self.next]
+            self.pending.append(spawn(self._fetch, start, stop))
+            self.next += 1
+    
+    def __iter__(self):
+        if self.semaphore is None:
+            for chunk in self.first:
+                yield chunk
+            for start, stop in self.segments:
+                yield self.fetch(start, stop, *self.args)
+            return
+        # Segments are already being fetched while the first part is read
+        self._fill()
+        for chunk in self.first:
+            yield chunk
+        while self.pending:
+            data = self.pending.pop(0).wait()
+            self._fill()
+            yield data
+    
+    def close(self):
+        # Cancels the outstanding segments and closes the first part
+        for thread in self.pending:
+            thread.kill()
+        self.pending = []
+        self.next = len(self.segments)
+        if hasattr(self.first, 'close'):
+            self.first.close()
+    
+
+
+class RangeByteSource(ByteSource):
+    """
+    ByteSource of size bytes where fetch(start, stop, *args) returns the
+    bytes from start up to stop, i.e. with a ranged request.
+    """
+    def __init__(self, fetch, size, *args):
+        self.fetch = fetch
+        self.size = size
+        self.args = args
+        self.stats = {'requests': 0, 'bytes': 0}
+    
+    def read(self, offset, size):
+        stop = min(offset + size, self.size)
+        if offset >= stop:
+            return ''
+        data = self.fetch(offset, stop, *self.args)
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(data)
+        return data
+    
+
+class ByteRanges(object):
+    """
+    Iterates over the parts of a ranged response as (start, stop, size,
+    headers, chunks), chunks yielding the bytes from start up to stop of
+    an Object of size bytes. A multipart/byteranges body is parsed while it
+    streams in and never more than a chunk of it is held, so a part has to
+    be read before the next one, whatever is left of it is skipped. A body
+    cut short inside a part raises ValueError, one that ends in between
+    parts just lacks its close delimiter. Single range and whole Object
+    responses are a single part.
+    """
+    def __init__(self, chunks, headers):
+        self.chunks = chunks
+        self.iter = iter(chunks)
+        self.headers = dict((header.lower(), value)
+                            for header, value in headers)
+        self.buf = ''
+    
+    def __iter__(self):
+        content_type = self.headers.get('content-type', '')
+        boundary = None
+        if content_type.lower().startswith('multipart/byteranges'):
+            for param in content_type.split(';')[1:]:
+                (name, value) = param.split('=', 1)
+                if name.strip().lower() == 'boundary':
+                    boundary = value.strip().strip('"')
+        if boundary is not None:
+            return self._parts(boundary)
+        return self._single()
+    
+    def _single(self):
+        if 'content-range' in self.headers:
+            (start, stop, size) = parse_content_range(
+                self.headers['content-range'])
+        else:
+            size = int(self.headers['content-length'])
+            (start, stop) = (0, size)
+        yield (start, stop, size, self.headers, self.iter)
+    
+    def _more(self):
+        try:
+            self.buf += self.iter.next()
+        except StopIteration:
+            raise ValueError('Truncated multipart/byteranges response')
+    
+    def _line(self):
+        # Reads up to the next CRLF, the closing delimiter may lack one
+        while '\r\n' not in self.buf:
+            try:
+                self._more()
+            except ValueError:
+                if not self.buf:
+                    raise
+                (line, self.buf) = (self.buf, '')
+                return line
+        (line, self.buf) = self.buf.split('\r\n', 1)
+        return line
+    
+    def _body(self, size):
+        while size > 0:
+            if not self.buf:
+                self._more()
+            data = self.buf[:size]
+            self.buf = self.buf[len(data):]
+            size -= len(data)
+            yield data
+    
+    def _parts(self, boundary):
+        delimiter = '--' + boundary
+        first = True
+        while True:
+            # Skips the preamble or the CRLF ending the previous part. Once
+            # a part is complete, the body may end without a close delimiter.
+            try:
+                line = self._line().rstrip()
+                while line != delimiter:
+                    if line == delimiter + '--':
+                        return
+                    line = self._line().rstrip()
+            except ValueError:
+                if first:
+                    raise
+                return
+            first = False
+            headers = {}
+            line = self._line()
+            while line:
+                (header, value) = line.split(':', 1)
+                headers[header.strip().lower()] = value.strip()
+                line = self._line()
+            (start, stop, size) = parse_content_range(
+                headers['content-range'])
+            body = self._body(stop - start)
+            yield (start, stop, size, headers, body)
+            for data in body:
+                pass
+    
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+    
+
+
+class Prefetch(object):
+    """
+    Calls func(*args) in a greenthread of its own right away, wait()
+    returns its result. Without eventlet func is only called by wait().
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.thread = None
+        if spawn is not None:
+            self.thread = spawn(func, *args)
+    
+    def wait(self):
+        if self.thread is None:
+            return self.func(*self.args)
+        (thread, self.thread) = (self.thread, None)
+        return thread.wait()
+    
+    def close(self):
+        # Cancels func, or closes its result when nobody waited for it
+        if self.thread is None:
+            return
+        (thread, self.thread) = (self.thread, None)
+        if not thread.dead:
+            thread.kill()
+            return
+        try:
+            result = thread.wait()
+        except Exception:
+            return
+        if hasattr(result, 'close'):
+            result.close()
+    
+
+
+class MultiRangeFetch(object):
+    """
+    Iterates over the bytes from start up to stop out of the ByteRanges of
+    a multi-range response, which has them up to window_stop, followed by
+    the chunks of the rest Prefetch that was requested in parallel.
+    """
+    def __init__(self, parts, start, window_stop, stop, rest=None):
+        self.parts = parts
+        self.start = start
+        self.window_stop = window_stop
+        self.stop = stop
+        self.rest = rest
+        self.rest_resp = None
+    
+    def __iter__(self):
+        offset = self.start
+        for part_start, part_stop, size, headers, chunks in self.parts:
+            if part_start > offset:
+                raise Exception('Multi-range response skips %d-%d' %
+                                (offset, part_start))
+            position = part_start
+            for chunk in chunks:
+                if position + len(chunk) > offset:
+                    yield chunk[max(offset - position, 0):
+                                self.stop - position]
+                    offset = min(position + len(chunk), self.stop)
+                position += len(chunk)
+                if offset >= self.stop:
+                    return
+        if offset <> self.window_stop or self.rest is None:
+            raise Exception('Multi-range response ended at %d' % offset)
+        self.rest_resp = self.rest.wait()
+        for chunk in self.rest_resp:
+            yield chunk
+    
+    def close(self):
+        # Closes both responses, or cancels the rest if it didn't start
+        self.parts.close()
+        if self.rest is not None:
+            self.rest.close()
+        if hasattr(self.rest_resp, 'close'):
+            self.rest_resp.close()
+    
+    
+
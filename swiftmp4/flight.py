@@ -0,0 +1,75 @@
+"""
+Single-flight coalescing of identical work for SwiftMp4Middleware
+
+When many seeks into the same Object arrive at once, only the first one of
+them, the leader, fetches and parses its metadata. The others follow the
+leader and wait for its result, or for its exception which is raised in
+every follower as well. A follower that waited longer than the timeout
+does the work itself, so a stuck leader never holds up its followers, and
+so do the followers of a leader that was killed or timed out itself.
+Without eventlet requests are never concurrent and work simply runs.
+"""
+import sys
+
+try:
+    from eventlet.event import Event
+    from eventlet.timeout import Timeout
+except ImportError:
+    Event = None
+    Timeout = None
+
+# Outcome of a call whose leader never finished it
+ABANDONED = object()
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time, sharing its outcome.
+    """
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.flights = {}
+        self.stats = {'leaders': 0, 'followers': 0, 'timeouts': 0}
+    
+    def do(self, key, func, *args, **kwargs):
+        # Calls func unless a call for key is in flight already, a key of
+        # None is never coalesced
+        if Event is None or key is None:
+            return func(*args, **kwargs)
+        event = self.flights.get(key)
+        if event is not None:
+            self.stats['followers'] += 1
+            result = ABANDONED
+            timeout = Timeout(self.timeout)
+            try:
+                result = event.wait()
+            except Timeout, t:
+                if t is not timeout:
+                    raise
+                self.stats['timeouts'] += 1
+            finally:
+                timeout.cancel()
+            if result is not ABANDONED:
+                return result
+            return func(*args, **kwargs)
+        
+        event = Event()
+        self.flights[key] = event
+        self.stats['leaders'] += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            exc_info = sys.exc_info()
+            event.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        except BaseException:
+            # GreenletExit or a Timeout of the leader's own request says
+            # nothing about func, its followers call it themselves
+            event.send(ABANDONED)
+            raise
+        finally:
+            del self.flights[key]
+        event.send(result)
+        return result
+    
+
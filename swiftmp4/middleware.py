@@ -1,9 +1,25 @@
+import os
+import uuid
+import urllib
 import urlparse
-from StringIO import StringIO
-from swiftmp4.streaming.StreamMp4 import SwiftStreamMp4
+from collections import OrderedDict
+from hashlib import md5
+from email.utils import parsedate_tz
+from swiftmp4.streaming.Helper import read32, read64, type_to_str, EndOfFile
+from swiftmp4.streaming.StreamMp4 import SwiftStreamMp4, SwiftMp4Segments, \
+                                         MalformedMP4
+from swiftmp4.cache import Mp4Metadata, MetadataCache
+from swiftmp4 import sidecar
+from swiftmp4.pool import WorkerPool, PoolSaturated, CooperativeCheckpoint
+from swiftmp4.flight import SingleFlight
+from swiftmp4.fetch import ReadAhead, SegmentedFetch, RangeByteSource, \
+                          ByteRanges, Prefetch, MultiRangeFetch
+from swiftmp4.streaming.StreamByteSource import CachedByteSource
 
 from swift.common import swob
-from swift.common.http import HTTP_BAD_REQUEST
+from swift.common.utils import get_logger
+from swift.common.http import HTTP_BAD_REQUEST, \
+    HTTP_REQUESTED_RANGE_NOT_SATISFIABLE
 
 def get_err_response():
     resp = swob.Response(content_type='text/xml')
@@ -13,17 +29,229 @@ def get_err_response():
                     % (HTTP_BAD_REQUEST, 'Unable to process requested MP4')
     return resp
 
+def get_object_info(headers):
+    # Obtain the object size, content type and etag from a (ranged) GET
+    # response
+    info = {'content_length': None, 'content_type': None, 'etag': None,
+            'last_modified': None}
+    for header, value in headers:
+        header = header.lower()
+        if header == 'content-range':
+            info['content_length'] = int(value.split('/')[-1])
+        elif header == 'content-length' and info['content_length'] is None:
+            info['content_length'] = int(value)
+        elif header == 'content-type':
+            info['content_type'] = value
+        elif header == 'etag':
+            info['etag'] = value.strip('"')
+        elif header == 'last-modified':
+            info['last_modified'] = value
+    return info
+
+def coalesce_ranges(ranges):
+    # Sorts (start, stop) byte ranges and merges the ones that overlap or
+    # touch, so they can be read from a single forward only response
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def multipart_headers(boundary, content_type, start, stop, size):
+    # Headers in front of a single part of a multipart/byteranges body
+    return '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d' \
+           '\r\n\r\n' % (boundary, content_type, start, stop - 1, size)
+
+def parse_time(value):
+    # Parses a start or end in seconds, raises ValueError unless it is a
+    # finite time of at least 0
+    seconds = float(value)
+    if not 0 <= seconds < float('inf'):
+        raise ValueError('Invalid time %r' % value)
+    return seconds
+
+def format_start(start):
+    # Formats a start in milliseconds as the seconds used in ?start=
+    return ('%d.%03d' % divmod(start, 1000)).rstrip('0').rstrip('.')
+
+def stream_etag(etag, start, end):
+    # ETag of the MP4 rewritten from the Object with etag to play from start
+    # up to end, both in milliseconds
+    return md5('%s/%s/%s' % (etag, start, end)).hexdigest()
+
+def seek_key(kind, path, etag, start, end):
+    # Key of a flight of seeks from start up to end, both in milliseconds.
+    # Seeks without an ETag can't tell they read the same Object.
+    if not etag:
+        return None
+    return (kind, path, etag, start, end)
+
+def moov_after_mdat(metadata):
+    # Whether the top level atom headers held by metadata show mdat ahead
+    # of moov, i.e. the MP4 can't be played before it is fully loaded
+    source_file = metadata.get_file()
+    offset = 0
+    while offset < metadata.content_length and source_file.has(offset, 8):
+        source_file.seek(offset, os.SEEK_SET)
+        size = read32(source_file)
+        type = type_to_str(read32(source_file))
+        if type == 'moov':
+            return False
+        if type == 'mdat':
+            return True
+        if size == 1:
+            if not source_file.has(offset, 16):
+                break
+            size = read64(source_file)
+        elif size == 0:
+            break
+        if size < 8:
+            break
+        offset += size
+    return False
+
+def config_true_value(value):
+    return str(value).lower() in ('true', '1', 'yes', 'on', 't', 'y')
+
+
+class RangeSlicer(object):
+    """
+    Reads consecutive byte ranges out of an iterable of chunks that starts
+    at a given offset, skipping whatever lies between them.
+    """
+    def __init__(self, chunks, offset):
+        self.chunks = iter(chunks)
+        self.offset = offset
+        self.buf = ''
+    
+    def read(self, start, stop):
+        # Yields the data in [start, stop), start may not lie behind the
+        # data that was already read
+        if start < self.offset:
+            raise ValueError('Range %d-%d was already read' % (start, stop))
+        while self.offset < stop:
+            if not self.buf:
+                try:
+                    self.buf = self.chunks.next()
+                except StopIteration:
+                    raise Exception('Range response ended at %d' %
+                                    self.offset)
+                continue
+            if self.offset < start:
+                skip = min(start - self.offset, len(self.buf))
+                self.buf = self.buf[skip:]
+                self.offset += skip
+                continue
+            take = min(stop - self.offset, len(self.buf))
+            yield self.buf[:take]
+            self.buf = self.buf[take:]
+            self.offset += take
+    
+
+
+class StaleMetadata(Exception):
+    """
+    Raised when metadata taken from the cache on speculation is no longer
+    the Object's or can't be verified. probe holds the (data, headers) of
+    the first probe_size bytes of the Object when they were read already.
+    """
+    def __init__(self, probe=None):
+        Exception.__init__(self)
+        self.probe = probe
+    
+
 
 class SwiftMp4Middleware(object):
     def __init__(self, app, conf):
         self.app = app
         self.conf = conf
+        self.logger = get_logger(conf, log_route='swiftmp4')
+        # 'probe' locates moov from the top level atom headers and fetches
+        # exactly its range, 'fixed' fetches the first fixed_fetch_size bytes
+        # and 'ondemand' only reads the blocks of ondemand_block_size bytes
+        # the parser touches, keeping up to ondemand_cache_blocks of them
+        self.metadata_fetch = conf.get('metadata_fetch', 'probe').lower()
+        self.fixed_fetch_size = int(conf.get('fixed_fetch_size', 4194304))
+        self.probe_size = int(conf.get('probe_size', 65536))
+        self.ondemand_block_size = int(conf.get('ondemand_block_size', 65536))
+        self.ondemand_cache_blocks = int(
+            conf.get('ondemand_cache_blocks', 256))
+        # Parsed metadata is cached in-process and optionally in memcache,
+        # a metadata_cache_size of 0 disables caching
+        cache_size = int(conf.get('metadata_cache_size', 67108864))
+        self.metadata_cache = None
+        if cache_size > 0:
+            self.metadata_cache = MetadataCache(
+                cache_size, int(conf.get('memcache_max_size', 1048576)),
+                int(conf.get('memcache_time', 86400)))
+        self.metadata_memcache = config_true_value(
+            conf.get('metadata_memcache', 'true'))
+        # Prebuilt seek index sidecars, either local files in sidecar_dir or
+        # companion Objects named after the MP4 with sidecar_suffix appended
+        self.sidecar_dir = conf.get('sidecar_dir', '')
+        self.sidecar_suffix = conf.get('sidecar_suffix', '')
+        # Snap starts onto a 'previous' or 'nearest' keyframe, and optionally
+        # redirect to the canonical start so caches only see those
+        self.seek_snap = conf.get('seek_snap', 'off').lower()
+        if self.seek_snap not in ('previous', 'nearest'):
+            self.seek_snap = None
+        self.seek_snap_redirect = config_true_value(
+            conf.get('seek_snap_redirect', 'false'))
+        # Serve MP4s with moov behind mdat as moov-first streams, for every
+        # GET of a .mp4 without a start or only the ones with ?faststart
+        self.faststart = config_true_value(conf.get('faststart', 'false'))
+        # Paths and ETags of up to faststart_cache_entries Objects that
+        # were found to be moov-first already, they are passed through
+        # without probing them again
+        self.moov_first = OrderedDict()
+        self.faststart_cache_entries = int(
+            conf.get('faststart_cache_entries', 10000))
+        # Parse, update and serialize metadata in a pool of metadata_workers
+        # native threads, with at most metadata_queue_depth seeks waiting
+        # for one. Seeks beyond that are passed through untouched.
+        workers = int(conf.get('metadata_workers', 0))
+        self.worker_pool = None
+        if workers > 0:
+            self.worker_pool = WorkerPool(
+                workers, int(conf.get('metadata_queue_depth', workers * 4)))
+        # Without workers, yield to other requests every
+        # metadata_checkpoint_entries sample table entries instead, 0
+        # disables it. The longest CPU slice of every seek is kept in
+        # its environ and the overall one in checkpoint_stats.
+        self.checkpoint_entries = int(
+            conf.get('metadata_checkpoint_entries', 0))
+        self.checkpoint_stats = {'seeks': 0, 'yields': 0,
+                                 'longest_slice': 0.0}
+        # Concurrent seeks into the same Object share a single metadata
+        # fetch, identical seeks also share the rewritten metadata. Followers
+        # stop waiting on their leader after coalesce_timeout seconds.
+        self.flight = None
+        if config_true_value(conf.get('coalesce_requests', 'true')):
+            self.flight = SingleFlight(
+                float(conf.get('coalesce_timeout', 10)))
+        # Chunks of the mdat range read ahead while the metadata is being
+        # sent, 0 only reads them once they are sent
+        self.read_ahead_chunks = int(conf.get('read_ahead_chunks', 4))
+        # Fetch mdat ranges longer than segment_size as separate segments,
+        # segment_parallelism at a time and at most segment_window ahead of
+        # the client. A segment_size of 0 uses a single request.
+        self.segment_size = int(conf.get('segment_size', 0))
+        self.segment_parallelism = int(conf.get('segment_parallelism', 4))
+        self.segment_window = int(conf.get('segment_window', 8))
+        # With the metadata of an Object cached, fetch the first
+        # probe_size bytes together with the first multirange_window bytes
+        # of the mdat range in a single multi-range request, the rest of it
+        # from a second request made in parallel. The probe tells whether
+        # the Object changed and replaces the regular one if it did. A
+        # multirange_window of 0 always probes before the mdat range.
+        self.multirange_window = int(conf.get('multirange_window', 0))
     
     def make_start_request(self, env):
-        # Request first 4 MB of Object
-        # TODO: Make this a configuration option later
+        # Request the first fixed_fetch_size bytes of Object
         environ = env.copy()
-        environ['HTTP_RANGE'] = 'bytes=0-4194304'
+        environ['HTTP_RANGE'] = 'bytes=0-%d' % self.fixed_fetch_size
         def start_response(status, headers, *args):
             if not status.startswith('2'):
                 env['swift.start_error'] = True
@@ -31,10 +259,19 @@ class SwiftMp4Middleware(object):
         
         return self.app(environ, start_response)
     
-    def make_range_request(self, env, start, stop):
-        # Makes a ranged request
+    def make_range_request(self, env, start, stop, etag=None):
+        # Makes a ranged request, optionally only if the Object still has
+        # the given etag
+        return self.make_ranges_request(env, [(start, stop)], etag)
+    
+    def make_ranges_request(self, env, ranges, etag=None):
+        # Makes a request for every inclusive (start, stop) byte range
+        env.pop('swift.range_error', None)
         environ = env.copy()
-        environ['HTTP_RANGE'] = 'bytes=%s-%s' % (start, stop)
+        environ['HTTP_RANGE'] = 'bytes=' + \
+            ','.join(['%s-%s' % (start, stop) for start, stop in ranges])
+        if etag:
+            environ['HTTP_IF_MATCH'] = etag
         def start_response(status, headers, *args):
             if not status.startswith('2'):
                 env['swift.range_error'] = True
@@ -42,66 +279,744 @@ class SwiftMp4Middleware(object):
         
         return self.app(environ, start_response)
     
+    def read_range(self, env, start, stop):
+        # Reads a byte range of the Object into memory
+        data = ''.join(self.make_range_request(env, start, stop))
+        if env.get('swift.range_error'):
+            raise Exception('Invalid range response %r' %
+                            (env['swift.range_response'],))
+        status, headers = env['swift.range_response']
+        return data, headers
+    
+    def read_segment(self, start, stop, env, etag):
+        # Returns the bytes from start up to stop of the Object, every
+        # segment gets its own environ as they are read concurrently
+        segment_env = env.copy()
+        data = ''.join(self.make_range_request(segment_env, start, stop - 1,
+                                               etag))
+        if segment_env.get('swift.range_error') or \
+                len(data) != stop - start:
+            raise Exception('Invalid segment response %r' %
+                            (segment_env.get('swift.range_response'),))
+        return data
+    
+    def open_range(self, start, stop, env, etag):
+        # Requests the bytes from start up to stop of the Object in an
+        # environ of its own, so it can be made in parallel
+        range_env = env.copy()
+        range_resp = self.make_range_request(range_env, start, stop - 1, etag)
+        if range_env.get('swift.range_error'):
+            if hasattr(range_resp, 'close'):
+                range_resp.close()
+            raise Exception('Invalid range response %r' %
+                            (range_env.get('swift.range_response'),))
+        return range_resp
+    
+    def make_multirange_request(self, env, metadata, start, stop):
+        # Requests the probe together with the first multirange_window
+        # bytes from start, and the rest up to stop in parallel. Returns
+        # the chunks from start up to stop and the response headers, or
+        # raises StaleMetadata when the Object is not the one parsed.
+        window_stop = min(start + self.multirange_window, stop)
+        probe_stop = min(self.probe_size, metadata.content_length)
+        rest = None
+        if window_stop < stop:
+            rest = Prefetch(self.open_range, window_stop, stop, env,
+                            metadata.etag)
+        if start <= probe_stop:
+            # The window touches the probe, a single range covers both
+            ranges = [(0, window_stop - 1)]
+        else:
+            ranges = [(0, probe_stop - 1), (start, window_stop - 1)]
+        range_resp = self.make_ranges_request(env, ranges)
+        parts = None
+        try:
+            if env.get('swift.range_error'):
+                raise StaleMetadata()
+            status, headers = env['swift.range_response']
+            parts = ByteRanges(range_resp, headers)
+            info = get_object_info(headers)
+            if info['etag'] != metadata.etag:
+                raise StaleMetadata(self.read_probe(parts, info))
+            self.metadata_cache.verified(env['PATH_INFO'])
+        except:
+            if parts is not None:
+                parts.close()
+            elif hasattr(range_resp, 'close'):
+                range_resp.close()
+            if rest is not None:
+                rest.close()
+            raise
+        return (MultiRangeFetch(parts, start, window_stop, stop, rest),
+                headers)
+    
+    def read_probe(self, parts, info):
+        # Reads the first probe_size bytes out of the first part, returns
+        # them with the headers of a ranged response for just them
+        for start, stop, size, part_headers, chunks in parts:
+            data = ''
+            for chunk in chunks:
+                data += chunk
+                if len(data) >= self.probe_size:
+                    break
+            data = data[:self.probe_size]
+            if start <> 0 or not data:
+                break
+            headers = [('content-range',
+                        'bytes 0-%d/%d' % (len(data) - 1, size)),
+                       ('content-type', part_headers.get(
+                           'content-type', info['content_type']))]
+            for header in ('etag', 'last_modified'):
+                if info[header]:
+                    headers.append((header.replace('_', '-'), info[header]))
+            return (data, headers)
+        return None
+    
+    def get_cached_metadata(self, env, etag):
+        if self.metadata_cache is None or not etag:
+            return None
+        memcache = None
+        if self.metadata_memcache:
+            memcache = env.get('swift.cache')
+        return self.metadata_cache.get(env['PATH_INFO'], etag, memcache)
+    
+    def set_seek_indexes(self, mp4stream, metadata):
+        # Reuse the cached seek indexes or build them to be cached, returns
+        # whether metadata has to be cached
+        if metadata.seek_indexes is not None:
+            mp4stream._setSeekIndexes(metadata.seek_indexes)
+        elif self.metadata_cache is not None and metadata.etag and \
+                metadata.source is None:
+            metadata.seek_indexes = mp4stream._buildSeekIndexes()
+            return True
+        return False
+    
+    def cache_metadata(self, env, metadata):
+        memcache = None
+        if self.metadata_memcache:
+            memcache = env.get('swift.cache')
+        self.metadata_cache.put(env['PATH_INFO'], metadata, memcache)
+    
+    def make_sidecar_request(self, env):
+        # Requests the companion sidecar Object
+        environ = env.copy()
+        environ['PATH_INFO'] = env['PATH_INFO'] + self.sidecar_suffix
+        environ['QUERY_STRING'] = ''
+        environ.pop('HTTP_RANGE', None)
+        def start_response(status, headers, *args):
+            env['swift.sidecar_response'] = (status, headers)
+        
+        return self.app(environ, start_response)
+    
+    def sidecar_metadata(self, env, etag):
+        # Returns the Mp4Metadata stored in the Object's sidecar if it has one
+        # built for the given etag, i.e. the current version of the Object
+        metadata = None
+        try:
+            if self.sidecar_dir:
+                path = sidecar.sidecar_path(self.sidecar_dir, env['PATH_INFO'])
+                if os.path.exists(path):
+                    metadata = sidecar.load(path)
+            if metadata is None and self.sidecar_suffix:
+                data = ''.join(self.make_sidecar_request(env))
+                status, headers = env['swift.sidecar_response']
+                if status.startswith('2'):
+                    metadata = sidecar.loads(data)
+        except (sidecar.InvalidSidecar, EnvironmentError):
+            pass
+        if metadata is None or not etag or metadata.etag != etag:
+            return None
+        return metadata
+    
+    def coalesce(self, key, func, *args):
+        # Shares func's outcome with concurrent calls for the same key
+        if self.flight is None:
+            return func(*args)
+        return self.flight.do(key, func, *args)
+    
+    def fetch_metadata(self, env, probe=None):
+        # Returns the Mp4Metadata of the requested Object, probe holds the
+        # (data, headers) of its first probe_size bytes if they are known
+        if self.sidecar_dir or self.sidecar_suffix:
+            # A sidecar is only as current as the ETag the probe shows, the
+            # probe is reused by the regular fetch when it is stale
+            probe = probe or self.read_range(env, 0, self.probe_size - 1)
+            info = get_object_info(probe[1])
+            metadata = self.sidecar_metadata(env, info['etag'])
+            if metadata is not None:
+                metadata.last_modified = info['last_modified']
+                return metadata
+        if self.metadata_fetch == 'ondemand':
+            return self.ondemand_metadata(env, probe)
+        if self.metadata_fetch == 'probe':
+            try:
+                return self.probe_metadata(env, probe)
+            except (MalformedMP4, EndOfFile):
+                # Fall back to the fixed size request
+                pass
+        # The ETag is only known once the fixed size response arrives
+        return self.coalesce(('fixed', env['PATH_INFO']),
+                             self.fixed_metadata, env)
+    
+    def fixed_metadata(self, env):
+        start_resp = self.make_start_request(env)
+        data = ''.join(start_resp)
+        if env.get('swift.start_error'):
+            raise Exception('Invalid start response %r' %
+                            env['swift.start_response'])
+        status, headers = env['swift.start_response']
+        info = get_object_info(headers)
+        metadata = self.get_cached_metadata(env, info['etag'])
+        if metadata is None:
+            metadata = Mp4Metadata(info['etag'], info['content_length'],
+                                   info['content_type'], [(0, data)],
+                                   last_modified=info['last_modified'])
+        return metadata
+    
+    def ondemand_metadata(self, env, probe=None):
+        # Mp4Metadata that reads the Object as it is parsed, starting out
+        # with the first probe_size bytes
+        data, headers = probe or self.read_range(env, 0, self.probe_size - 1)
+        info = get_object_info(headers)
+        metadata = self.get_cached_metadata(env, info['etag'])
+        if metadata is not None:
+            return metadata
+        source = CachedByteSource(
+            RangeByteSource(self.read_segment, info['content_length'], env,
+                            info['etag']),
+            self.ondemand_block_size, self.ondemand_cache_blocks)
+        source.add(0, data)
+        metadata = Mp4Metadata(info['etag'], info['content_length'],
+                               info['content_type'], None,
+                               last_modified=info['last_modified'])
+        metadata.source = source
+        return metadata
+    
+    def probe_metadata(self, env, probe=None):
+        # Most MP4s keep ftyp and a small moov at the front, so the first
+        # probe_size bytes frequently hold everything
+        data, headers = probe or self.read_range(env, 0, self.probe_size - 1)
+        info = get_object_info(headers)
+        metadata = self.get_cached_metadata(env, info['etag'])
+        if metadata is not None:
+            return metadata
+        key = None
+        if info['etag']:
+            key = ('probe', env['PATH_INFO'], info['etag'])
+        return self.coalesce(key, self.probe_atoms, env, data, info)
+    
+    def probe_atoms(self, env, data, info):
+        # Fetches the rest of the top level atoms past the probe
+        content_length = info['content_length']
+        segments = SwiftMp4Segments(content_length)
+        segments.add(0, data)
+        
+        # Walk the top level atom headers, fetching the ones that were not
+        # part of the probe and the full ftyp and moov atoms
+        found_moov = False
+        found_mdat = False
+        offset = 0
+        while offset < content_length:
+            header_size = min(16, content_length - offset)
+            if not segments.has(offset, header_size):
+                stop = offset + header_size
+                if found_mdat and \
+                        content_length - offset <= self.fixed_fetch_size:
+                    # Atoms behind mdat, i.e. a moov at the end, are read
+                    # along with their headers up to the end of the Object
+                    stop = content_length
+                data, headers = self.read_range(env, offset, stop - 1)
+                segments.add(offset, data)
+            segments.seek(offset, os.SEEK_SET)
+            size = read32(segments)
+            type = type_to_str(read32(segments))
+            if size == 1:
+                size = read64(segments)
+            elif size == 0:
+                size = content_length - offset
+            if size < 8:
+                raise MalformedMP4()
+            if type in ('ftyp', 'moov'):
+                if not segments.has(offset, size):
+                    data, headers = self.read_range(env, offset,
+                                                    offset + size - 1)
+                    segments.add(offset, data)
+                if type == 'moov':
+                    found_moov = True
+            elif type == 'mdat':
+                found_mdat = True
+            offset += size
+        
+        if not found_moov:
+            raise MalformedMP4()
+        return Mp4Metadata(info['etag'], content_length,
+                           info['content_type'], segments.segments,
+                           last_modified=info['last_modified'])
+    
+    def probe_moov_first(self, env, data, info):
+        # Whether moov lies ahead of mdat, told by the top level atom
+        # headers in the probe data and the ones fetched past it, without
+        # fetching any atom itself
+        content_length = info['content_length']
+        segments = SwiftMp4Segments(content_length)
+        segments.add(0, data)
+        offset = 0
+        while offset + 8 <= content_length:
+            header_size = min(16, content_length - offset)
+            if not segments.has(offset, header_size):
+                data, headers = self.read_range(env, offset,
+                                                offset + header_size - 1)
+                segments.add(offset, data)
+            segments.seek(offset, os.SEEK_SET)
+            size = read32(segments)
+            type = type_to_str(read32(segments))
+            if type == 'moov':
+                return True
+            if type == 'mdat':
+                return False
+            if size == 1:
+                size = read64(segments)
+            elif size == 0:
+                size = content_length - offset
+            if size < 8:
+                raise MalformedMP4()
+            offset += size
+        raise MalformedMP4()
+    
+    def remember_moov_first(self, path, etag):
+        self.moov_first.pop(path, None)
+        if etag and self.faststart_cache_entries > 0:
+            self.moov_first[path] = etag
+            while len(self.moov_first) > self.faststart_cache_entries:
+                self.moov_first.popitem(last=False)
+    
+    def passthrough_moov_first(self, env, start_response, client_range,
+                               if_range, etag):
+        # Serves an Object known to be moov-first as is. Returns None
+        # instead when the response shows another ETag, the new version of
+        # the Object has to be probed.
+        response = {}
+        def moov_first_response(status, headers, *args):
+            response['args'] = (status, headers) + args
+        
+        resp = self.passthrough(env.copy(), moov_first_response,
+                                client_range, if_range)
+        status, headers = response['args'][:2]
+        if status.startswith('2') and \
+                get_object_info(headers)['etag'] != etag:
+            if hasattr(resp, 'close'):
+                resp.close()
+            del self.moov_first[env['PATH_INFO']]
+            return None
+        start_response(*response['args'])
+        return resp
+    
+    def get_ranges(self, client_range, if_range, etag, last_modified,
+                   size):
+        # Byte ranges of the rewritten MP4 that were requested, None when
+        # the whole MP4 should be sent and [] when none is satisfiable.
+        # An If-Range keeps the Range if it holds the ETag of the rewritten
+        # MP4 or the Last-Modified date sent along with it.
+        if not client_range:
+            return None
+        if if_range:
+            if_range = if_range.strip()
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                # Only strong ETags can be compared for a Range
+                if not etag or if_range != '"%s"' % etag:
+                    return None
+            else:
+                date = parsedate_tz(if_range)
+                if date is None or not last_modified or \
+                        date != parsedate_tz(last_modified):
+                    return None
+        try:
+            ranges = swob.Range(client_range).ranges_for_length(size)
+        except ValueError:
+            # Invalid Range headers are ignored
+            return None
+        if ranges is None:
+            return None
+        return coalesce_ranges(ranges)
+    
+    def make_redirect_response(self, env, start_response, start):
+        # Redirects to the same request with the canonical start
+        query = [(key, value) for key, value
+                 in urlparse.parse_qsl(env.get('QUERY_STRING') or '',
+                                       keep_blank_values=True)
+                 if key != 'start']
+        query.insert(0, ('start', format_start(start)))
+        location = urllib.quote(env.get('SCRIPT_NAME', '') +
+                                env['PATH_INFO']) + '?' + \
+                   urllib.urlencode(query)
+        start_response('302 Found', [('location', location),
+                                     ('content-length', '0')])
+        return []
+    
+    def make_stream_response(self, env, start_response, mp4stream, metadata,
+                             size, ranges, etag, speculative=False):
+        # Serves the rewritten MP4, or ranges of it, out of the rewritten
+        # metadata and a single ranged request for the mdat data. Metadata
+        # taken on speculation is verified by a multi-range request instead.
+        partial = ranges is not None
+        if not partial:
+            ranges = [(0, size)]
+        header_size = mp4stream._getMetadataSize()
+        mdat_start, mdat_stop = mp4stream._getByteRangeToRequest()
+        
+        # Map the ranges past the metadata onto the Object
+        backend_ranges = [(mdat_start + max(start, header_size) - header_size,
+                           mdat_start + stop - header_size)
+                          for start, stop in ranges if stop > header_size]
+        range_resp = []
+        last_modified = None
+        if speculative and not backend_ranges:
+            # Nothing would show whether the Object changed
+            raise StaleMetadata()
+        if speculative:
+            (range_resp, range_headers) = self.make_multirange_request(
+                env, metadata, backend_ranges[0][0], backend_ranges[-1][1])
+            last_modified = get_object_info(range_headers)['last_modified']
+            range_resp = ReadAhead(range_resp, self.read_ahead_chunks)
+        elif backend_ranges:
+            backend_start = backend_ranges[0][0]
+            backend_stop = backend_ranges[-1][1]
+            first_stop = backend_stop
+            if self.segment_size > 0:
+                first_stop = min(backend_start + self.segment_size,
+                                 backend_stop)
+            # Its response also tells if the Object is still the one parsed
+            range_resp = self.make_range_request(
+                env, backend_start, first_stop - 1, metadata.etag)
+            if env.get('swift.range_error'):
+                if hasattr(range_resp, 'close'):
+                    range_resp.close()
+                raise Exception('Invalid range response %r' %
+                                (env['swift.range_response'],))
+            status, range_headers = env['swift.range_response']
+            last_modified = get_object_info(range_headers)['last_modified']
+            range_resp = ReadAhead(range_resp, self.read_ahead_chunks)
+            if first_stop < backend_stop:
+                range_resp = SegmentedFetch(
+                    range_resp, first_stop, backend_stop, self.segment_size,
+                    self.segment_parallelism, self.segment_window,
+                    self.read_segment, env, metadata.etag)
+        
+        headers = [('accept-ranges', 'bytes'),
+                   ('x-mp4-start', format_start(mp4stream.start))]
+        if etag:
+            headers.append(('etag', '"%s"' % etag))
+        if last_modified:
+            headers.append(('last-modified', last_modified))
+        boundary = None
+        if not partial:
+            status = '200 OK'
+            headers += [('content-type', metadata.content_type),
+                        ('content-length', str(size))]
+        elif len(ranges) == 1:
+            status = '206 Partial Content'
+            start, stop = ranges[0]
+            headers += [('content-type', metadata.content_type),
+                        ('content-length', str(stop - start)),
+                        ('content-range',
+                         'bytes %d-%d/%d' % (start, stop - 1, size))]
+        else:
+            status = '206 Partial Content'
+            boundary = uuid.uuid4().hex
+            length = len('--%s--' % boundary)
+            for start, stop in ranges:
+                length += len(multipart_headers(boundary,
+                                                metadata.content_type,
+                                                start, stop, size))
+                length += (stop - start) + 2
+            headers += [('content-type',
+                         'multipart/byteranges;boundary=%s' % boundary),
+                        ('content-length', str(length))]
+        start_response(status, headers)
+        
+        # Return iterator of mp4 data
+        def content_iter():
+            try:
+                metadata_data = None
+                if ranges[0][0] < header_size:
+                    # Yield modified mp4 metadata
+                    metadata_data = mp4stream._getStreamHeader()
+                slicer = None
+                if backend_ranges:
+                    slicer = RangeSlicer(range_resp, backend_ranges[0][0])
+                for start, stop in ranges:
+                    if boundary:
+                        yield multipart_headers(boundary,
+                                                metadata.content_type,
+                                                start, stop, size)
+                    if start < header_size:
+                        yield metadata_data[start:min(stop, header_size)]
+                    if stop > header_size:
+                        for chunk in slicer.read(
+                                mdat_start + max(start, header_size) -
+                                header_size,
+                                mdat_start + stop - header_size):
+                            yield chunk
+                    if boundary:
+                        yield '\r\n'
+                if boundary:
+                    yield '--%s--' % boundary
+            except Exception:
+                # Content-Length was already sent, raising makes the server
+                # abort the connection so the client sees a short response
+                self.logger.exception('Error streaming %s' %
+                                      env['PATH_INFO'])
+                raise
+            finally:
+                # Also stops reading when the client went away
+                if hasattr(range_resp, 'close'):
+                    range_resp.close()
+        
+        return content_iter()
+    
     def __call__(self, env, start_response):
         try:
             return self.handle_request(env, start_response)
-        except Exception, e:
-            pass
-        return 
+        except Exception:
+            # Nothing was sent yet, the body is only streamed once the
+            # request was handled
+            self.logger.exception('Error serving %s' % env['PATH_INFO'])
+            return get_err_response()(env, start_response)
+    
+    def snap_stream(self, metadata, start, end, checkpoint=None):
+        # Parses the metadata as far as it takes to snap start onto a
+        # keyframe. Returns the canonical start in milliseconds, or None
+        # when the metadata is invalid, and whether metadata has to be
+        # cached.
+        mp4stream = SwiftStreamMp4(metadata.get_file(),
+                                   metadata.content_length, start,
+                                   end=end, snap=self.seek_snap,
+                                   checkpoint=checkpoint)
+        mp4stream._parseMp4()
+        if not mp4stream._verifyMetadata():
+            return (None, False)
+        cache = self.set_seek_indexes(mp4stream, metadata)
+        return (mp4stream._snapStart(mp4stream.start), cache)
+    
+    def prepare_stream(self, metadata, start, end, canonical_start,
+                       checkpoint=None):
+        # Parses, updates and serializes the metadata to play from the
+        # canonical start in milliseconds, only CPU bound work so it can run
+        # in a native thread. Returns the SwiftStreamMp4, or None when the
+        # metadata is invalid, and whether metadata has to be cached.
+        mp4stream = SwiftStreamMp4(metadata.get_file(),
+                                   metadata.content_length, start,
+                                   end=end, checkpoint=checkpoint)
+        mp4stream._parseMp4()
+        if not mp4stream._verifyMetadata():
+            return (None, False)
+        cache = self.set_seek_indexes(mp4stream, metadata)
+        mp4stream.start = canonical_start
+        mp4stream._updateAtoms()
+        mp4stream._getStreamHeader()
+        return (mp4stream, cache)
+    
+    def prepare(self, env, metadata, func, *args):
+        # Runs func on metadata, away from the hub if possible, and caches
+        # the metadata if func says so. Returns the rest of its result.
+        if self.worker_pool is not None and metadata.source is None:
+            # Reading on demand makes requests, so it stays on the hub
+            prepared = self.worker_pool.execute(func, metadata, *args)
+        elif self.checkpoint_entries > 0:
+            checkpoint = CooperativeCheckpoint(self.checkpoint_entries)
+            try:
+                prepared = func(metadata, *args, checkpoint=checkpoint)
+            finally:
+                self.record_checkpoint(env, checkpoint)
+        else:
+            prepared = func(metadata, *args)
+        (result, cache) = prepared
+        if cache:
+            self.cache_metadata(env, metadata)
+        return result
+    
+    def record_checkpoint(self, env, checkpoint):
+        longest_slice = checkpoint.finish()
+        env['swiftmp4.longest_slice'] = longest_slice
+        self.checkpoint_stats['seeks'] += 1
+        self.checkpoint_stats['yields'] += checkpoint.yields
+        self.checkpoint_stats['longest_slice'] = max(
+            self.checkpoint_stats['longest_slice'], longest_slice)
+    
+    def passthrough(self, env, start_response, client_range, if_range):
+        # Serves the Object as is
+        if client_range:
+            env['HTTP_RANGE'] = client_range
+        if if_range:
+            env['HTTP_IF_RANGE'] = if_range
+        return self.app(env, start_response)
     
     def handle_request(self, env, start_response):
-        parts = urlparse.parse_qs(env.get('QUERY_STRING') or '')
+        parts = urlparse.parse_qs(env.get('QUERY_STRING') or '',
+                                  keep_blank_values=True)
         start = parts.get('start', [''])[0]
+        end = parts.get('end', [''])[0]
+        # Without a start, faststart rewrites the whole MP4 from 0
+        faststart = not start and env['REQUEST_METHOD'] == 'GET' and \
+            ('faststart' in parts or
+             (self.faststart and env['PATH_INFO'].lower().endswith('.mp4')))
+        if faststart:
+            start = '0'
         # TODO: Check that the file requested is a MP4
         if start and env['REQUEST_METHOD'] == 'GET':
-            # Get the MP4 metadata
-            start_resp = self.make_start_request(env)
-            start_file = StringIO(''.join(start_resp))
-            if env.get('swift.start_error'):
-                raise Exception('Invalid start response %r' %
-                                env['swift.start_response'])
-            status, headers = env['swift.start_response']
-            for header, value in headers:
-                if header == 'content-range':
-                    content_length = int(value.split('/')[-1])
-                if header == 'content-type':
-                    content_type = value
+            # Starts and ends have to be times, ends past their start
+            try:
+                start_time = parse_time(start)
+                if end and parse_time(end) <= start_time:
+                    raise ValueError('End %r before start %r' % (end, start))
+            except ValueError:
+                return get_err_response()(env, start_response)
             
-            # Parse MP4 metadata
-            mp4stream = SwiftStreamMp4(start_file, content_length, start)
-            mp4stream._parseMp4()
+            # A client Range applies to the rewritten MP4, never pass it on
+            # to the subrequests
+            client_range = env.pop('HTTP_RANGE', None)
+            if_range = env.pop('HTTP_IF_RANGE', None)
             
-            # Verify MP4 metadata
-            if mp4stream._verifyMetadata():
-                # Update the metadata
-                mp4stream._updateAtoms()
-                
-                # Start creating the response
-                status = '200 OK'
-                headers = [('content-type', content_type)]
-                start_response(status, headers)
-                
-                # Return iterator of mp4 data
-                def content_iter():
-                    try:
-                        # Yield modified mp4 metadata
-                        for i, chunk in enumerate(mp4stream._yieldMetadataToStream()):
-                            yield chunk
-                        # Make a ranged request for the actual MP4 content data
-                        start, stop = mp4stream._getByteRangeToRequest()
-                        range_resp = self.make_range_request(env, start, stop)
-                        for chunk in range_resp:
-                            yield chunk
-                    except Exception, e:
-                        # TODO: Figure out how this exception should be handled
-                        pass
-                
-                return content_iter()
-            else:
-                raise Exception('Invalid MP4 metadata')
+            if self.worker_pool is not None and \
+                    self.worker_pool.saturated():
+                return self.passthrough(env, start_response, client_range,
+                                        if_range)
+            
+            if not faststart:
+                return self.seek(env, start_response, start, end, faststart,
+                                 client_range, if_range)
+            
+            # A faststart is a plain GET of the MP4, whatever goes wrong
+            # before the response started serves it as is instead
+            started = []
+            def faststart_response(status, headers, *args):
+                started.append(status)
+                return start_response(status, headers, *args)
+            
+            try:
+                return self.seek(env, faststart_response, start, end,
+                                 faststart, client_range, if_range)
+            except Exception, e:
+                if started:
+                    raise
+                self.logger.warning('Serving %s as is: %s' %
+                                    (env['PATH_INFO'], e))
+                return self.passthrough(env, start_response, client_range,
+                                        if_range)
         else:
             return self.app(env, start_response)
     
+    def seek(self, env, start_response, start, end, faststart, client_range,
+             if_range):
+        # A faststart of an Object known to be moov-first costs nothing
+        # but passing it through
+        rewrite_all = faststart and not end
+        if rewrite_all and env['PATH_INFO'] in self.moov_first:
+            resp = self.passthrough_moov_first(
+                env, start_response, client_range, if_range,
+                self.moov_first[env['PATH_INFO']])
+            if resp is not None:
+                return resp
+        
+        # Try the cached metadata of the Object first, the multi-range
+        # request for its mdat data verifies it
+        probe = None
+        metadata = None
+        if self.multirange_window > 0 and self.metadata_cache is not None:
+            metadata = self.metadata_cache.peek(env['PATH_INFO'])
+        if metadata is not None:
+            try:
+                return self.serve(env, start_response, metadata, start, end,
+                                  faststart, client_range, if_range,
+                                  speculative=True)
+            except StaleMetadata, e:
+                probe = e.probe
+        
+        # Only an Object with moov behind mdat is worth a faststart, which
+        # its top level atom headers tell before moov is fetched
+        if rewrite_all:
+            probe = probe or self.read_range(env, 0, self.probe_size - 1)
+            info = get_object_info(probe[1])
+            if self.probe_moov_first(env, probe[0], info):
+                self.remember_moov_first(env['PATH_INFO'], info['etag'])
+                return self.passthrough(env, start_response, client_range,
+                                        if_range)
+        
+        # Get the MP4 metadata
+        metadata = self.fetch_metadata(env, probe)
+        return self.serve(env, start_response, metadata, start, end,
+                          faststart, client_range, if_range)
+    
+    def serve(self, env, start_response, metadata, start, end, faststart,
+              client_range, if_range, speculative=False):
+        # Serves the MP4 rewritten from metadata, raises StaleMetadata
+        # before anything is sent when metadata was taken on speculation
+        # and turns out to be stale or can't be verified
+        if faststart and not end and not moov_after_mdat(metadata):
+            # Anything but an MP4 with moov behind mdat is served as is,
+            # unless it has to be cut at an end
+            return self.passthrough(env, start_response, client_range,
+                                    if_range)
+        
+        # Snap the start onto a keyframe once for identical seeks, then
+        # update and serialize the metadata once for all the seeks that
+        # snap onto the same keyframe, however their start and end are
+        # written
+        path = env['PATH_INFO']
+        requested_start = int(float(start) * 1000)
+        end_time = int(float(end) * 1000) if end else None
+        mp4stream = None
+        try:
+            canonical_start = requested_start
+            if self.seek_snap:
+                canonical_start = self.coalesce(
+                    seek_key('snap', path, metadata.etag, requested_start,
+                             end_time),
+                    self.prepare, env, metadata, self.snap_stream, start,
+                    end)
+            if canonical_start is not None:
+                mp4stream = self.coalesce(
+                    seek_key('stream', path, metadata.etag, canonical_start,
+                             end_time),
+                    self.prepare, env, metadata, self.prepare_stream, start,
+                    end, canonical_start)
+        except PoolSaturated:
+            return self.passthrough(env, start_response, client_range,
+                                    if_range)
+        
+        # Verify MP4 metadata
+        if mp4stream is None:
+            if speculative:
+                raise StaleMetadata()
+            raise Exception('Invalid MP4 metadata')
+        if self.seek_snap_redirect and mp4stream.start != requested_start:
+            if speculative:
+                raise StaleMetadata()
+            return self.make_redirect_response(env, start_response,
+                                               mp4stream.start)
+        
+        # The response is a virtual file of the rewritten metadata followed
+        # by a byte range of the Object, its size is fully known once the
+        # metadata is updated
+        size = mp4stream._getStreamSize()
+        etag = None
+        if metadata.etag:
+            etag = stream_etag(metadata.etag, mp4stream.start, mp4stream.end)
+        ranges = self.get_ranges(client_range, if_range, etag,
+                                 metadata.last_modified, size)
+        if ranges == []:
+            if speculative:
+                raise StaleMetadata()
+            start_response('%d Requested Range Not Satisfiable' %
+                           HTTP_REQUESTED_RANGE_NOT_SATISFIABLE,
+                           [('content-range', 'bytes */%d' % size),
+                            ('content-length', '0'),
+                            ('accept-ranges', 'bytes')])
+            return []
+        return self.make_stream_response(env, start_response, mp4stream,
+                                         metadata, size, ranges, etag,
+                                         speculative)
+    
 
 
 def filter_factory(global_conf, **local_conf):
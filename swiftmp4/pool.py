@@ -0,0 +1,104 @@
+"""
+Bounded worker pool and cooperative checkpoints for the CPU bound work of
+SwiftMp4Middleware
+
+Parsing, updating and serializing MP4 metadata never yields to the eventlet
+hub, so a seek into a long file would stall every other greenthread of the
+proxy worker. The pool runs that work in eventlet's native thread pool,
+at most workers jobs at a time and with at most queue_depth jobs waiting
+for one of them. Callers fall back to something cheaper once it is
+saturated. Without eventlet there is no hub to protect and jobs simply run
+inline.
+
+CooperativeCheckpoint is the lighter alternative, it is handed to the long
+sample table loops and yields to the hub every so many entries instead.
+"""
+import time
+
+try:
+    from eventlet import tpool, sleep
+    from eventlet.semaphore import Semaphore
+except ImportError:
+    tpool = None
+    sleep = None
+    Semaphore = None
+
+
+class PoolSaturated(Exception):
+    pass
+    
+
+
+class WorkerPool(object):
+    """
+    Runs jobs in native threads, never more than workers at a time.
+    """
+    def __init__(self, workers, queue_depth=0):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.running = 0
+        self.waiting = 0
+        self.semaphore = None
+        if Semaphore is not None:
+            self.semaphore = Semaphore(workers)
+        self.stats = {'executed': 0, 'rejected': 0}
+    
+    def saturated(self):
+        return self.running >= self.workers and \
+            self.waiting >= self.queue_depth
+    
+    def execute(self, func, *args, **kwargs):
+        # Runs func in a native thread and returns its result, or raises
+        # PoolSaturated without running it
+        if tpool is None:
+            return func(*args, **kwargs)
+        if self.saturated():
+            self.stats['rejected'] += 1
+            raise PoolSaturated()
+        self.waiting += 1
+        try:
+            self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            self.stats['executed'] += 1
+            return tpool.execute(func, *args, **kwargs)
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+    
+
+
+class CooperativeCheckpoint(object):
+    """
+    Checkpoint hook yielding to the eventlet hub once every entries table
+    entries. Keeps track of the longest stretch of CPU time in between.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.pending = 0
+        self.yields = 0
+        self.longest_slice = 0.0
+        self.slice_start = time.time()
+    
+    def __call__(self, entries):
+        self.pending += entries
+        if self.pending >= self.entries:
+            self.pending = 0
+            self.end_slice()
+            if sleep is not None:
+                sleep(0)
+            self.yields += 1
+            self.slice_start = time.time()
+    
+    def end_slice(self):
+        self.longest_slice = max(self.longest_slice,
+                                 time.time() - self.slice_start)
+    
+    # Ends the last slice, returns the longest one in seconds
+    def finish(self):
+        self.end_slice()
+        return self.longest_slice
+    
+
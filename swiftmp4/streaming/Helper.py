@@ -4,7 +4,17 @@
 
 Helper.py - Helper functions used to parse MP4 files
 """
+import os
+import sys
+import array
 import struct
+import itertools
+
+# NumPy is optional, sample tables fall back to the array module without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ### File Handling Helper Functions Below
 
@@ -14,8 +24,17 @@ class EndOfFile(Exception):
         Exception.__init__(self)
     
 
+# Fixed size fields, unpacked in place by buffers that support it
+UINT64 = struct.Struct(">Q")
+UINT32 = struct.Struct(">I")
+UINT24 = struct.Struct(">BH")
+UINT16 = struct.Struct(">H")
+UINT8 = struct.Struct(">B")
+
 # read64 - Reads 64 bits from MP4 in BigEndian
 def read64(file):
+    if isinstance(file, Mp4Buffer):
+        return file.unpack(UINT64)[0]
     data = file.read(8)
     if (data is None or len(data) <> 8):
         raise EndOfFile()
@@ -23,6 +42,8 @@ def read64(file):
 
 # read32 - Reads 32 bits from MP4 in BigEndian
 def read32(file):
+    if isinstance(file, Mp4Buffer):
+        return file.unpack(UINT32)[0]
     data = file.read(4)
     if (data is None or len(data) <> 4):
         raise EndOfFile()
@@ -30,6 +51,9 @@ def read32(file):
 
 # read24 - Reads 24 bits from MP4 in BigEndian
 def read24(file):
+    if isinstance(file, Mp4Buffer):
+        (high, low) = file.unpack(UINT24)
+        return (high << 16) | low
     data = file.read(3)
     if (data is None or len(data) <> 3):
         raise EndOfFile()
@@ -37,6 +61,8 @@ def read24(file):
 
 # read16 - Reads 16 bits from MP4 in BigEndian
 def read16(file):
+    if isinstance(file, Mp4Buffer):
+        return file.unpack(UINT16)[0]
     data = file.read(2)
     if (data is None or len(data) <> 2):
         raise EndOfFile()
@@ -44,11 +70,20 @@ def read16(file):
 
 # read8 - Reads 8 bits from MP4 in BigEndian
 def read8(file):
+    if isinstance(file, Mp4Buffer):
+        return file.unpack(UINT8)[0]
     data = file.read(1)
     if (data is None or len(data) <> 1):
-        raise EndofFile()
+        raise EndOfFile()
     return struct.unpack(">B", data)[0]
 
+# read_array - Reads count BigEndian unsigned ints of width bytes into an array
+def read_array(file, count, width=4):
+    data = file.read(count * width)
+    if (data is None or len(data) <> count * width):
+        raise EndOfFile()
+    return unpack_array(data, width)
+
 # type_to_str - Converts MP4 type to Python string
 def type_to_str(data):
     a = (data >> 0) & 0xff
@@ -57,3 +92,426 @@ def type_to_str(data):
     d = (data >> 24) & 0xff
     return '%c%c%c%c' % (d, c, b, a)
 
+
+### Buffer Handling Helper Functions Below
+
+# Mp4Buffer - File-like object over byte ranges of an MP4 held in memory
+#             Reads return zero-copy buffer slices of the ranges and the
+#             read helpers above unpack fields straight out of them
+class Mp4Buffer(object):
+    def __init__(self, size, data=None):
+        # len mirrors StringIO so parse_atom can size atoms that run to EOF
+        self.len = size
+        self.segments = []
+        self.current = None
+        self.pos = 0
+        if data is not None:
+            self.add(0, data)
+    
+    def add(self, offset, data):
+        self.segments.append((offset, data))
+        self.current = None
+    
+    def _find(self, offset, size=1):
+        # Ranges rarely overlap, so try the last one used first
+        current = self.current
+        if current is not None and current[0] <= offset and \
+                (offset + size) <= (current[0] + len(current[1])):
+            return current
+        # Find the segment holding offset with the most data after it
+        found = None
+        for start, data in self.segments:
+            if start <= offset < (start + len(data)):
+                if found is None or (start + len(data)) > (found[0] + len(found[1])):
+                    found = (start, data)
+        self.current = found
+        return found
+    
+    def has(self, offset, size):
+        found = self._find(offset, size)
+        return found is not None and (found[0] + len(found[1])) >= (offset + size)
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self.pos = offset
+    
+    def tell(self):
+        return self.pos
+    
+    def read(self, size=-1):
+        found = self._find(self.pos, max(size, 1))
+        if found is None:
+            return ''
+        (start, data) = found
+        begin = self.pos - start
+        end = len(data)
+        if size >= 0:
+            end = min(end, begin + size)
+        self.pos += (end - begin)
+        return buffer(data, begin, end - begin)
+    
+    # Unpacks a struct.Struct at the current position without copying
+    def unpack(self, fmt):
+        found = self._find(self.pos, fmt.size)
+        if found is None or (self.pos + fmt.size) > (found[0] + len(found[1])):
+            raise EndOfFile()
+        values = fmt.unpack_from(found[1], self.pos - found[0])
+        self.pos += fmt.size
+        return values
+    
+
+### Sample Table Helper Functions Below
+
+# array_typecode - Finds the array typecode for unsigned ints of width bytes
+def array_typecode(width):
+    for typecode in ('I', 'L', 'Q'):
+        try:
+            if array.array(typecode).itemsize == width:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+ARRAY_TYPECODES = {4: array_typecode(4), 8: array_typecode(8)}
+STRUCT_CODES = {4: 'I', 8: 'Q'}
+
+# Most table entries handled by a loop between two checkpoint calls
+CHECKPOINT_ENTRIES = 4096
+
+# no_checkpoint - Default checkpoint hook, long table loops call their hook
+#                 with the amount of entries handled since the last call
+def no_checkpoint(entries):
+    pass
+
+# entry_blocks - Splits entries start up to stop into blocks of at most
+#                CHECKPOINT_ENTRIES entries
+def entry_blocks(start, stop):
+    return [(block, min(block + CHECKPOINT_ENTRIES, stop))
+            for block in xrange(start, stop, CHECKPOINT_ENTRIES)]
+
+# unpack_array - Converts BigEndian data into a native typed array
+def unpack_array(data, width=4):
+    if numpy is not None:
+        # Widen to int64 so arithmetic with offsets can never wrap around
+        return numpy.frombuffer(data, dtype='>u%d' % width).astype(numpy.int64)
+    typecode = ARRAY_TYPECODES[width]
+    if typecode is None:
+        return list(struct.unpack('>%d%s' % (len(data) / width,
+                                             STRUCT_CODES[width]), data))
+    values = array.array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+# pack_array - Converts a native typed array back into BigEndian data
+def pack_array(values, width=4):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.astype('>u%d' % width).tostring()
+    if isinstance(values, array.array):
+        if sys.byteorder == 'little':
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        return values.tostring()
+    return struct.pack('>%d%s' % (len(values), STRUCT_CODES[width]), *values)
+
+# SampleTable - Compact table of fixed size entries backed by a typed array
+class SampleTable(object):
+    __slots__ = ('values', 'fields', 'width')
+    
+    def __init__(self, values, fields=1, width=4):
+        self.values = values
+        self.fields = fields
+        self.width = width
+    
+    def __len__(self):
+        return len(self.values) // self.fields
+    
+    def __getitem__(self, index):
+        fields = self.fields
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('SampleTable slices must be contiguous')
+            return SampleTable(self.values[start*fields:stop*fields],
+                               fields, self.width)
+        if index < 0:
+            index += len(self)
+        if fields == 1:
+            return int(self.values[index])
+        return tuple(int(value) for value in
+                     self.values[index*fields:(index+1)*fields])
+    
+    def __setitem__(self, index, entry):
+        if index < 0:
+            index += len(self)
+        if self.fields == 1:
+            self.values[index] = entry
+        else:
+            self.values[index*self.fields:(index+1)*self.fields] = \
+                self._new_values(entry)
+    
+    def __iter__(self):
+        values = self.values
+        if not isinstance(values, list):
+            values = values.tolist()
+        if self.fields == 1:
+            return iter(values)
+        return itertools.izip(*([iter(values)] * self.fields))
+    
+    def _new_values(self, entry):
+        if self.fields == 1:
+            entry = (entry,)
+        if numpy is not None and isinstance(self.values, numpy.ndarray):
+            return numpy.array(entry, dtype=self.values.dtype)
+        if isinstance(self.values, array.array):
+            return array.array(self.values.typecode, entry)
+        return list(entry)
+    
+    def insert(self, index, entry):
+        if index < 0:
+            index += len(self)
+        values = self._new_values(entry)
+        if numpy is not None and isinstance(self.values, numpy.ndarray):
+            self.values = numpy.insert(self.values, index*self.fields, values)
+        else:
+            self.values[index*self.fields:index*self.fields] = values
+    
+    # Adds delta to field of every entry from index start onwards
+    def adjust(self, delta, field=0, start=0, checkpoint=no_checkpoint):
+        values = self.values
+        fields = self.fields
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values[start*fields+field::fields] += delta
+            checkpoint(len(self) - start)
+        else:
+            for block_start, block_stop in entry_blocks(start, len(self)):
+                for index in xrange(block_start*fields+field,
+                                    block_stop*fields, fields):
+                    values[index] += delta
+                checkpoint(block_stop - block_start)
+    
+    def materialize(self, checkpoint=no_checkpoint):
+        return self
+    
+    def copy(self):
+        values = self.values
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = values.copy()
+        elif isinstance(values, array.array):
+            values = array.array(values.typecode, values)
+        else:
+            values = list(values)
+        return SampleTable(values, self.fields, self.width)
+    
+    def tostring(self):
+        return pack_array(self.values, self.width)
+    
+    # Writes the BigEndian table to stream with delta added to field of
+    # every entry, leaving the table itself untouched
+    def write(self, stream, delta=0, field=0, checkpoint=no_checkpoint):
+        table = self
+        if delta:
+            table = self.copy()
+            table.adjust(delta, field, checkpoint=checkpoint)
+        stream.write(table.tostring())
+    
+
+# LazySampleTable - SampleTable that only decodes entries from file on demand
+#                   Overrides, adjustments and blocks are kept by absolute
+#                   entry index so slices can share what was already decoded
+class LazySampleTable(object):
+    # Amount of entries decoded per read when entries are accessed
+    block_entries = 1024
+    __slots__ = ('file', 'offset', 'start', 'count', 'limit', 'fields', 'width',
+                 'head', 'overrides', 'adjustments', 'blocks')
+    
+    def __init__(self, file, offset, count, fields=1, width=4):
+        self.file = file
+        self.offset = offset
+        self.start = 0
+        self.count = count
+        self.limit = count
+        self.fields = fields
+        self.width = width
+        self.head = []
+        self.overrides = {}
+        self.adjustments = []
+        self.blocks = {}
+    
+    def __len__(self):
+        return len(self.head) + self.count
+    
+    # Reads the raw BigEndian source entries from start up to stop
+    def _read(self, start, stop):
+        row_size = self.fields * self.width
+        self.file.seek(self.offset + (start * row_size), os.SEEK_SET)
+        data = self.file.read((stop - start) * row_size)
+        if (data is None or len(data) <> (stop - start) * row_size):
+            raise EndOfFile()
+        return data
+    
+    def _decode(self, start, stop):
+        values = unpack_array(self._read(start, stop), self.width)
+        return SampleTable(values, self.fields, self.width)
+    
+    def _adjust_entry(self, index, entry):
+        for field, start, delta in self.adjustments:
+            if index >= start:
+                entry = self._adjust_row(entry, field, delta)
+        return entry
+    
+    def _source_entry(self, index):
+        if index in self.overrides:
+            return self.overrides[index]
+        block = index // self.block_entries
+        table = self.blocks.get(block)
+        if table is None:
+            start = block * self.block_entries
+            stop = min(start + self.block_entries, self.limit)
+            table = self._decode(start, stop)
+            self.blocks[block] = table
+        entry = table[index - (block * self.block_entries)]
+        return self._adjust_entry(index, entry)
+    
+    def __getitem__(self, index):
+        heads = len(self.head)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('SampleTable slices must be contiguous')
+            table = LazySampleTable(self.file, self.offset, 0,
+                                    self.fields, self.width)
+            table.limit = self.limit
+            table.blocks = self.blocks
+            table.overrides = self.overrides
+            table.adjustments = list(self.adjustments)
+            table.head = self.head[start:stop]
+            source_start = min(max(start - heads, 0), self.count)
+            source_stop = min(max(stop - heads, 0), self.count)
+            table.start = self.start + source_start
+            table.count = max(source_stop - source_start, 0)
+            return table
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('SampleTable index out of range')
+        if index < heads:
+            return self.head[index]
+        return self._source_entry(self.start + index - heads)
+    
+    def __setitem__(self, index, entry):
+        heads = len(self.head)
+        if index < 0:
+            index += len(self)
+        if index < heads:
+            self.head[index] = entry
+        else:
+            # Slices share overrides, so copy before the first write
+            self.overrides = dict(self.overrides)
+            self.overrides[self.start + index - heads] = entry
+    
+    def __iter__(self):
+        for entry in self.head:
+            yield entry
+        for index in xrange(self.start, self.start + self.count):
+            yield self._source_entry(index)
+    
+    def insert(self, index, entry):
+        if index < 0:
+            index += len(self)
+        if index > len(self.head):
+            raise IndexError('LazySampleTable can only insert in front')
+        self.head.insert(index, entry)
+    
+    # Slice of the whole table, changes to either never show through the
+    # other and nothing has to be decoded for it
+    def copy(self):
+        return self[0:len(self)]
+    
+    # Adds delta to field of every entry from index start onwards, source
+    # entries are only adjusted once they are decoded
+    def adjust(self, delta, field=0, start=0, checkpoint=no_checkpoint):
+        heads = len(self.head)
+        for index in xrange(start, heads):
+            self.head[index] = self._adjust_row(self.head[index], field, delta)
+        source_start = self.start + max(start - heads, 0)
+        overrides = {}
+        for index, entry in self.overrides.iteritems():
+            if index >= source_start:
+                entry = self._adjust_row(entry, field, delta)
+            overrides[index] = entry
+        self.overrides = overrides
+        self.adjustments.append((field, source_start, delta))
+    
+    def _adjust_row(self, entry, field, delta):
+        if self.fields == 1:
+            return entry + delta
+        return entry[:field] + (entry[field] + delta,) + entry[field+1:]
+    
+    # Decodes the whole table into an in-memory SampleTable
+    def materialize(self, checkpoint=no_checkpoint):
+        table = self._decode(self.start, self.start + self.count)
+        checkpoint(self.count)
+        for field, start, delta in self.adjustments:
+            if start < self.start + self.count:
+                table.adjust(delta, field, max(start - self.start, 0),
+                             checkpoint)
+        for index, entry in self.overrides.iteritems():
+            if self.start <= index < self.start + self.count:
+                table[index - self.start] = entry
+        for index, entry in enumerate(self.head):
+            table.insert(index, entry)
+        return table
+    
+    def tostring(self):
+        return self.materialize().tostring()
+    
+    def _pack_row(self, entry):
+        if self.fields == 1:
+            entry = (entry,)
+        return pack_array(list(entry), self.width)
+    
+    # Writes the BigEndian table to stream with delta added to field of
+    # every entry. Source entries are split into runs at every adjustment
+    # and override, runs that end up unchanged are copied over as they are
+    # and the others are converted in a single pass, one block at a time
+    def write(self, stream, delta=0, field=0, checkpoint=no_checkpoint):
+        for entry in self.head:
+            stream.write(self._pack_row(self._adjust_row(entry, field, delta)))
+        stop = self.start + self.count
+        bounds = set([self.start, stop])
+        for adjust_field, adjust_start, adjust_delta in self.adjustments:
+            if self.start < adjust_start < stop:
+                bounds.add(adjust_start)
+        for index in self.overrides:
+            if self.start <= index < stop:
+                bounds.add(index)
+                bounds.add(index + 1)
+        bounds = sorted(bounds)
+        for run_start, run_stop in zip(bounds, bounds[1:]):
+            if run_start in self.overrides:
+                entry = self.overrides[run_start]
+                stream.write(self._pack_row(self._adjust_row(entry, field,
+                                                             delta)))
+                continue
+            deltas = [0] * self.fields
+            deltas[field] += delta
+            for adjust_field, adjust_start, adjust_delta in self.adjustments:
+                if adjust_start <= run_start:
+                    deltas[adjust_field] += adjust_delta
+            for block_start, block_stop in entry_blocks(run_start, run_stop):
+                data = self._read(block_start, block_stop)
+                if any(deltas):
+                    table = SampleTable(unpack_array(data, self.width),
+                                        self.fields, self.width)
+                    for run_field, run_delta in enumerate(deltas):
+                        if run_delta:
+                            table.adjust(run_delta, run_field)
+                    data = table.tostring()
+                stream.write(data)
+                checkpoint(block_stop - block_start)
+    
@@ -8,7 +8,8 @@ StreamAtoms.py - Outlines generic Atom structure to be used for parsing
 import os
 import struct
 
-from Helper import read8, read24, read32, read64, type_to_str, EndOfFile
+from Helper import read8, read24, read32, read64, type_to_str, EndOfFile, \
+                   LazySampleTable, no_checkpoint
 from StreamExceptions import *
 
 # ISO 14996-12 Atoms that are Trees
@@ -19,6 +20,15 @@ ATOM_TREES = [ 'moov', 'trak', 'edts', 'mdia',
                'sinf', 'fiin', 'paen', 'meco'
                ]
 
+# Atom implementations by type, see register_atom
+ATOM_REGISTRY = {}
+
+# Registers cls as the implementation of Atoms of the given type
+def register_atom(type, cls):
+    if len(type) != 4:
+        raise ValueError('Atom types are four characters, got %r' % type)
+    ATOM_REGISTRY[type] = cls
+
 # Parses an Atom Tree
 def parse_atom_tree(mp4, range, start):
     atoms = []
@@ -58,20 +68,21 @@ def parse_atom(mp4, start):
         return None
 
 def create_atom(mp4, offset, size, type, is_64, start):
-    try:
-        return eval("%s(mp4, offset, size, type, is_64, start)" % type)
-    except NameError:
+    cls = ATOM_REGISTRY.get(type)
+    if cls is None:
         if type in ATOM_TREES:
-            return StreamAtomTree(mp4, offset, size, type, is_64, start)
+            cls = StreamAtomTree
         else:
-            return StreamAtom(mp4, offset, size, type, is_64, start)
-    except TypeError:
-        return StreamAtom(mp4, offset, size, type, is_64, start)
+            cls = StreamAtom
+    return cls(mp4, offset, size, type, is_64, start)
 
 # Generic StreamAtom Object - Equivalent to Box in ISO specs
+#                             Atoms are slotted, every subclass declares the
+#                             attributes it sets in its own __slots__
 class StreamAtom(object):
-    # Copy verifies if parsed Atom should be copied into Stream
-    copy = False
+    # copy verifies if parsed Atom should be copied into Stream
+    __slots__ = ('file', 'offset', 'size', 'type', 'is_64', 'start',
+                 'parent', 'copy')
     
     def __init__(self, file, offset, size, type, is_64, start):
         self.file = file
@@ -80,22 +91,23 @@ class StreamAtom(object):
         self.type = type
         self.is_64 = is_64
         self.start = start
-        self.children = []
-        self.attrs = {}
+        self.parent = None
+        self.copy = False
     
     def _set_attr(self, key, value):
-        self.attrs[key] = value
-    
-    def _set_children(self, children):
-        for child in children:
-            child.parent = self
-        self.children = children
+        setattr(self, key, value)
     
     def get_attribute(self, key):
-        return self.attrs[key]
+        return getattr(self, key)
     
     def get_atoms(self):
-        return self.children
+        return ()
+    
+    # Decode any lazily parsed table held by the StreamAtom
+    def materialize(self, checkpoint=no_checkpoint):
+        entries = getattr(self, 'entries', None)
+        if isinstance(entries, LazySampleTable):
+            self._set_attr('entries', entries.materialize(checkpoint))
     
     # Prepare StreamAtom to be pushed into a stream
     def update(self, data={}):
@@ -108,20 +120,59 @@ class StreamAtom(object):
 
 # Generic StreamFullAtom - Equivalent to FullBox in ISO specs
 class StreamFullAtom(StreamAtom):
+    __slots__ = ('version', 'bit')
+    
     def  __init__(self, file, offset, size, type, is_64, start):
         StreamAtom.__init__(self, file, offset, size, type, is_64, start)
         self.version = read8(file)
         self.bit = read24(file)
     
+    # Records the rest of the Atom as a table of count entries, entries are
+    # only decoded once they are accessed or the table is materialized
+    def _read_table(self, count, fields=1, width=4):
+        table_offset = self.file.tell()
+        remaining = self.offset + self.size - table_offset
+        if remaining != (count * fields * width):
+            raise MalformedMP4()
+        if remaining:
+            # Verify the whole table is actually available, asking files
+            # that know without reading the last byte of it
+            last = self.offset + self.size - 1
+            if hasattr(self.file, 'has'):
+                if not self.file.has(last, 1):
+                    raise EndOfFile()
+            else:
+                self.file.seek(last, os.SEEK_SET)
+                if len(self.file.read(1)) != 1:
+                    raise EndOfFile()
+        return LazySampleTable(self.file, table_offset, count, fields, width)
+    
 
 # Generic StreamAtomTree - Represents a Tree of Atoms
 class StreamAtomTree(StreamAtom):
+    __slots__ = ('children',)
+    # Order in which child Atoms are updated and streamed, defaults to the
+    # order they were parsed in
+    update_order = ()
+    stream_order = ()
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtom.__init__(self, file, offset, size, type, is_64, start)
         children = parse_atom_tree(file, offset+size, start)
         self._set_children(children)
-        self.update_order = []
-        self.stream_order = []
+    
+    def _set_children(self, children):
+        for child in children:
+            child.parent = self
+        self.children = children
+    
+    def get_atoms(self):
+        return self.children
+    
+    def materialize(self, checkpoint=no_checkpoint):
+        StreamAtom.materialize(self, checkpoint)
+        for atom in self.get_atoms():
+            atom.materialize(checkpoint)
     
     def update(self, data={}):
         if self.copy:
@@ -164,5 +215,23 @@ class StreamAtomTree(StreamAtom):
                         atom.pushToStream(stream, data)
     
 
-# Import specific Mp4Atoms
+# Generic StreamVerbatimAtom - Atom that is copied into Stream as is, only its
+#                              position is kept
+class StreamVerbatimAtom(StreamAtom):
+    __slots__ = ()
+    
+    def __init__(self, file, offset, size, type, is_64, start):
+        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
+        self.copy = True
+    
+    def update(self, data={}):
+        # No modifications needed
+        return
+    
+    def pushToStream(self, stream, data={}):
+        self.file.seek(self.offset, os.SEEK_SET)
+        stream.write(self.file.read(self.size))
+    
+
+# Import specific Mp4Atoms, which registers them
 from StreamMp4Atoms import *
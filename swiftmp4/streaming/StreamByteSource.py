@@ -0,0 +1,139 @@
+"""
+@project MP4 Stream
+@author Young Kim (shadowing71@gmail.com)
+
+StreamByteSource.py - Random access sources of MP4 bytes, read by offset
+                      instead of through a file position, and a file-like
+                      adapter so they can be handed to the parser
+"""
+import os
+from collections import OrderedDict
+
+# ByteSource - Random access bytes of an MP4 of a known size
+#              read(offset, size) returns the bytes from offset on, only
+#              fewer than size when they run past the end of the source
+class ByteSource(object):
+    size = 0
+    
+    def read(self, offset, size):
+        raise NotImplementedError()
+    
+
+# FileByteSource - ByteSource over a local file
+class FileByteSource(ByteSource):
+    def __init__(self, file):
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+    
+    def read(self, offset, size):
+        self.file.seek(offset, os.SEEK_SET)
+        return self.file.read(max(min(size, self.size - offset), 0))
+    
+
+# BufferByteSource - ByteSource over bytes held in memory, i.e. a mmap
+class BufferByteSource(ByteSource):
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+    
+    def read(self, offset, size):
+        return self.data[offset:offset + max(size, 0)]
+    
+
+# CachedByteSource - Keeps the most recently read blocks of another source
+#                    Reads are rounded out to whole blocks and every run of
+#                    consecutive missing blocks is read from the source at
+#                    once, so small neighbouring reads cost a single one
+class CachedByteSource(ByteSource):
+    def __init__(self, source, block_size=65536, max_blocks=256):
+        self.source = source
+        self.size = source.size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+    
+    # Adds data read elsewhere at offset, only whole blocks are kept
+    def add(self, offset, data):
+        first = (offset + self.block_size - 1) // self.block_size
+        while True:
+            begin = first * self.block_size - offset
+            end = begin + self.block_size
+            if begin >= len(data) or (end > len(data) and
+                                      offset + len(data) < self.size):
+                break
+            self._store(first, data[begin:end])
+            first += 1
+    
+    def _store(self, block, data):
+        self.blocks.pop(block, None)
+        self.blocks[block] = data
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+    
+    def _fetch(self, first, last):
+        # Reads the blocks first up to and including last from the source
+        offset = first * self.block_size
+        data = self.source.read(offset, (last - first + 1) * self.block_size)
+        for block in xrange(first, last + 1):
+            begin = (block - first) * self.block_size
+            self._store(block, data[begin:begin + self.block_size])
+    
+    def read(self, offset, size):
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return ''
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        if (last - first + 1) > self.max_blocks:
+            # Would evict itself, so don't cache it at all
+            return self.source.read(offset, size)
+        
+        # Mark the cached blocks as used so reading the others keeps them
+        missing = None
+        for block in xrange(first, last + 1):
+            if block in self.blocks:
+                self._store(block, self.blocks[block])
+                if missing is not None:
+                    self._fetch(missing, block - 1)
+                    missing = None
+            elif missing is None:
+                missing = block
+        if missing is not None:
+            self._fetch(missing, last)
+        
+        data = ''.join([self.blocks[block] for block in xrange(first, last + 1)])
+        begin = offset - (first * self.block_size)
+        return data[begin:begin + size]
+    
+
+# ByteSourceFile - Seekable file-like view of a ByteSource for the parser
+class ByteSourceFile(object):
+    def __init__(self, source):
+        self.source = source
+        # len mirrors StringIO so parse_atom can size atoms that run to EOF
+        self.len = source.size
+        self.pos = 0
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self.pos = offset
+    
+    def tell(self):
+        return self.pos
+    
+    # Every byte up to the size of the source can be read, so this never
+    # has to read anything
+    def has(self, offset, size):
+        return offset >= 0 and (offset + size) <= self.len
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = self.len - self.pos
+        data = self.source.read(self.pos, size)
+        self.pos += len(data)
+        return data
+    
+
@@ -21,6 +21,11 @@ class StartOutOfRange(Exception):
         Exception.__init__(self)
     
 
+class EndOutOfRange(Exception):
+    def __init_(self):
+        Exception.__init__(self)
+    
+
 class MalformedMP4(Exception):
     def __init_(self):
         Exception.__init__(self)
@@ -6,18 +6,96 @@ StreamMp4.py - Represents a StreamMp4 that is a Pseudo-stream equivalent
 """
 
 import os
+import mmap
+import cStringIO
+from Helper import Mp4Buffer, no_checkpoint
 from StreamAtoms import StreamAtomTree
 
+# _end_time - Converts an optional end in seconds to milliseconds
+def _end_time(end):
+    if end is None or end == '':
+        return None
+    return int(float(end) * 1000)
+
+# Amount of mdat data copied at a time when the kernel can't copy it
+COPY_CHUNK_SIZE = 1048576
+# Amount of mdat data handed to a single sendfile call
+SENDFILE_CHUNK_SIZE = 0x40000000
+
+# _load_sendfile - Looks up sendfile(2) with a 64 bit offset in the C
+#                  library, Python 2 has no os.sendfile. Returns None where
+#                  there is none, the sendfile of other platforms than Linux
+#                  takes different arguments.
+def _load_sendfile():
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    def call(destination_fd, source_fd, offset, size):
+        position = ctypes.c_int64(offset)
+        return sendfile(destination_fd, source_fd, ctypes.byref(position),
+                        size)
+    
+    return call
+
+_sendfile = _load_sendfile()
+
+# _kernel_copy - Copies size bytes at offset of source_fd to the position of
+#                destination_fd with sendfile, without passing them through
+#                userspace. Returns the amount copied, which falls short of
+#                size when the platform or the files don't allow it.
+def _kernel_copy(source_fd, destination_fd, offset, size):
+    copied = 0
+    if _sendfile is None:
+        return copied
+    while copied < size:
+        count = _sendfile(destination_fd, source_fd, offset + copied,
+                          min(size - copied, SENDFILE_CHUNK_SIZE))
+        if count <= 0:
+            break
+        copied += count
+    return copied
+
+# copy_range - Copies size bytes at offset of source to destination, through
+#              the kernel if possible and in bounded chunks otherwise
+def copy_range(source, destination, offset, size):
+    destination.flush()
+    copied = _kernel_copy(source.fileno(), destination.fileno(), offset, size)
+    destination.seek(0, os.SEEK_END)
+    source.seek(offset + copied, os.SEEK_SET)
+    while copied < size:
+        data = source.read(min(COPY_CHUNK_SIZE, size - copied))
+        if not data:
+            break
+        destination.write(data)
+        copied += len(data)
+
 # StreamMp4 - Used to stream a static MP4 file
 class StreamMp4(object):
     atoms = None
     data = None
+    end = None
+    # Keyframe snapping of start, None, 'previous' or 'nearest'
+    snap = None
+    # Hook called by long table loops, i.e. to yield to other work
+    checkpoint = None
     
-    def __init__(self, source, destination, start):
+    def __init__(self, source, destination, start, lazy=False,
+                 buffered=False, end=None, snap=None):
         self.source = source
         self.source_file = open(self.source, "rb")
         self.destination = destination
         self.start = int(float(start) * 1000)
+        self.end = _end_time(end)
+        self.snap = snap
+        self.lazy = lazy
+        self.buffered = buffered
     
     # pushToStream - Converts source file for pseudo-streaming
     def pushToStream(self):
@@ -30,25 +108,118 @@ class StreamMp4(object):
     
     def _parseMp4(self):
         source_size = os.path.getsize(self.source)
-        self.atoms = StreamAtomTree(self.source_file, 0, source_size, 
+        parse_file = self.source_file
+        if self.buffered and source_size:
+            # Parse straight out of a memory map of the source
+            source_map = mmap.mmap(self.source_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            parse_file = Mp4Buffer(source_size, source_map)
+        self.atoms = StreamAtomTree(parse_file, 0, source_size, 
                                     '', False, self.start)
+        if not self.lazy:
+            # Decode every sample table up front
+            self.atoms.materialize(self._getCheckpoint())
     
     def _updateAtoms(self):
-        self.data = {'CHUNK_OFFSET' : 0}
-        for atom in self.atoms.get_atoms():
-            if atom.copy:
-                atom.update(self.data)
-    
-    def _writeToStream(self):
-        file = open(self.destination, "w")
+        if self.snap:
+            self.start = self._snapStart(self.start)
+        self.data = {'CHUNK_OFFSET' : 0, 'START' : self.start,
+                     'END' : self.end, 'CHECKPOINT' : self._getCheckpoint()}
+        # moov has to be updated before mdat, even if it is stored after it
         for type in ["ftyp", "moov", "mdat"]:
             for atom in self.atoms.get_atoms():
                 if atom.copy and atom.type == type:
-                    atom.pushToStream(file, self.data)
-                    if atom.type == "mdat":
-                        self.source_file.seek(atom.stream_offset, os.SEEK_SET)
-                        file.write(self.source_file.read(atom.stream_size))
-        file.close()
+                    atom.update(self.data)
+    
+    # Metadata is serialized in memory and written at once, the mdat data is
+    # copied behind it straight from the source
+    def _writeToStream(self):
+        file = open(self.destination, "wb")
+        try:
+            header = cStringIO.StringIO()
+            for type in ["ftyp", "moov", "mdat"]:
+                for atom in self.atoms.get_atoms():
+                    if atom.copy and atom.type == type:
+                        atom.pushToStream(header, self.data)
+                        if atom.type == "mdat":
+                            file.write(header.getvalue())
+                            header = cStringIO.StringIO()
+                            copy_range(self.source_file, file,
+                                       atom.stream_offset, atom.stream_size)
+            file.write(header.getvalue())
+        finally:
+            file.close()
+    
+    def _getCheckpoint(self):
+        if self.checkpoint is None:
+            return no_checkpoint
+        return self.checkpoint
+    
+    # Returns the stbl atoms of every trak in order
+    def _getSampleTables(self):
+        tables = []
+        for atom in self.atoms.get_atoms():
+            if atom.type == 'moov':
+                for trak in atom.get_atoms():
+                    for mdia in trak.get_atoms():
+                        for minf in mdia.get_atoms():
+                            for stbl in minf.get_atoms():
+                                if stbl.type == 'stbl':
+                                    tables.append(stbl)
+        return tables
+    
+    # Moves start onto a keyframe of the first trak with a sync sample
+    # table, the other traks are cut at the same time. Returns the canonical
+    # start in milliseconds, the first one that lands on the keyframe
+    def _snapStart(self, start):
+        for stbl in self._getSampleTables():
+            seek_index = stbl.getSeekIndex()
+            checkpoint = self._getCheckpoint()
+            mdhd = None
+            for atom in stbl.parent.parent.get_atoms():
+                if atom.type == 'mdhd':
+                    mdhd = atom
+            if mdhd is None:
+                continue
+            timescale = mdhd.get_attribute('timescale')
+            stream_time = start * timescale / 1000
+            found = seek_index.timeToSample(stream_time, checkpoint)
+            if found is None:
+                return start
+            keyframes = seek_index.keyframesAround(found[1], checkpoint)
+            if keyframes is None:
+                continue
+            (previous, following) = keyframes
+            keyframe = previous
+            if following is not None and previous is None:
+                keyframe = following
+            elif following is not None and self.snap == 'nearest':
+                following_time = seek_index.sampleToTime(following,
+                                                         checkpoint)
+                previous_time = seek_index.sampleToTime(previous, checkpoint)
+                # Never snap onto or past the end, the previous keyframe
+                # still plays up to it
+                if following_time - stream_time < \
+                        stream_time - previous_time and \
+                        (self.end is None or
+                         (following_time * 1000 + timescale - 1) /
+                         timescale < self.end):
+                    keyframe = following
+            if keyframe is None:
+                return start
+            keyframe_time = seek_index.sampleToTime(keyframe, checkpoint)
+            return (keyframe_time * 1000 + timescale - 1) / timescale
+        return start
+    
+    # Builds the complete seek index of every trak, i.e. to cache them
+    def _buildSeekIndexes(self):
+        return [stbl.getSeekIndex().build(self._getCheckpoint())
+                for stbl in self._getSampleTables()]
+    
+    # Reuses previously built seek indexes
+    def _setSeekIndexes(self, seek_indexes):
+        for stbl, seek_index in zip(self._getSampleTables(), seek_indexes):
+            stbl.setSeekIndex(seek_index)
     
     # getAtoms - Used primarily for debugging purposes
     def getAtoms(self):
@@ -59,44 +230,90 @@ class MalformedMP4(Exception):
     pass
 
 
+# SwiftMp4Buffer - Preallocated buffer of the exact size of the metadata,
+#                  every write is copied into place
 class SwiftMp4Buffer(object):
-    def __init__(self):
-        self.buf = []
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.pos = 0
     
     def write(self, bytes):
-        self.buf.append(bytes)
-    
-    def __iter__(self):
-        self.queue = iter(list(self.buf))
-        self.buf = []
-        return self
+        end = self.pos + len(bytes)
+        if end > len(self.buf):
+            raise MalformedMP4()
+        self.buf[self.pos:end] = bytes
+        self.pos = end
     
-    def next(self):
-        return self.queue.next()
+    # Read-only view of the buffer, slicing it is the only copy ever made
+    def getvalue(self):
+        if self.pos <> len(self.buf):
+            # Atom sizes did not match what was written
+            raise MalformedMP4()
+        return buffer(self.buf)
     
 
+# SwiftMp4Segments - Sparse Mp4Buffer over the byte ranges of an object
+#                    that were fetched from Swift
+class SwiftMp4Segments(Mp4Buffer):
+    pass
+
+
 # SwiftStreamMp4 - Adapted version of StreamMp4 for Swift
 class SwiftStreamMp4(StreamMp4):
-    def __init__(self, source_file, source_size, start):
+    stream_header = None
+    
+    def __init__(self, source_file, source_size, start, lazy=True, end=None,
+                 snap=None, checkpoint=None):
         self.source = None
         self.destination = None
         self.source_file = source_file
         self.source_size = source_size
         self.start = int(float(start) * 1000)
+        self.end = _end_time(end)
+        self.snap = snap
+        self.lazy = lazy
+        self.checkpoint = checkpoint
     
     def _parseMp4(self):
         self.atoms = StreamAtomTree(self.source_file, 0, self.source_size,
                                     '', False, self.start)
+        if not self.lazy:
+            self.atoms.materialize(self._getCheckpoint())
+    
+    # Size of everything streamed ahead of the mdat data, only valid after
+    # _updateAtoms as it relies on the updated atom sizes
+    def _getMetadataSize(self):
+        size = 0
+        for atom in self.atoms.get_atoms():
+            if atom.copy and atom.type in ("ftyp", "moov"):
+                size += atom.size
+            elif atom.copy and atom.type == "mdat":
+                size += atom.size - atom.stream_size
+        return size
+    
+    # Size of the whole stream, metadata followed by the mdat data
+    def _getStreamSize(self):
+        size = self._getMetadataSize()
+        for atom in self.atoms.get_atoms():
+            if atom.copy and atom.type == "mdat":
+                size += atom.stream_size
+        return size
+    
+    # Serialized metadata as a buffer, kept so it's only serialized once
+    def _getStreamHeader(self):
+        if self.stream_header is None:
+            for header in self._yieldMetadataToStream():
+                self.stream_header = header
+        return self.stream_header
     
     def _yieldMetadataToStream(self):
-        self.destination = SwiftMp4Buffer()
         if self._verifyMetadata():
+            self.destination = SwiftMp4Buffer(self._getMetadataSize())
             for type in ["ftyp", "moov", "mdat"]:
                 for atom in self.atoms.get_atoms():
                     if atom.copy and atom.type == type:
                         atom.pushToStream(self.destination, self.data)
-                        for chunk in self.destination:
-                            yield chunk
+            yield self.destination.getvalue()
         else:
             # The correct thing to do is to adjust the amount of bytes
             # to be requested to parse the metadata
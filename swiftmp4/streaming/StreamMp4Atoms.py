@@ -34,20 +34,23 @@ StreamMp4Atoms.py - Outlines specific Atom implementations for parsing and
 import os
 
 from Helper import *
-from StreamAtoms import StreamAtom, StreamFullAtom, StreamAtomTree
+from StreamAtoms import StreamAtom, StreamFullAtom, StreamAtomTree, \
+                        StreamVerbatimAtom, register_atom
 from StreamExceptions import *
+from StreamSeekIndex import SeekIndex, columns, search
 
 ## Additional classes to keep track of trak metadata
 class TrakData(object):
     # Define necessary objects in Trak
-    timescale = None
-    chunks = None
-    chunk_samples = None
-    chunk_samples_size = None
-    start_chunk = None
-    start_sample = None
-    start_offset = None
-        
+    __slots__ = ('timescale', 'chunks', 'chunk_samples', 'chunk_samples_size',
+                 'start_chunk', 'start_sample', 'start_offset', 'seek_index',
+                 'end_sample', 'end_chunk', 'end_chunk_samples',
+                 'end_chunk_samples_size', 'end_offset')
+    
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+    
     def setTimescale(self, timescale):
         self.timescale = timescale
     
@@ -90,29 +93,61 @@ class TrakData(object):
     def getStartOffset(self):
         return self.start_offset
     
+    def setSeekIndex(self, seek_index):
+        self.seek_index = seek_index
+    
+    def getSeekIndex(self):
+        return self.seek_index
+    
+    # End data is only set when the trak is clipped at an end time
+    def setEndSample(self, end_sample):
+        self.end_sample = end_sample
+    
+    def getEndSample(self):
+        return self.end_sample
+    
+    def setEndChunk(self, end_chunk):
+        self.end_chunk = end_chunk
+    
+    def getEndChunk(self):
+        return self.end_chunk
+    
+    def setEndChunkSamples(self, end_chunk_samples):
+        self.end_chunk_samples = end_chunk_samples
+    
+    def getEndChunkSamples(self):
+        return self.end_chunk_samples
+    
+    def setEndChunkSampleSize(self, end_chunk_sample_size):
+        self.end_chunk_samples_size = end_chunk_sample_size
+    
+    def getEndChunkSampleSize(self):
+        return self.end_chunk_samples_size
+    
+    def setEndOffset(self, end_offset):
+        self.end_offset = end_offset
+    
+    def getEndOffset(self):
+        return self.end_offset
+    
 
 
 ### ftyp
-class ftyp(StreamAtom):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
+class ftyp(StreamVerbatimAtom):
+    __slots__ = ()
     
     def update(self, data={}):
         data['CHUNK_OFFSET'] += self.size
     
-    def pushToStream(self, stream, data={}):
-        # ftyp is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
-    
 
 ### moov
 class moov(StreamAtomTree):
+    __slots__ = ()
+    update_order = ("cmov", "mvhd", "trak", "tkhd")
+    stream_order = ("cmov", "mvhd", "trak", "tkhd")
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.update_order = ["cmov", "mvhd", "trak", "tkhd"]
-        self.stream_order = ["cmov", "mvhd", "trak", "tkhd"]
         self.copy = True
     
     def update(self, data={}):
@@ -128,12 +163,16 @@ class moov(StreamAtomTree):
 
 ### cmov
 class cmov(StreamAtom):
+    __slots__ = ()
+    
     def __init__(self, file, offset, size, type, is_64, start):
         raise AtomNotSupported()
     
 
 ### mvhd
 class mvhd(StreamFullAtom):
+    __slots__ = ('timescale', 'duration')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         
@@ -162,7 +201,11 @@ class mvhd(StreamFullAtom):
         # mvhd only needs its duration updated
         duration = self.get_attribute('duration')
         timescale = self.get_attribute('timescale')
-        stream_duration = duration - (int(self.start) * timescale / 1000)
+        if data.get('END') is not None:
+            if data['END'] <= data['START']:
+                raise EndOutOfRange()
+            duration = min(duration, data['END'] * timescale / 1000)
+        stream_duration = duration - (data['START'] * timescale / 1000)
         self._set_attr('duration', stream_duration)
     
     def pushToStream(self, stream, data={}):
@@ -191,10 +234,12 @@ class mvhd(StreamFullAtom):
 
 ### trak
 class trak(StreamAtomTree):
+    __slots__ = ()
+    update_order = ("tkhd", "mdia")
+    stream_order = ("tkhd", "mdia")
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.update_order = ["tkhd", "mdia"]
-        self.stream_order = ["tkhd", "mdia"]
         self.copy = True
     
     def update(self, data={}):
@@ -205,10 +250,23 @@ class trak(StreamAtomTree):
             data['TRAK_START_OFFSET'] = data['TRAK_DATA'].getStartOffset()
         else:
             data['TRAK_START_OFFSET'] = min(data['TRAK_START_OFFSET'], data['TRAK_DATA'].getStartOffset())
+        
+        # A trak without end offset runs up to the end of mdat
+        if data.get('END') is not None:
+            end_offset = data['TRAK_DATA'].getEndOffset()
+            if 'TRAK_END_OFFSET' not in data:
+                data['TRAK_END_OFFSET'] = end_offset
+            elif data['TRAK_END_OFFSET'] is not None:
+                if end_offset is None:
+                    data['TRAK_END_OFFSET'] = None
+                else:
+                    data['TRAK_END_OFFSET'] = max(data['TRAK_END_OFFSET'], end_offset)
     
 
 ### tkhd
 class tkhd(StreamFullAtom):
+    __slots__ = ('duration',)
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         
@@ -224,7 +282,9 @@ class tkhd(StreamFullAtom):
     def update(self, data={}):
         # tkhd only needs its duration updated
         duration = self.get_attribute('duration')
-        stream_duration = duration - (int(self.start) * data['MP4_TIMESCALE'] / 1000)
+        if data.get('END') is not None:
+            duration = min(duration, data['END'] * data['MP4_TIMESCALE'] / 1000)
+        stream_duration = duration - (data['START'] * data['MP4_TIMESCALE'] / 1000)
         self._set_attr('duration', stream_duration)
     
     def pushToStream(self, stream, data={}):
@@ -253,15 +313,19 @@ class tkhd(StreamFullAtom):
 
 ### mdia
 class mdia(StreamAtomTree):
+    __slots__ = ()
+    update_order = ("mdhd", "hdlr", "minf")
+    stream_order = ("mdhd", "hdlr", "minf")
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.update_order = ["mdhd", "hdlr", "minf"]
-        self.stream_order = ["mdhd", "hdlr", "minf"]
         self.copy = True
     
 
 ### mdhd
 class mdhd(StreamFullAtom):
+    __slots__ = ('timescale', 'duration')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
@@ -284,7 +348,9 @@ class mdhd(StreamFullAtom):
         # mdhd only needs its duration updated
         duration = self.get_attribute('duration')
         timescale = self.get_attribute('timescale')
-        stream_duration = duration - (int(self.start) * timescale / 1000)
+        if data.get('END') is not None:
+            duration = min(duration, data['END'] * timescale / 1000)
+        stream_duration = duration - (data['START'] * timescale / 1000)
         self._set_attr('duration', stream_duration)
     
     def pushToStream(self, stream, data={}):
@@ -312,162 +378,129 @@ class mdhd(StreamFullAtom):
     
 
 ### hdlr
-class hdlr(StreamAtom):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
-    
-    def update(self, data={}):
-        # No modifications needed for hdlr
-        return
-    
-    def pushToStream(self, stream, data={}):
-        # hdlr is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
+class hdlr(StreamVerbatimAtom):
+    # hdlr is just copied over
+    __slots__ = ()
     
 
 ### minf
 class minf(StreamAtomTree):
+    __slots__ = ()
+    update_order = ("vmhd", "smhd", "dinf", "stbl")
+    stream_order = ("vmhd", "smhd", "dinf", "stbl")
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.update_order = ["vmhd", "smhd", "dinf", "stbl"]
-        self.stream_order = ["vmhd", "smhd", "dinf", "stbl"]
         self.copy = True
     
 
 ### vmhd
-class vmhd(StreamAtom):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
-    
-    def update(self, data={}):
-        # No modifications needed for vmhd
-        return
-    
-    def pushToStream(self, stream, data={}):
-        # vmhd is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
+class vmhd(StreamVerbatimAtom):
+    # vmhd is just copied over
+    __slots__ = ()
     
 
 ### smhd
-class smhd(StreamAtom):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
-    
-    def update(self, data={}):
-        # No modifications needed for smhd
-        return
-    
-    def pushToStream(self, stream, data={}):
-        # smhd is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
+class smhd(StreamVerbatimAtom):
+    # smhd is just copied over
+    __slots__ = ()
     
 
 ### dinf
-class dinf(StreamAtomTree):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
-    
-    def update(self, data={}):
-        # No modifications needed for dinf
-        return
-    
-    def pushToStream(self, stream, data={}):
-        # vmhd is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
+class dinf(StreamVerbatimAtom):
+    # dinf is just copied over, its children are never looked at
+    __slots__ = ()
     
 
 ### stbl
 class stbl(StreamAtomTree):
+    __slots__ = ('seek_index',)
+    update_order = ("stsd", "stts", "stss", "ctts", "stsc", "stsz", "stco", "co64")
+    stream_order = ("stsd", "stts", "stss", "ctts", "stsc", "stsz", "stco", "co64")
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtomTree.__init__(self, file, offset, size, type, is_64, start)
-        self.update_order = ["stsd", "stts", "stss", "ctts", "stsc", "stsz", "stco", "co64"]
-        self.stream_order = ["stsd", "stts", "stss", "ctts", "stsc", "stsz", "stco", "co64"]
+        self.seek_index = None
         self.copy = True
     
+    # Seek index over copies of the untouched tables, unless one was
+    # already provided (i.e. from a cache). It is only decoded as far as
+    # lookups reach, so it must not see the updates of the tables.
+    def getSeekIndex(self):
+        if self.seek_index is None:
+            tables = {}
+            for atom in self.get_atoms():
+                if atom.type in ('stts', 'stsc', 'stss', 'ctts'):
+                    tables[atom.type] = atom.get_attribute('entries').copy()
+            self.seek_index = SeekIndex(**tables)
+        return self.seek_index
+    
+    def setSeekIndex(self, seek_index):
+        self.seek_index = seek_index
+    
     def update(self, data={}):
         trak = data['TRAK_DATA']
         for atom in self.get_atoms():
             if (atom.type == 'stco') or (atom.type == 'co64'):
                 trak.setChunks(atom.get_attribute('chunk_count'))
+        trak.setSeekIndex(self.getSeekIndex())
         super(stbl, self).update(data)
     
 
 ### stsd
-class stsd(StreamAtom):
-    def __init__(self, file, offset, size, type, is_64, start):
-        StreamAtom.__init__(self, file, offset, size, type, is_64, start)
-        self.copy = True
-    
-    def update(self, data={}):
-        # No modifications needed for stsd
-        return
-    
-    def pushToStream(self, stream, data={}):
-        # stsd is just copied over
-        self.file.seek(self.offset, os.SEEK_SET)
-        stream.write(self.file.read(self.size))
+class stsd(StreamVerbatimAtom):
+    # stsd is just copied over
+    __slots__ = ()
     
 
 ### stts
 class stts(StreamFullAtom):
+    __slots__ = ('entry_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
         
         # Set stts metadata
         self._set_attr('entry_count', read32(self.file))
-        entries = []
-        while self.file.tell() < (offset+size):
-            count = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            duration = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append((count, duration))
-        if self.get_attribute('entry_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('entry_count'), 2)
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         # Derive stream_time from trak data
         trak = data['TRAK_DATA']
         trak_timescale = trak.getTimescale()
-        start_sample = 0
-        stream_time = int(self.start) * trak_timescale / 1000
-        
-        # Parse entries to determine what to truncate
-        valid = False
-        truncate_index = 0
-        entries = self.get_attribute('entries')
-        for index, entry in enumerate(entries):
-            (count, duration) = entry
-            if (stream_time < (count*duration)):
-                start_sample += (stream_time / duration)
-                count -= (stream_time / duration)
-                entries[index] = (count, duration)
-                truncate_index = index
-                valid = True
-                break
-            else:
-                # Update size accordingly
-                self.size -= 8
-                start_sample += count
-                stream_time -= (count*duration)
-                
-        if valid:
-            if truncate_index > 0:
-                entries = entries[truncate_index:]
+        stream_time = data['START'] * trak_timescale / 1000
         
+        # Look up the entry holding stream_time to determine what to truncate
+        found = trak.getSeekIndex().timeToSample(
+            stream_time, data['CHECKPOINT'])
+        if found:
+            (truncate_index, start_sample, skipped) = found
+            entries = self.get_attribute('entries')
+            (count, duration) = entries[truncate_index]
+            self.size -= (8 * truncate_index)
+            entries = entries[truncate_index:]
+            entries[0] = (count - skipped, duration)
+            
+            # Clip the entries after the last sample starting before END
+            if data.get('END') is not None:
+                end_time = data['END'] * trak_timescale / 1000
+                end_found = trak.getSeekIndex().timeToEndSample(
+                    end_time, data['CHECKPOINT'])
+                if end_found:
+                    (end_index, end_sample, kept) = end_found
+                    if end_index == truncate_index:
+                        kept -= skipped
+                    end_index -= truncate_index
+                    self.size -= (8 * (len(entries) - (end_index + 1)))
+                    entries = entries[:end_index + 1]
+                    (count, duration) = entries[end_index]
+                    entries[end_index] = (kept, duration)
+                    
+                    # Set endSample to be used in stss, stsc, ctts, stsz
+                    trak.setEndSample(end_sample)
+            
             # Modify own entries accordingly
             self._set_attr('entry_count', len(entries))
             self._set_attr('entries', entries)
@@ -495,65 +528,52 @@ class stts(StreamFullAtom):
         # Write in stts
         entries = self.get_attribute('entries')
         stream.write(struct.pack(">I", len(entries)))
-        for entry in entries:
-            (count, duration) = entry
-            stream.write(struct.pack(">II", count, duration))
+        entries.write(stream, checkpoint=data['CHECKPOINT'])
     
 
 ### stss
 class stss(StreamFullAtom):
+    __slots__ = ('entry_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
         
         # Set stss metadata
         self._set_attr('entry_count', read32(self.file))
-        entries = []
-        while self.file.tell() < (offset+size):
-            entry = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append(entry)
-        if self.get_attribute('entry_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('entry_count'))
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         # Obtain start_sample from trak data
         trak = data['TRAK_DATA']
         start_sample = trak.getStartSample()
         
-        if start_sample:
-            start_sample += 1
-            
-            # Parse entries to determine what to truncate
-            valid = False
-            truncate_index = 0
+        # Look up the first keyframe at or after start_sample, a start_sample
+        # of 0 keeps every keyframe
+        truncate_index = trak.getSeekIndex().sampleToKeyframe(
+            start_sample + 1, data['CHECKPOINT'])
+        if truncate_index is not None:
             entries = self.get_attribute('entries')
-            for index, entry in enumerate(entries):
-                sample = entry
-                if (sample >= start_sample):
-                    valid = True
-                    truncate_index = index
-                    break
-                else:
-                    self.size -= 4
-                    
-            if valid:
-                start_sample -= 1
-                if truncate_index > 0:
-                    entries = entries[truncate_index:]
-                for index, entry in enumerate(entries):
-                    sample = entry - start_sample
-                    entries[index] = sample
-                self._set_attr('entry_count', len(entries))
-                self._set_attr('entries', entries)                
-            else:
-                raise MalformedMP4()
+            self.size -= (4 * truncate_index)
+            if truncate_index > 0:
+                entries = entries[truncate_index:]
+            if start_sample:
+                entries.adjust(-start_sample, checkpoint=data['CHECKPOINT'])
+            
+            # Drop the keyframes past endSample
+            end_sample = trak.getEndSample()
+            if end_sample is not None:
+                end_index = trak.getSeekIndex().sampleToKeyframe(
+                    end_sample + 1, data['CHECKPOINT'])
+                if end_index is not None:
+                    end_index = max(end_index - truncate_index, 0)
+                    self.size -= (4 * (len(entries) - end_index))
+                    entries = entries[:end_index]
+            self._set_attr('entry_count', len(entries))
+            self._set_attr('entries', entries)                
         else:
-            # Signal that MP4 is being parsed incorrectly
-            raise IncorrectParseMP4()
+            raise MalformedMP4()
     
     def pushToStream(self, stream, data={}):
         # Simply copy over the initial entries in stss
@@ -573,65 +593,57 @@ class stss(StreamFullAtom):
         # Write in stss
         entries = self.get_attribute('entries')
         stream.write(struct.pack(">I", len(entries)))
-        for entry in entries:
-            stream.write(struct.pack(">I", entry))
+        entries.write(stream, checkpoint=data['CHECKPOINT'])
     
 
 ### ctts
 class ctts(StreamFullAtom):
+    __slots__ = ('entry_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
         
         # Set ctts metadat
         self._set_attr('entry_count', read32(self.file))
-        entries = []
-        while self.file.tell() < (offset+size):
-            count = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            soffset = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append((count, soffset))
-        if self.get_attribute('entry_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('entry_count'), 2)
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         # Obtain start_sample from trak data
         trak = data['TRAK_DATA']
         start_sample = trak.getStartSample()
-        if start_sample:
-            start_sample += 1
-            
-            # Parse entries to determine what to truncate
-            valid = False
-            truncate_index = 0
+        # Look up the entry holding start_sample to determine what to truncate
+        found = trak.getSeekIndex().sampleToOffset(
+            start_sample + 1, data['CHECKPOINT'])
+        if found:
+            (truncate_index, start_sample) = found
             entries = self.get_attribute('entries')
-            for index, entry in enumerate(entries):
-                (count, offset) = entry
-                if (start_sample <= count):
-                    count -= (start_sample - 1)
-                    valid = True
-                    entries[index] = (count, offset)
-                    truncate_index = index
-                    break
-                else:
-                    start_sample -= count
-                    self.size -= 8
-            if valid:
-                if truncate_index > 0:
-                    entries = entries[truncate_index:]
-                
-                # Modify own entries accordingly
-                self._set_attr('entry_count', len(entries))
-                self._set_attr('entries', entries)                
-            else:
-                # If it failed, just don't copy it
-                self.copy = False
+            (count, offset) = entries[truncate_index]
+            self.size -= (8 * truncate_index)
+            entries = entries[truncate_index:]
+            entries[0] = (count - (start_sample - 1), offset)
+            
+            # Clip the entries at endSample
+            end_sample = trak.getEndSample()
+            if end_sample is not None:
+                end_found = trak.getSeekIndex().sampleToOffset(
+                    end_sample, data['CHECKPOINT'])
+                if end_found:
+                    (end_index, end_count) = end_found
+                    if end_index == truncate_index:
+                        end_count -= (start_sample - 1)
+                    end_index -= truncate_index
+                    self.size -= (8 * (len(entries) - (end_index + 1)))
+                    entries = entries[:end_index + 1]
+                    (count, offset) = entries[end_index]
+                    entries[end_index] = (end_count, offset)
+            
+            # Modify own entries accordingly
+            self._set_attr('entry_count', len(entries))
+            self._set_attr('entries', entries)                
         else:
+            # If it failed, just don't copy it
             self.copy = False
     
     def pushToStream(self, stream, data={}):
@@ -653,13 +665,13 @@ class ctts(StreamFullAtom):
             # Write in ctts
             entries = self.get_attribute('entries')
             stream.write(struct.pack(">I", len(entries)))
-            for entry in entries:
-                (count, offset) = entry
-                stream.write(struct.pack(">II", count, offset))
+            entries.write(stream, checkpoint=data['CHECKPOINT'])
     
 
 ### stsc
 class stsc(StreamFullAtom):
+    __slots__ = ('entry_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
@@ -671,53 +683,36 @@ class stsc(StreamFullAtom):
         if (self.get_attribute('entry_count') == 0):
             raise MalformedMP4()
             
-        entries = []
-        while self.file.tell() < (offset+size):
-            chunk = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            samples = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            id = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append((chunk, samples, id))
-        if self.get_attribute('entry_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('entry_count'), 3)
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         # Obtain chunk data
         trak = data['TRAK_DATA']
         start_sample = trak.getStartSample()
         
-        # Parse entries to determine what to modify
-        valid = False
-        truncate_index = 1
+        # Look up the run of chunks holding start_sample
         entries = self.get_attribute('entries')
+        (truncate_index, start_sample) = trak.getSeekIndex().sampleToChunk(
+            start_sample, data['CHECKPOINT'])
         
-        # Iterate over chunks
-        (chunk, samples, id) = entries[0]
-        self.size -= 12
+        # Look up the chunk holding the last sample before endSample
+        end_sample = trak.getEndSample()
+        if end_sample is not None:
+            (end_index, end_samples) = trak.getSeekIndex().sampleToChunk(
+                end_sample, data['CHECKPOINT'])
+            (end_chunk, end_run_samples, id) = entries[end_index]
+            if (end_run_samples == 0):
+                raise MalformedMP4()
+            end_chunk = (end_chunk - 1) + (end_samples - 1) / end_run_samples
+            end_chunk_samples = (end_samples - 1) % end_run_samples + 1
+            trak.setEndChunk(end_chunk)
+            trak.setEndChunkSamples(end_chunk_samples)
+        (chunk, samples, id) = entries[truncate_index]
         
-        while (truncate_index < len(entries)):
-            (next_chunk, next_samples, next_id) = entries[truncate_index]
-            n = (next_chunk - chunk) * samples
-            
-            if (start_sample <= n):
-                valid = True
-                break
-                
-            start_sample -= n
-            chunk = next_chunk
-            samples = next_samples
-            id = next_id
-            truncate_index += 1
-            self.size -= 12
-            
-        if not valid:
+        if (truncate_index + 1) < len(entries):
+            next_chunk = entries[truncate_index + 1][0]
+        else:
             next_chunk = trak.getChunks()
             n = (next_chunk - chunk) * samples
             if (start_sample > n):
@@ -728,8 +723,7 @@ class stsc(StreamFullAtom):
             raise MalformedMP4()
             
         # Proceed to truncate rest of entries
-        truncate_index -= 1
-        self.size += 12
+        self.size -= (12 * truncate_index)
         if truncate_index > 0:
             entries = entries[truncate_index:]
         (chunk, samples, id) = entries[0]
@@ -749,11 +743,28 @@ class stsc(StreamFullAtom):
             self.size += 12
             index += 1
             
-        while (index < len(entries)):
-            (chunk, samples, id) = entries[index]
-            chunk -= start_chunk
-            entries[index] = (chunk, samples, id)
-            index += 1
+        entries.adjust(-start_chunk, 0, index, data['CHECKPOINT'])
+        
+        if end_sample is not None:
+            # Drop the runs past the end chunk, the end chunk may only hold
+            # part of its samples and gets an entry of its own then
+            last_chunk = end_chunk - start_chunk + 1
+            last_samples = end_chunk_samples
+            if end_chunk == start_chunk:
+                last_samples -= chunk_samples
+            entries = entries.materialize(data['CHECKPOINT'])
+            last_index = search(columns(entries, data['CHECKPOINT'])[0],
+                                last_chunk, right=True) - 1
+            self.size -= (12 * (len(entries) - (last_index + 1)))
+            entries = entries[:last_index + 1]
+            (chunk, samples, id) = entries[last_index]
+            if samples != last_samples:
+                if chunk == last_chunk:
+                    entries[last_index] = (chunk, last_samples, id)
+                else:
+                    entries.insert(last_index + 1, (last_chunk, last_samples, id))
+                    self.size += 12
+        
         self._set_attr('entry_count', len(entries))
         self._set_attr('entries', entries)
         
@@ -779,13 +790,13 @@ class stsc(StreamFullAtom):
         # Write in stsc
         entries = self.get_attribute('entries')
         stream.write(struct.pack(">I", len(entries)))
-        for entry in entries:
-            (chunk, samples, id) = entry
-            stream.write(struct.pack(">III", chunk, samples, id))
+        entries.write(stream, checkpoint=data['CHECKPOINT'])
     
 
 ### stsz
 class stsz(StreamFullAtom):
+    __slots__ = ('uniform_size', 'entry_count', 'entries', 'uniform')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
@@ -797,25 +808,29 @@ class stsz(StreamFullAtom):
         
         if self.get_attribute('uniform_size') == 0:
             self.uniform = False
-            entries = []
-            while self.file.tell() < (offset+size):
-                entry = read32(self.file)
-                if self.file.tell() > (offset+size):
-                    raise MalformedMP4()
-                entries.append(entry)
-            if self.get_attribute('entry_count') != len(entries):
-                raise MalformedMP4()
-            else:
-                self._set_attr('entries', entries)
+            entries = self._read_table(self.get_attribute('entry_count'))
+            self._set_attr('entries', entries)
     
     def update(self, data={}):
-        # stsz only needs to be updated if it is not uniform
-        if not self.uniform:
-            # Obtain start_sample from trak data
-            trak = data['TRAK_DATA']
-            start_sample = trak.getStartSample()
-            chunk_samples = trak.getChunkSamples()
-            
+        # Obtain start_sample from trak data
+        trak = data['TRAK_DATA']
+        start_sample = trak.getStartSample()
+        chunk_samples = trak.getChunkSamples()
+        
+        if self.uniform:
+            # Uniform stsz has no entries, only its sample count changes
+            if (start_sample > self.get_attribute('entry_count')):
+                raise MalformedMP4()
+            trak.setChunkSampleSize(self.get_attribute('uniform_size') *
+                                    chunk_samples)
+            end_sample = trak.getEndSample()
+            if end_sample is None:
+                end_sample = self.get_attribute('entry_count')
+            else:
+                trak.setEndChunkSampleSize(self.get_attribute('uniform_size') *
+                                           trak.getEndChunkSamples())
+            self._set_attr('entry_count', end_sample - start_sample)
+        else:
             if (start_sample > self.get_attribute('entry_count')):
                 raise MalformedMP4()
                 
@@ -830,7 +845,20 @@ class stsz(StreamFullAtom):
                 chunk_index += 1
             trak.setChunkSampleSize(chunk_sample_size)
             
+            # Determine and set the size used of the end chunk
+            end_sample = trak.getEndSample()
+            if end_sample is not None:
+                end_chunk_sample_size = 0
+                chunk_index = end_sample - trak.getEndChunkSamples()
+                while (chunk_index < end_sample):
+                    end_chunk_sample_size += entries[chunk_index]
+                    chunk_index += 1
+                trak.setEndChunkSampleSize(end_chunk_sample_size)
+            
             # Modify stsz
+            if end_sample is not None:
+                self.size -= (4 * (len(entries) - end_sample))
+                entries = entries[:end_sample]
             if (truncate_index > 0):
                 entries = entries[truncate_index:]
                 self.size -= (4*truncate_index)
@@ -840,46 +868,40 @@ class stsz(StreamFullAtom):
     def pushToStream(self, stream, data={}):
         self.file.seek(self.offset, os.SEEK_SET)
         
-        if self.uniform:
-            # stsz is just copied over
-            stream.write(self.file.read(self.size))
+        # Copy in fullbox
+        if self.is_64:
+            stream.write(self.file.read(8))
+            self.file.seek(8, os.SEEK_CUR)
+            stream.write(struct.pack(">Q", self.size))
         else:
-            # Copy in fullbox
-            if self.is_64:
-                stream.write(self.file.read(8))
-                self.file.seek(8, os.SEEK_CUR)
-                stream.write(struct.pack(">Q", self.size))
-            else:
-                self.file.seek(4, os.SEEK_CUR)
-                stream.write(struct.pack(">I", self.size))
-                stream.write(self.file.read(4))
+            self.file.seek(4, os.SEEK_CUR)
+            stream.write(struct.pack(">I", self.size))
             stream.write(self.file.read(4))
-            
+        stream.write(self.file.read(4))
+        
+        if self.uniform:
+            # Uniform stsz only carries the remaining sample count
+            stream.write(struct.pack(">II", self.get_attribute('uniform_size'),
+                                     self.get_attribute('entry_count')))
+        else:
             # Write in stsz
             entries = self.get_attribute('entries')
             stream.write(struct.pack(">II", 0, len(entries)))
-            for entry in entries:
-                stream.write(struct.pack(">I", entry))
+            entries.write(stream, checkpoint=data['CHECKPOINT'])
     
 
 ### stco
 class stco(StreamFullAtom):
+    __slots__ = ('chunk_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
         
         # Obtain metadata
         self._set_attr('chunk_count', read32(self.file))
-        entries = []
-        while self.file.tell() < (offset+size):
-            chunk_offset = read32(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append(chunk_offset)
-        if self.get_attribute('chunk_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('chunk_count'))
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         trak = data['TRAK_DATA']
@@ -891,6 +913,15 @@ class stco(StreamFullAtom):
             raise MalformedMP4()
         truncate_index = start_chunk
         
+        # Set end offset before entries are modified
+        end_chunk = trak.getEndChunk()
+        if end_chunk is not None:
+            if end_chunk >= len(entries):
+                raise MalformedMP4()
+            trak.setEndOffset(entries[end_chunk] + trak.getEndChunkSampleSize())
+            self.size -= (4 * (len(entries) - (end_chunk + 1)))
+            entries = entries[:end_chunk + 1]
+        
         if truncate_index > 0:
             entries = entries[truncate_index:]
             self.size -= (4 * truncate_index)
@@ -921,28 +952,22 @@ class stco(StreamFullAtom):
         # Write in stco
         entries = self.get_attribute('entries')
         stream.write(struct.pack(">I", len(entries)))
-        for entry in entries:
-            stream.write(struct.pack(">I", entry+data['CHUNK_OFFSET']))
+        entries.write(stream, data['CHUNK_OFFSET'],
+                      checkpoint=data['CHECKPOINT'])
     
 
 ### co64
 class co64(StreamFullAtom):
+    __slots__ = ('chunk_count', 'entries')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamFullAtom.__init__(self, file, offset, size, type, is_64, start)
         self.copy = True
         
         # Obtain metadata
         self._set_attr('chunk_count', read32(self.file))
-        entries = []
-        while self.file.tell() < (offset+size):
-            chunk_offset = read64(self.file)
-            if self.file.tell() > (offset+size):
-                raise MalformedMP4()
-            entries.append(chunk_offset)
-        if self.get_attribute('chunk_count') != len(entries):
-            raise MalformedMP4()
-        else:
-            self._set_attr('entries', entries)
+        entries = self._read_table(self.get_attribute('chunk_count'), 1, 8)
+        self._set_attr('entries', entries)
     
     def update(self, data={}):
         trak = data['TRAK_DATA']
@@ -954,6 +979,15 @@ class co64(StreamFullAtom):
             raise MalformedMP4()
         truncate_index = start_chunk
         
+        # Set end offset before entries are modified
+        end_chunk = trak.getEndChunk()
+        if end_chunk is not None:
+            if end_chunk >= len(entries):
+                raise MalformedMP4()
+            trak.setEndOffset(entries[end_chunk] + trak.getEndChunkSampleSize())
+            self.size -= (8 * (len(entries) - (end_chunk + 1)))
+            entries = entries[:end_chunk + 1]
+        
         if truncate_index > 0:
             entries = entries[truncate_index:]
             self.size -= (8 * truncate_index)
@@ -984,12 +1018,14 @@ class co64(StreamFullAtom):
         # Write in co64
         entries = self.get_attribute('entries')
         stream.write(struct.pack(">I", len(entries)))
-        for entry in entries:
-            stream.write(struct.pack(">Q", entry+data['CHUNK_OFFSET']))
+        entries.write(stream, data['CHUNK_OFFSET'],
+                      checkpoint=data['CHECKPOINT'])
     
 
 ### mdat
 class mdat(StreamAtom):
+    __slots__ = ('file_offset', 'stream_offset', 'stream_size')
+    
     def __init__(self, file, offset, size, type, is_64, start):
         StreamAtom.__init__(self, file, offset, size, type, is_64, start)
         self.file_offset = 0
@@ -1000,7 +1036,10 @@ class mdat(StreamAtom):
         
         # Save file offsets
         self.stream_offset = start_offset
-        self.stream_size = (self.offset + self.size - start_offset)
+        end_offset = data.get('TRAK_END_OFFSET')
+        if end_offset is None:
+            end_offset = self.offset + self.size
+        self.stream_size = (end_offset - start_offset)
         
         # Determine file size
         self.size = self.stream_size
@@ -1019,5 +1058,11 @@ class mdat(StreamAtom):
             stream.write(struct.pack(">I4sQ", 0, self.type, self.size))
         else:
             stream.write(struct.pack(">I4s", self.size, self.type))
-        
     
+
+# Register the specific Mp4Atoms
+for atom in (ftyp, moov, cmov, mvhd, trak, tkhd, mdia, mdhd, hdlr, minf, vmhd,
+             smhd, dinf, stbl, stsd, stts, stss, ctts, stsc, stsz, stco, co64,
+             mdat):
+    register_atom(atom.__name__, atom)
+del atom
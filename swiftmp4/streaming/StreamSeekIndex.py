@@ -0,0 +1,270 @@
+"""
+@project MP4 Stream
+@author Young Kim (shadowing71@gmail.com)
+
+StreamSeekIndex.py - Per trak seek index answering time to sample, sample to
+                     chunk and sample to keyframe lookups with binary search
+"""
+import array
+import bisect
+
+from Helper import numpy, ARRAY_TYPECODES, CHECKPOINT_ENTRIES, \
+                   no_checkpoint, entry_blocks
+
+# columns - Splits a SampleTable into one sequence per field, copied so
+#           that later updates of the table never show through
+def columns(table, checkpoint=no_checkpoint):
+    table = table.materialize(checkpoint)
+    values = table.values
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.reshape(-1, table.fields)
+        return [values[:, field].copy() for field in xrange(table.fields)]
+    return [values[field::table.fields] for field in xrange(table.fields)]
+
+# cumulative - Running totals of values starting out at total, ends[i] is
+#              the sum through values[i]
+def cumulative(values, checkpoint=no_checkpoint, total=0):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        ends = numpy.cumsum(values, dtype=numpy.int64)
+        ends += total
+        checkpoint(len(values))
+        return ends
+    typecode = ARRAY_TYPECODES[8]
+    ends = array.array(typecode) if typecode else []
+    for block_start, block_stop in entry_blocks(0, len(values)):
+        for index in xrange(block_start, block_stop):
+            total += values[index]
+            ends.append(total)
+        checkpoint(block_stop - block_start)
+    return ends
+
+# concatenate - Appends values to the end of part, part may be None
+def concatenate(part, values):
+    if part is None:
+        return values
+    if numpy is not None and isinstance(part, numpy.ndarray):
+        return numpy.concatenate((part, values))
+    part.extend(values)
+    return part
+
+# search - Binary search over a sorted sequence, mirrors bisect semantics
+def search(values, value, right=False):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return int(numpy.searchsorted(values, value,
+                                      side='right' if right else 'left'))
+    if right:
+        return bisect.bisect_right(values, value)
+    return bisect.bisect_left(values, value)
+
+# SeekIndex - Prefix sums over the sample tables of a single trak
+#             Every part is only decoded as far as lookups reach into it, a
+#             block at a time, and only depends on the original tables, so
+#             it can be cached once it is fully built
+class SeekIndex(object):
+    __slots__ = ('stts', 'stsc', 'stss', 'ctts', 'stts_index', 'stsc_index',
+                 'stss_index', 'ctts_index', 'built')
+    
+    def __init__(self, stts=None, stsc=None, stss=None, ctts=None):
+        self.stts = stts
+        self.stsc = stsc
+        self.stss = stss
+        self.ctts = ctts
+        self.stts_index = None
+        self.stsc_index = None
+        self.stss_index = None
+        self.ctts_index = None
+        # Entries of every table that went into its part so far
+        self.built = {}
+    
+    # Builds every part of the index, i.e. before caching it
+    def build(self, checkpoint=no_checkpoint):
+        for name in ('stts', 'stsc', 'stss', 'ctts'):
+            while self._extend(name, checkpoint):
+                pass
+            # The tables keep their parsed atom, and with it the file it
+            # reads from, alive for as long as the index is cached
+            setattr(self, name, None)
+        return self
+    
+    # Entries the part of table name ends up with
+    def _size(self, name):
+        table = getattr(self, name)
+        if name == 'stsc':
+            return max(len(table) - 1, 0)
+        return len(table)
+    
+    # Decodes the next block of table name into its part, every block as
+    # large as everything before it so concatenating stays linear overall.
+    # Returns whether there was anything left to decode.
+    def _extend(self, name, checkpoint=no_checkpoint):
+        if getattr(self, name) is None:
+            return False
+        built = self.built.get(name, 0)
+        size = self._size(name)
+        if built >= size and getattr(self, name + '_index') is not None:
+            return False
+        stop = min(built + max(built, CHECKPOINT_ENTRIES), size)
+        getattr(self, '_extend' + name.capitalize())(built, stop, checkpoint)
+        self.built[name] = stop
+        return True
+    
+    def _extendStts(self, start, stop, checkpoint):
+        (counts, durations) = columns(self.stts[start:stop], checkpoint)
+        if numpy is not None and isinstance(counts, numpy.ndarray):
+            times = counts * durations
+        else:
+            times = [count * duration for count, duration
+                     in zip(counts, durations)]
+        (time_total, sample_total) = (0, 0)
+        if self.stts_index is not None:
+            time_total = int(self.stts_index[1][-1])
+            sample_total = int(self.stts_index[2][-1])
+        time_ends = cumulative(times, checkpoint, time_total)
+        sample_ends = cumulative(counts, checkpoint, sample_total)
+        if self.stts_index is None:
+            self.stts_index = (durations, time_ends, sample_ends)
+        else:
+            self.stts_index = tuple(
+                concatenate(part, values) for part, values in
+                zip(self.stts_index, (durations, time_ends, sample_ends)))
+    
+    def _extendStsc(self, start, stop, checkpoint):
+        # Samples held by every run of chunks, which ends where the next
+        # entry starts, the last entry has no end
+        (chunks, samples, ids) = columns(self.stsc[start:stop + 1],
+                                         checkpoint)
+        if numpy is not None and isinstance(chunks, numpy.ndarray):
+            run_samples = (chunks[1:] - chunks[:-1]) * samples[:-1]
+        else:
+            run_samples = [(chunks[index+1] - chunks[index]) *
+                           samples[index]
+                           for index in xrange(len(chunks) - 1)]
+        total = 0
+        if self.stsc_index is not None:
+            total = int(self.stsc_index[-1])
+        self.stsc_index = concatenate(
+            self.stsc_index, cumulative(run_samples, checkpoint, total))
+    
+    def _extendStss(self, start, stop, checkpoint):
+        self.stss_index = concatenate(
+            self.stss_index, columns(self.stss[start:stop], checkpoint)[0])
+    
+    def _extendCtts(self, start, stop, checkpoint):
+        total = 0
+        if self.ctts_index is not None:
+            total = int(self.ctts_index[-1])
+        self.ctts_index = concatenate(
+            self.ctts_index,
+            cumulative(columns(self.ctts[start:stop], checkpoint)[0],
+                       checkpoint, total))
+    
+    # Returns the part of table name, decoded at least until its last value
+    # lies past value, or reaches it unless right is set, or completely.
+    # column picks the values to compare out of a tuple of them.
+    def _reach(self, name, value, right=False, column=None,
+               checkpoint=no_checkpoint):
+        while True:
+            part = getattr(self, name + '_index')
+            if part is not None:
+                values = part if column is None else part[column]
+                if len(values) and (values[-1] > value or
+                                    (not right and values[-1] == value)):
+                    return part
+            if not self._extend(name, checkpoint):
+                return part
+    
+    # Returns (stts entry, sample, samples skipped in the entry) for the
+    # sample playing at stream_time or None if it is past the last sample
+    def timeToSample(self, stream_time, checkpoint=no_checkpoint):
+        (durations, time_ends, sample_ends) = self._reach(
+            'stts', stream_time, True, 1, checkpoint)
+        index = search(time_ends, stream_time, right=True)
+        if index >= len(time_ends):
+            return None
+        time_start = 0
+        sample_start = 0
+        if index > 0:
+            time_start = int(time_ends[index-1])
+            sample_start = int(sample_ends[index-1])
+        skipped = (stream_time - time_start) / int(durations[index])
+        return (index, sample_start + skipped, skipped)
+    
+    # Returns (stts entry, end sample, samples kept in the entry) for the
+    # samples that start before stream_time, end sample being exclusive,
+    # or None if every sample starts before it
+    def timeToEndSample(self, stream_time, checkpoint=no_checkpoint):
+        (durations, time_ends, sample_ends) = self._reach(
+            'stts', stream_time, False, 1, checkpoint)
+        index = search(time_ends, stream_time)
+        if index >= len(time_ends) or stream_time <= 0:
+            return None
+        time_start = 0
+        sample_start = 0
+        if index > 0:
+            time_start = int(time_ends[index-1])
+            sample_start = int(sample_ends[index-1])
+        duration = int(durations[index])
+        kept = (stream_time - time_start + duration - 1) / duration
+        return (index, sample_start + kept, kept)
+    
+    # Returns the time the 0-based sample starts at or None if there is no
+    # such sample
+    def sampleToTime(self, sample, checkpoint=no_checkpoint):
+        (durations, time_ends, sample_ends) = self._reach(
+            'stts', sample, True, 2, checkpoint)
+        index = search(sample_ends, sample, right=True)
+        if index >= len(sample_ends):
+            return None
+        time_start = 0
+        sample_start = 0
+        if index > 0:
+            time_start = int(time_ends[index-1])
+            sample_start = int(sample_ends[index-1])
+        return time_start + (sample - sample_start) * int(durations[index])
+    
+    # Returns (stsc entry, samples left in the entry) for the given amount of
+    # samples, a sample on a run boundary stays with the earlier run
+    def sampleToChunk(self, sample, checkpoint=no_checkpoint):
+        sample_ends = self._reach('stsc', sample, checkpoint=checkpoint)
+        index = search(sample_ends, sample)
+        if index > 0:
+            sample -= int(sample_ends[index-1])
+        return (index, sample)
+    
+    # Returns the stss entry of the first keyframe at or after the 1-based
+    # sample or None if there is no such keyframe
+    def sampleToKeyframe(self, sample, checkpoint=no_checkpoint):
+        keyframes = self._reach('stss', sample, checkpoint=checkpoint)
+        index = search(keyframes, sample)
+        if index >= len(keyframes):
+            return None
+        return index
+    
+    # Returns the 0-based keyframes at or before and after the 0-based
+    # sample, either being None if there is none, or None if the trak has
+    # no sync sample table
+    def keyframesAround(self, sample, checkpoint=no_checkpoint):
+        keyframes = self._reach('stss', sample + 1, True,
+                                checkpoint=checkpoint)
+        if keyframes is None:
+            return None
+        index = search(keyframes, sample + 1, right=True)
+        previous = None
+        following = None
+        if index > 0:
+            previous = int(keyframes[index-1]) - 1
+        if index < len(keyframes):
+            following = int(keyframes[index]) - 1
+        return (previous, following)
+    
+    # Returns (ctts entry, samples left in the entry) for the 1-based sample
+    # or None if the sample is past the last ctts entry
+    def sampleToOffset(self, sample, checkpoint=no_checkpoint):
+        count_ends = self._reach('ctts', sample, checkpoint=checkpoint)
+        index = search(count_ends, sample)
+        if index >= len(count_ends):
+            return None
+        if index > 0:
+            sample -= int(count_ends[index-1])
+        return (index, sample)
+    
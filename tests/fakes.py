@@ -0,0 +1,260 @@
+"""
+Test doubles shared by the test modules: synthesized MP4s, a WSGI backend
+serving them like a Swift proxy would and an in-memory memcache
+"""
+import json
+import random
+import struct
+
+try:
+    from eventlet import sleep
+except ImportError:
+    from time import sleep
+
+
+def box(type, payload):
+    return struct.pack('>I4s', 8 + len(payload), type) + payload
+
+
+def full_box(type, payload, version=0, flags=0):
+    return box(type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def _runs(values):
+    # Run length encodes values into [count, value] pairs
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return runs
+
+
+def _trak(track_id, timescale, deltas, sizes, chunks, chunk_offsets,
+          keyframes=None, offsets=None, handler='vide'):
+    duration = sum(deltas)
+    stbl = [full_box('stsd', struct.pack('>I', 1) +
+                     box('avc1' if handler == 'vide' else 'mp4a',
+                         '\x00' * 20))]
+    runs = _runs(deltas)
+    stbl.append(full_box('stts', struct.pack('>I', len(runs)) +
+                         ''.join(struct.pack('>II', *run) for run in runs)))
+    if keyframes is not None:
+        stbl.append(full_box('stss', struct.pack('>I', len(keyframes)) +
+                             ''.join(struct.pack('>I', sample)
+                                     for sample in keyframes)))
+    if offsets is not None:
+        runs = _runs(offsets)
+        stbl.append(full_box('ctts', struct.pack('>I', len(runs)) +
+                             ''.join(struct.pack('>II', *run)
+                                     for run in runs)))
+    entries = []
+    for index, chunk in enumerate(chunks):
+        if not entries or entries[-1][1] != len(chunk):
+            entries.append((index + 1, len(chunk), 1))
+    stbl.append(full_box('stsc', struct.pack('>I', len(entries)) +
+                         ''.join(struct.pack('>III', *entry)
+                                 for entry in entries)))
+    if len(set(sizes)) == 1:
+        stbl.append(full_box('stsz', struct.pack('>II', sizes[0],
+                                                 len(sizes))))
+    else:
+        stbl.append(full_box('stsz', struct.pack('>II', 0, len(sizes)) +
+                             ''.join(struct.pack('>I', size)
+                                     for size in sizes)))
+    stbl.append(full_box('stco', struct.pack('>I', len(chunk_offsets)) +
+                         ''.join(struct.pack('>I', offset)
+                                 for offset in chunk_offsets)))
+
+    tkhd = full_box('tkhd', struct.pack('>IIIII', 0, 0, track_id, 0,
+                                        duration * 1000 // timescale) +
+                    '\x00' * 60)
+    mdhd = full_box('mdhd', struct.pack('>IIII', 0, 0, timescale, duration) +
+                    '\x00' * 4)
+    hdlr = full_box('hdlr', '\x00' * 4 + handler + '\x00' * 12 + 'x\x00')
+    if handler == 'vide':
+        media_header = full_box('vmhd', '\x00' * 8, flags=1)
+    else:
+        media_header = full_box('smhd', '\x00' * 4)
+    dinf = box('dinf', full_box('dref', struct.pack('>I', 1) +
+                                full_box('url ', '', flags=1)))
+    minf = box('minf', media_header + dinf + box('stbl', ''.join(stbl)))
+    return box('trak', tkhd + box('mdia', mdhd + hdlr + minf))
+
+
+def make_mp4(samples=600, moov_last=False, seed=1):
+    """
+    Synthesizes an MP4 of a 25 fps video trak with a keyframe every 25
+    samples and composition offsets, interleaved with an audio trak of
+    uniform samples. Every sample is filled with its trak and number so
+    misplaced media bytes can be told apart.
+    """
+    rnd = random.Random(seed)
+    video_deltas = [512] * samples
+    video_sizes = [rnd.randint(100, 600) for index in xrange(samples)]
+    keyframes = range(1, samples + 1, 25)
+    offsets = [rnd.choice([0, 512, 1024]) for index in xrange(samples)]
+    audio_samples = samples * 512 * 44100 // 12800 // 1024
+    audio_deltas = [1024] * audio_samples
+    audio_sizes = [200] * audio_samples
+
+    def split(count, per_chunk):
+        return [range(start, min(start + per_chunk, count))
+                for start in xrange(0, count, per_chunk)]
+
+    video_chunks = split(samples, 5)
+    audio_chunks = split(audio_samples, 7)
+    # Interleave the chunks and fill the samples
+    payload = []
+    position = 0
+    video_offsets = []
+    audio_offsets = []
+    for index in xrange(max(len(video_chunks), len(audio_chunks))):
+        for trak, chunks, sizes, chunk_offsets in (
+                ('v', video_chunks, video_sizes, video_offsets),
+                ('a', audio_chunks, audio_sizes, audio_offsets)):
+            if index >= len(chunks):
+                continue
+            chunk_offsets.append(position)
+            for sample in chunks[index]:
+                data = (struct.pack('>cI', trak, sample) *
+                        (sizes[sample] // 5 + 1))[:sizes[sample]]
+                payload.append(data)
+                position += len(data)
+    mdat = box('mdat', ''.join(payload))
+
+    def moov(mdat_offset):
+        mvhd = full_box('mvhd', struct.pack('>IIII', 0, 0, 1000,
+                                            samples * 512 * 1000 // 12800) +
+                        '\x00' * 80)
+        video = _trak(1, 12800, video_deltas, video_sizes, video_chunks,
+                      [offset + mdat_offset for offset in video_offsets],
+                      keyframes, offsets, 'vide')
+        audio = _trak(2, 44100, audio_deltas, audio_sizes, audio_chunks,
+                      [offset + mdat_offset for offset in audio_offsets],
+                      handler='soun')
+        return box('moov', mvhd + video + audio)
+
+    ftyp = box('ftyp', 'isom\x00\x00\x02\x00isomiso2avc1mp41')
+    free = box('free', '\x00' * 8)
+    if moov_last:
+        return ftyp + free + mdat + moov(len(ftyp) + len(free) + 8)
+    size = len(moov(0))
+    return ftyp + moov(len(ftyp) + size + len(free) + 8) + free + mdat
+
+
+class FakeBackend(object):
+    """
+    WSGI app serving a single Object out of memory, with single and
+    multi-range GETs and If-Match like a Swift proxy. Every Range header
+    and the amount of bytes sent are recorded. With fail_after set, bodies
+    raise once that many bytes of them were sent. A latency in seconds
+    delays every response, a seek_latency the first chunk of its body like
+    a disk seek and a rate in bytes per second paces the body. All of them
+    sleep cooperatively when eventlet is installed.
+    """
+    def __init__(self, data, etag='abc', content_type='video/mp4',
+                 chunk_size=4096, latency=0, seek_latency=0, rate=0):
+        self.data = data
+        self.etag = etag
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.seek_latency = seek_latency
+        self.rate = rate
+        self.last_modified = 'Tue, 01 Jan 2013 00:00:00 GMT'
+        self.requests = []
+        self.bytes_sent = 0
+        self.fail_after = None
+    
+    def _chunks(self, body):
+        if self.seek_latency:
+            sleep(self.seek_latency)
+        for offset in xrange(0, len(body), self.chunk_size):
+            chunk = body[offset:offset + self.chunk_size]
+            if self.fail_after is not None and \
+                    offset + len(chunk) > self.fail_after:
+                raise IOError('Backend connection lost')
+            if self.rate:
+                sleep(float(len(chunk)) / self.rate)
+            self.bytes_sent += len(chunk)
+            yield chunk
+    
+    def _ranges(self, value):
+        size = len(self.data)
+        ranges = []
+        for spec in value.split('=', 1)[1].split(','):
+            (first, last) = spec.strip().split('-', 1)
+            if not first:
+                (first, last) = (max(size - int(last), 0), size - 1)
+            else:
+                first = int(first)
+                last = size - 1 if not last else min(int(last), size - 1)
+            if first < size:
+                ranges.append((first, last + 1))
+        return ranges
+    
+    def __call__(self, env, start_response):
+        self.requests.append(env.get('HTTP_RANGE'))
+        if self.latency:
+            sleep(self.latency)
+        headers = [('Content-Type', self.content_type),
+                   ('Etag', '"%s"' % self.etag),
+                   ('Last-Modified', self.last_modified)]
+        if_match = env.get('HTTP_IF_MATCH')
+        if if_match and if_match.strip('"') != self.etag:
+            start_response('412 Precondition Failed', headers)
+            return ['']
+        if not env.get('HTTP_RANGE'):
+            start_response('200 OK', headers +
+                           [('Content-Length', str(len(self.data)))])
+            return self._chunks(self.data)
+        ranges = self._ranges(env['HTTP_RANGE'])
+        if not ranges:
+            start_response('416 Requested Range Not Satisfiable', headers)
+            return ['']
+        if len(ranges) == 1:
+            (start, stop) = ranges[0]
+            start_response('206 Partial Content', headers + [
+                ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1,
+                                                      len(self.data))),
+                ('Content-Length', str(stop - start))])
+            return self._chunks(self.data[start:stop])
+        boundary = 'fakeboundary'
+        body = []
+        for start, stop in ranges:
+            body.append('--%s\r\nContent-Type: %s\r\nContent-Range: '
+                        'bytes %d-%d/%d\r\n\r\n' %
+                        (boundary, self.content_type, start, stop - 1,
+                         len(self.data)))
+            body.append(self.data[start:stop])
+            body.append('\r\n')
+        body.append('--%s--' % boundary)
+        body = ''.join(body)
+        headers[0] = ('Content-Type',
+                      'multipart/byteranges;boundary=%s' % boundary)
+        start_response('206 Partial Content', headers +
+                       [('Content-Length', str(len(body)))])
+        return self._chunks(body)
+    
+
+
+class FakeMemcache(object):
+    """
+    In-memory stand-in for swift.cache, values go through JSON like they
+    do with the real one
+    """
+    def __init__(self):
+        self.store = {}
+    
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+    
+    def set(self, key, value, serialize=True, time=0):
+        self.store[key] = json.dumps(value)
+    
+
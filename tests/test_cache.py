@@ -0,0 +1,128 @@
+import unittest
+
+from swiftmp4.cache import Mp4Metadata, MetadataCache
+from swiftmp4.middleware import SwiftMp4Middleware
+from tests.fakes import make_mp4, FakeBackend, FakeMemcache
+from tests.test_middleware import request
+
+
+def make_metadata(etag='abc', size=1000):
+    return Mp4Metadata(etag, 100000, 'video/mp4', [(0, 'x' * size)])
+
+
+class TestMetadataCache(unittest.TestCase):
+    
+    def test_get_put(self):
+        cache = MetadataCache()
+        self.assertEquals(cache.get('/o', 'abc'), None)
+        metadata = make_metadata()
+        cache.put('/o', metadata)
+        self.assertTrue(cache.get('/o', 'abc') is metadata)
+        self.assertEquals(cache.stats['hits'], 1)
+        self.assertEquals(cache.stats['misses'], 1)
+    
+    def test_changed_object_is_dropped(self):
+        cache = MetadataCache()
+        cache.put('/o', make_metadata('abc'))
+        self.assertEquals(cache.get('/o', 'def'), None)
+        self.assertEquals(cache.entries.keys(), [])
+        self.assertEquals(cache.size, 0)
+    
+    def test_eviction(self):
+        cache = MetadataCache(max_size=2500)
+        for path in ('/a', '/b', '/c'):
+            cache.put(path, make_metadata())
+        self.assertEquals(cache.get('/a', 'abc'), None)
+        self.assertTrue(cache.get('/c', 'abc') is not None)
+        self.assertEquals(cache.stats['evictions'], 1)
+        self.assertEquals(cache.size, 2000)
+    
+    def test_memcache(self):
+        memcache = FakeMemcache()
+        MetadataCache().put('/o', make_metadata(), memcache)
+        self.assertEquals(len(memcache.store), 1)
+        # Another proxy finds it in memcache, and keeps it in-process
+        cache = MetadataCache()
+        metadata = cache.get('/o', 'abc', memcache)
+        self.assertEquals(metadata.segments, [(0, 'x' * 1000)])
+        self.assertEquals(metadata.content_length, 100000)
+        self.assertTrue(metadata.in_memcache)
+        self.assertTrue(cache.get('/o', 'abc', memcache) is metadata)
+        self.assertEquals(cache.stats['memcache_hits'], 1)
+        self.assertEquals(cache.stats['hits'], 1)
+        self.assertEquals(cache.get('/o', 'def', memcache), None)
+        self.assertEquals(cache.stats['memcache_misses'], 1)
+    
+    def test_memcache_max_size(self):
+        memcache = FakeMemcache()
+        cache = MetadataCache(memcache_max_size=500)
+        cache.put('/o', make_metadata(), memcache)
+        self.assertEquals(memcache.store, {})
+        self.assertTrue(cache.get('/o', 'abc') is not None)
+    
+    def test_peek_counts_verified_hits(self):
+        cache = MetadataCache()
+        metadata = make_metadata()
+        cache.put('/o', metadata)
+        self.assertTrue(cache.peek('/o') is metadata)
+        self.assertEquals(cache.peek('/p'), None)
+        self.assertEquals(cache.stats['hits'], 0)
+        cache.verified('/o')
+        self.assertEquals(cache.stats['hits'], 1)
+    
+
+
+class TestMiddlewareCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = make_mp4()
+        self.backend = FakeBackend(self.data)
+        self.memcache = FakeMemcache()
+    
+    def get(self, app, query='start=3.3'):
+        (status, headers, body) = request(app, query)
+        self.assertEquals(status, 200)
+        return body
+    
+    def test_cached_seek_indexes(self):
+        app = SwiftMp4Middleware(self.backend, {})
+        body = self.get(app)
+        [(metadata, size)] = app.metadata_cache.entries.values()
+        for seek_index in metadata.seek_indexes:
+            # Only the built index is kept, not the tables it came from
+            self.assertEquals((seek_index.stts, seek_index.stsc,
+                               seek_index.stss, seek_index.ctts),
+                              (None, None, None, None))
+            self.assertTrue(seek_index.stts_index is not None)
+        self.assertEquals(self.get(app), body)
+        self.assertEquals(self.get(app, 'start=10'),
+                          self.get(SwiftMp4Middleware(self.backend, {}),
+                                   'start=10'))
+        self.assertEquals(app.metadata_cache.stats['hits'], 2)
+    
+    def test_shared_through_memcache(self):
+        def get(app):
+            env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c/o.mp4',
+                   'QUERY_STRING': 'start=3.3', 'swift.cache': self.memcache}
+            return ''.join(app(env, lambda status, headers: None))
+    
+        body = get(SwiftMp4Middleware(self.backend, {}))
+        self.assertEquals(len(self.memcache.store), 1)
+        app = SwiftMp4Middleware(self.backend, {})
+        self.assertEquals(get(app), body)
+        self.assertEquals(app.metadata_cache.stats['memcache_hits'], 1)
+    
+    def test_speculative_hits(self):
+        app = SwiftMp4Middleware(self.backend, {'multirange_window': '65536'})
+        body = self.get(app)
+        self.assertEquals(self.get(app), body)
+        self.assertEquals(app.metadata_cache.stats['hits'], 1)
+        # Stale metadata is no hit
+        self.backend.etag = 'def'
+        self.assertEquals(self.get(app), body)
+        self.assertEquals(app.metadata_cache.stats['hits'], 1)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
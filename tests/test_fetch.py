@@ -0,0 +1,245 @@
+import logging
+import unittest
+
+from swiftmp4.fetch import ByteRanges, Prefetch, MultiRangeFetch
+from swiftmp4.middleware import SwiftMp4Middleware
+from tests.fakes import make_mp4, FakeBackend
+from tests.test_middleware import request
+
+DATA = ''.join(chr(index % 251) for index in xrange(10000))
+
+
+def get(backend, value):
+    # Returns the response headers and the whole body of a ranged GET
+    response = {}
+
+    def start_response(status, headers, *args):
+        response['headers'] = headers
+
+    body = ''.join(backend({'HTTP_RANGE': value}, start_response))
+    return (response['headers'], body)
+
+
+def chunked(body, size):
+    return [body[offset:offset + size]
+            for offset in xrange(0, len(body), size)]
+
+
+def read_parts(chunks, headers):
+    # Returns the (start, stop, size, data) of every part
+    return [(start, stop, size, ''.join(data))
+            for start, stop, size, part_headers, data
+            in ByteRanges(chunks, headers)]
+
+
+class MultiRangeBackend(FakeBackend):
+    """
+    FakeBackend answering multi-range GETs like a proxy that doesn't
+    support them, with the whole Object, with a single range spanning all
+    the ranges asked for, or with an error status.
+    """
+    def __init__(self, data, answer, **kwargs):
+        FakeBackend.__init__(self, data, **kwargs)
+        self.answer = answer
+    
+    def __call__(self, env, start_response):
+        value = env.get('HTTP_RANGE')
+        if not value or ',' not in value:
+            return FakeBackend.__call__(self, env, start_response)
+        env = env.copy()
+        if self.answer == 'whole':
+            del env['HTTP_RANGE']
+        elif self.answer == 'single':
+            ranges = self._ranges(value)
+            env['HTTP_RANGE'] = 'bytes=%d-%d' % (ranges[0][0],
+                                                 ranges[-1][1] - 1)
+        else:
+            self.requests.append(value)
+            start_response(self.answer, [])
+            return ['']
+        return FakeBackend.__call__(self, env, start_response)
+    
+
+
+class TestByteRanges(unittest.TestCase):
+    
+    def setUp(self):
+        self.backend = FakeBackend(DATA)
+        (self.headers, self.body) = get(self.backend,
+                                        'bytes=0-99,1000-2999,9990-')
+        self.parts = [(0, 100, 10000, DATA[:100]),
+                      (1000, 3000, 10000, DATA[1000:3000]),
+                      (9990, 10000, 10000, DATA[9990:])]
+    
+    def test_multipart(self):
+        self.assertEquals(read_parts([self.body], self.headers), self.parts)
+    
+    def test_split_across_chunks(self):
+        # Delimiters, part headers and CRLFs cut anywhere
+        for size in (1, 2, 3, 7, 16, 99, 4096):
+            self.assertEquals(read_parts(chunked(self.body, size),
+                                         self.headers), self.parts, size)
+    
+    def test_quoted_boundary(self):
+        headers = [('Content-Type', 'multipart/byteranges; charset=x; '
+                                    'boundary="fakeboundary"')]
+        self.assertEquals(read_parts([self.body], headers), self.parts)
+    
+    def test_preamble(self):
+        body = 'Ignore this\r\n--fakeboundaryless\r\n\r\n' + self.body
+        self.assertEquals(read_parts(chunked(body, 5), self.headers),
+                          self.parts)
+    
+    def test_epilogue(self):
+        # The close delimiter with or without a CRLF, or missing
+        # altogether once the last part is complete
+        closing = '--fakeboundary--'
+        self.assertTrue(self.body.endswith('\r\n' + closing))
+        body = self.body[:-len(closing)]
+        for tail in (closing, closing + '\r\n', closing + '\r\nepilogue',
+                     ''):
+            self.assertEquals(read_parts(chunked(body + tail, 3),
+                                         self.headers), self.parts, tail)
+        self.assertEquals(read_parts(chunked(body[:-2], 3), self.headers),
+                          self.parts)
+    
+    def test_truncated_part(self):
+        # A part cut short raises instead of ending on short data
+        for index, (start, stop, size, data) in enumerate(self.parts):
+            header_end = self.body.index('\r\n\r\n' + data) + 4
+            for cut in (header_end - 10, header_end,
+                        header_end + len(data) // 2,
+                        header_end + len(data) - 1):
+                chunks = chunked(self.body[:cut], 7)
+                self.assertRaises(ValueError, read_parts, chunks,
+                                  self.headers)
+    
+    def test_single_range(self):
+        # A single part 206 and a 200 are a single part
+        (headers, body) = get(self.backend, 'bytes=1000-2999')
+        self.assertEquals(read_parts(chunked(body, 7), headers),
+                          [(1000, 3000, 10000, DATA[1000:3000])])
+        (headers, body) = get(self.backend, None)
+        self.assertEquals(read_parts(chunked(body, 7), headers),
+                          [(0, 10000, 10000, DATA)])
+    
+    def test_unread_parts_are_skipped(self):
+        ranges = ByteRanges(chunked(self.body, 7), self.headers)
+        self.assertEquals([start for start, stop, size, headers, data
+                           in ranges], [0, 1000, 9990])
+    
+
+
+class TestMultiRangeFetch(unittest.TestCase):
+    
+    def setUp(self):
+        self.backend = FakeBackend(DATA, chunk_size=7)
+    
+    def fetch(self, ranges, start, window_stop, stop):
+        # Returns the bytes read out of a response to ranges
+        response = {}
+        def start_response(status, headers, *args):
+            response['headers'] = headers
+        
+        chunks = self.backend({'HTTP_RANGE': ranges}, start_response)
+        rest = Prefetch(chunked, DATA[window_stop:stop], 5)
+        fetch = MultiRangeFetch(ByteRanges(chunks, response['headers']),
+                                start, window_stop, stop, rest)
+        try:
+            return ''.join(fetch)
+        finally:
+            fetch.close()
+    
+    def test_window_and_rest(self):
+        self.assertEquals(self.fetch('bytes=0-99,1000-2999', 1000, 3000,
+                                     8000), DATA[1000:8000])
+        self.assertEquals(self.fetch('bytes=0-99,1000-2999', 1000, 3000,
+                                     3000), DATA[1000:3000])
+    
+    def test_single_range(self):
+        # The window within the first range, or all of it in a single one
+        self.assertEquals(self.fetch('bytes=0-2999', 50, 3000, 8000),
+                          DATA[50:8000])
+        self.assertEquals(self.fetch('bytes=0-7999', 1000, 3000, 8000),
+                          DATA[1000:8000])
+        self.assertEquals(self.fetch(None, 1000, 3000, 8000),
+                          DATA[1000:8000])
+    
+    def test_missing_range(self):
+        # Whatever would leave a hole in between the bytes read raises
+        self.assertRaises(Exception, self.fetch, 'bytes=0-99,1500-2999',
+                          1000, 3000, 8000)
+        self.assertRaises(Exception, self.fetch, 'bytes=0-99,1000-1999',
+                          1000, 3000, 8000)
+        self.assertRaises(Exception, self.fetch, 'bytes=0-99', 1000, 3000,
+                          8000)
+    
+
+
+class TestMultiRangeRequests(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = make_mp4()
+        (status, headers, self.full) = request(
+            SwiftMp4Middleware(FakeBackend(self.data), {}), 'start=10')
+    
+    def speculative(self, backend):
+        # Returns the body of a seek served from the cached metadata and
+        # the backend requests made for it
+        app = SwiftMp4Middleware(backend, {'multirange_window': '65536'})
+        request(app, 'start=10')
+        backend.requests = []
+        (status, headers, body) = request(app, 'start=10')
+        self.assertEquals(status, 200)
+        self.assertEquals(int(headers['content-length']), len(body))
+        self.assertEquals(body, self.full)
+        return backend.requests
+    
+    def test_multipart(self):
+        # The probe and the start of the mdat range, then the rest of it
+        requests = self.speculative(FakeBackend(self.data))
+        self.assertEquals(len(requests), 2)
+        self.assertTrue(',' in requests[0])
+    
+    def test_not_multipart(self):
+        # A proxy may answer with a single range or the whole Object, both
+        # still show the metadata is the one cached
+        for answer in ('single', 'whole'):
+            requests = self.speculative(MultiRangeBackend(self.data, answer))
+            self.assertFalse('bytes=0-65535' in requests, answer)
+    
+    def test_refused(self):
+        # An error response falls back to probing the Object again
+        for answer in ('412 Precondition Failed',
+                       '416 Requested Range Not Satisfiable'):
+            requests = self.speculative(MultiRangeBackend(self.data, answer))
+            self.assertTrue(',' in requests[0])
+            self.assertEquals(requests[1], 'bytes=0-65535')
+            self.assertEquals(len(requests), 3)
+    
+    def test_stale(self):
+        # A changed ETag falls back to the metadata of the new version,
+        # parsed out of the probe the multi-range response started with.
+        # The rest of the old mdat range gets a 412.
+        backend = FakeBackend(self.data)
+        app = SwiftMp4Middleware(backend, {'multirange_window': '65536'})
+        request(app, 'start=10')
+        backend.data = make_mp4(samples=700, seed=2)
+        backend.etag = 'def'
+        backend.requests = []
+        logging.disable(logging.CRITICAL)
+        try:
+            (status, headers, body) = request(app, 'start=10')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEquals(body, request(SwiftMp4Middleware(
+            FakeBackend(backend.data, etag='def'), {}), 'start=10')[2])
+        self.assertEquals(app.metadata_cache.stats['hits'], 0)
+        self.assertTrue(',' in backend.requests[0])
+        self.assertFalse('bytes=0-%d' % (app.probe_size - 1)
+                         in backend.requests)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
+
+from swiftmp4.flight import SingleFlight
+from swiftmp4.middleware import SwiftMp4Middleware
+from tests.fakes import make_mp4, FakeBackend
+from tests.test_middleware import request
+
+
+@unittest.skipIf(eventlet is None, 'eventlet is not installed')
+class TestSingleFlight(unittest.TestCase):
+    
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = []
+    
+    def work(self, value, delay=0.01):
+        self.calls.append(value)
+        eventlet.sleep(delay)
+        return value
+    
+    def test_coalesced(self):
+        threads = [eventlet.spawn(self.flight.do, 'key', self.work, value)
+                   for value in xrange(3)]
+        self.assertEquals([thread.wait() for thread in threads], [0, 0, 0])
+        self.assertEquals(self.calls, [0])
+        self.assertEquals(self.flight.flights, {})
+    
+    def test_exception_is_shared(self):
+        def fail():
+            self.calls.append(None)
+            eventlet.sleep(0.01)
+            raise ValueError('Invalid MP4')
+    
+        threads = [eventlet.spawn(self.flight.do, 'key', fail)
+                   for value in xrange(2)]
+        for thread in threads:
+            self.assertRaises(ValueError, thread.wait)
+        self.assertEquals(self.calls, [None])
+        self.assertEquals(self.flight.flights, {})
+    
+    def test_leader_killed(self):
+        leader = eventlet.spawn(self.flight.do, 'key', self.work, 0, 1)
+        eventlet.sleep(0)
+        follower = eventlet.spawn(self.flight.do, 'key', self.work, 1)
+        eventlet.sleep(0)
+        leader.kill()
+        # The follower does the work itself instead of waiting forever
+        self.assertEquals(follower.wait(), 1)
+        self.assertEquals(self.calls, [0, 1])
+        self.assertEquals(self.flight.flights, {})
+        self.assertEquals(self.flight.do('key', self.work, 2), 2)
+    
+    def test_leader_timeout(self):
+        timeout = eventlet.Timeout(0.01)
+        try:
+            self.assertRaises(eventlet.Timeout, self.flight.do, 'key',
+                              self.work, 0, 1)
+        finally:
+            timeout.cancel()
+        self.assertEquals(self.flight.flights, {})
+    
+
+
+@unittest.skipIf(eventlet is None, 'eventlet is not installed')
+class TestSeekCoalescing(unittest.TestCase):
+    
+    def test_canonical_start(self):
+        # Both starts snap onto the keyframe at 3 seconds, so only one of
+        # them updates and serializes the metadata
+        app = SwiftMp4Middleware(FakeBackend(make_mp4()),
+                                 {'seek_snap': 'previous'})
+        request(app, 'start=10')
+        calls = []
+        prepare_stream = app.prepare_stream
+    
+        def slow_prepare_stream(*args, **kwargs):
+            calls.append(args[3])
+            eventlet.sleep(0.01)
+            return prepare_stream(*args, **kwargs)
+    
+        app.prepare_stream = slow_prepare_stream
+        app.flight.stats = {'leaders': 0, 'followers': 0, 'timeouts': 0}
+        threads = [eventlet.spawn(request, app, query)
+                   for query in ('start=3.2', 'start=3.6')]
+        responses = [thread.wait() for thread in threads]
+        self.assertEquals(calls, [3000])
+        self.assertEquals([headers['x-mp4-start']
+                           for status, headers, body in responses],
+                          ['3', '3'])
+        self.assertEquals(responses[0][2], responses[1][2])
+        # A snap flight each and one stream flight
+        self.assertEquals(app.flight.stats['leaders'], 3)
+        self.assertEquals(app.flight.stats['followers'], 1)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import logging
+import unittest
+
+from swiftmp4.middleware import SwiftMp4Middleware
+from tests.fakes import make_mp4, FakeBackend
+
+
+def request(app, query='', path='/v1/a/c/o.mp4', **headers):
+    # Runs a GET through app, returns the status code, the lowercased
+    # response headers and the whole body
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+           'QUERY_STRING': query}
+    for name, value in headers.items():
+        env['HTTP_' + name.upper()] = value
+    response = {}
+
+    def start_response(status, response_headers, *args):
+        response['status'] = int(status.split()[0])
+        response['headers'] = dict((name.lower(), value)
+                                   for name, value in response_headers)
+
+    body = ''.join(app(env, start_response))
+    return (response['status'], response['headers'], body)
+
+
+def parse_multipart(body, boundary):
+    # Splits a multipart/byteranges body into (content-range, data) parts
+    parts = []
+    for part in body.split('--%s' % boundary)[1:-1]:
+        (head, data) = part.split('\r\n\r\n', 1)
+        assert data.endswith('\r\n')
+        content_range = [line.split(':', 1)[1].strip()
+                         for line in head.split('\r\n')
+                         if line.lower().startswith('content-range:')][0]
+        parts.append((content_range, data[:-2]))
+    return parts
+
+
+class TestStreamResponses(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = make_mp4()
+        self.backend = FakeBackend(self.data)
+        self.app = SwiftMp4Middleware(self.backend, {})
+        (status, headers, self.full) = request(self.app, 'start=3.3')
+        self.assertEquals(status, 200)
+        self.assertEquals(int(headers['content-length']), len(self.full))
+    
+    def test_full(self):
+        self.assertEquals(self.full[4:8], 'ftyp')
+        # The rewritten MP4 ends on the untouched tail of the mdat data
+        self.assertEquals(self.full[-4096:], self.data[-4096:])
+        self.assertTrue(len(self.full) < len(self.data))
+    
+    def test_single_range(self):
+        size = len(self.full)
+        for (first, last) in ((0, 99), (1000, 50000), (size - 10, size - 1)):
+            (status, headers, body) = request(
+                self.app, 'start=3.3', range='bytes=%d-%d' % (first, last))
+            self.assertEquals(status, 206)
+            self.assertEquals(headers['content-range'],
+                              'bytes %d-%d/%d' % (first, last, size))
+            self.assertEquals(int(headers['content-length']), len(body))
+            self.assertEquals(body, self.full[first:last + 1])
+    
+    def test_multipart_ranges(self):
+        size = len(self.full)
+        (status, headers, body) = request(
+            self.app, 'start=3.3', range='bytes=0-9,30000-30999,-500')
+        self.assertEquals(status, 206)
+        self.assertEquals(int(headers['content-length']), len(body))
+        boundary = headers['content-type'].split('boundary=', 1)[1]
+        self.assertEquals(parse_multipart(body, boundary), [
+            ('bytes 0-9/%d' % size, self.full[:10]),
+            ('bytes 30000-30999/%d' % size, self.full[30000:31000]),
+            ('bytes %d-%d/%d' % (size - 500, size - 1, size),
+             self.full[-500:])])
+    
+    def test_unsatisfiable_range(self):
+        size = len(self.full)
+        (status, headers, body) = request(
+            self.app, 'start=3.3', range='bytes=%d-' % size)
+        self.assertEquals(status, 416)
+        self.assertEquals(headers['content-range'], 'bytes */%d' % size)
+        self.assertEquals(body, '')
+    
+    def test_if_range(self):
+        (status, headers, body) = request(self.app, 'start=3.3')
+        etag = headers['etag']
+        self.assertNotEquals(etag, '"%s"' % self.backend.etag)
+        self.assertNotEquals(request(self.app, 'start=10')[1]['etag'], etag)
+        for (if_range, expected) in (
+                (etag, 206), (self.backend.last_modified, 206),
+                ('"%s"' % self.backend.etag, 200), ('W/' + etag, 200),
+                ('Wed, 02 Jan 2013 00:00:00 GMT', 200), ('garbage', 200)):
+            (status, headers, body) = request(
+                self.app, 'start=3.3', range='bytes=0-99', if_range=if_range)
+            self.assertEquals(status, expected, if_range)
+            self.assertEquals(int(headers['content-length']), len(body))
+    
+    def test_backend_failure_raises(self):
+        # A body cut short after Content-Length was declared has to abort
+        # the connection rather than end quietly
+        self.backend.fail_after = 100000
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertRaises(IOError, request, self.app, 'start=3.3')
+        finally:
+            logging.disable(logging.NOTSET)
+    
+
+
+class TestSeekParameters(unittest.TestCase):
+    
+    def setUp(self):
+        self.backend = FakeBackend(make_mp4())
+    
+    def test_invalid(self):
+        app = SwiftMp4Middleware(self.backend, {})
+        logging.disable(logging.CRITICAL)
+        try:
+            for query in ('start=abc', 'start=-1', 'start=nan', 'start=inf',
+                          'start=3&end=abc', 'start=3&end=3',
+                          'start=3&end=2', 'start=1000'):
+                (status, headers, body) = request(app, query)
+                self.assertEquals(status, 400, query)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEquals(request(app, 'start=3&end=3.5')[0], 200)
+    
+    def test_snap_before_end(self):
+        # Keyframes are a second apart, the nearest one to 3.95 lies past
+        # the end so the previous one is taken
+        app = SwiftMp4Middleware(self.backend, {'seek_snap': 'nearest'})
+        (status, headers, body) = request(app, 'start=3.95')
+        self.assertEquals(headers['x-mp4-start'], '4')
+        (status, headers, body) = request(app, 'start=3.95&end=3.99')
+        self.assertEquals(status, 200)
+        self.assertEquals(headers['x-mp4-start'], '3')
+        self.assertEquals(int(headers['content-length']), len(body))
+    
+
+
+class TestFaststart(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = make_mp4(moov_last=True)
+        self.backend = FakeBackend(self.data)
+        self.app = SwiftMp4Middleware(self.backend, {'faststart': 'true'})
+    
+    def test_moov_last(self):
+        (status, headers, body) = request(self.app)
+        self.assertEquals(status, 200)
+        self.assertEquals(int(headers['content-length']), len(body))
+        self.assertEquals([body[4:8], body[36:40]], ['ftyp', 'moov'])
+        # The probe, everything behind mdat and the mdat data
+        self.assertEquals(len(self.backend.requests), 3)
+    
+    def test_moov_first(self):
+        backend = FakeBackend(make_mp4())
+        app = SwiftMp4Middleware(backend, {'faststart': 'true'})
+        self.assertEquals(request(app)[2], backend.data)
+        (status, headers, body) = request(app, range='bytes=0-99')
+        self.assertEquals(status, 206)
+        self.assertEquals(body, backend.data[:100])
+    
+    def test_moov_first_cost(self):
+        # The probe tells moov is first without fetching it, after that the
+        # Object is passed through straight away
+        backend = FakeBackend(make_mp4(samples=6000))
+        app = SwiftMp4Middleware(backend, {'faststart': 'true',
+                                           'probe_size': '4096'})
+        (status, headers, body) = request(app, range='bytes=0-1023')
+        self.assertEquals(body, backend.data[:1024])
+        self.assertEquals(backend.requests, ['bytes=0-4095', 'bytes=0-1023'])
+        self.assertEquals(backend.bytes_sent, 4096 + 1024)
+        backend.requests = []
+        (status, headers, body) = request(app, range='bytes=0-1023')
+        self.assertEquals(status, 206)
+        self.assertEquals(backend.requests, ['bytes=0-1023'])
+    
+    def test_moov_first_replaced(self):
+        backend = FakeBackend(make_mp4())
+        app = SwiftMp4Middleware(backend, {'faststart': 'true'})
+        request(app)
+        # The pass-through response shows the new version, which is
+        # probed and rewritten instead
+        backend.data = self.data
+        backend.etag = 'def'
+        (status, headers, body) = request(app)
+        self.assertEquals(status, 200)
+        self.assertEquals(body[36:40], 'moov')
+        self.assertEquals(int(headers['content-length']), len(body))
+    
+    def test_invalid_metadata(self):
+        # A sample table that doesn't fit its atom fails the rewrite, which
+        # serves the Object as is instead
+        offset = self.data.index('stts') + 8
+        self.backend.data = self.data[:offset] + '\x00\xff\xff\xff' + \
+                            self.data[offset + 4:]
+        logging.disable(logging.CRITICAL)
+        try:
+            (status, headers, body) = request(self.app)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEquals(status, 200)
+        self.assertEquals(body, self.backend.data)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import mmap
+import struct
+import tempfile
+import unittest
+
+from swiftmp4.fetch import RangeByteSource
+from swiftmp4.middleware import SwiftMp4Middleware
+from swiftmp4.streaming.StreamByteSource import ByteSourceFile
+from swiftmp4.streaming.StreamMp4 import SwiftStreamMp4
+from tests.fakes import make_mp4, FakeBackend
+from tests.test_middleware import request
+
+
+CONTAINERS = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+
+
+def atoms(data, offset=0, stop=None):
+    # Yields (type, offset, size) of every atom, depth first
+    if stop is None:
+        stop = len(data)
+    while offset < stop:
+        (size, type) = struct.unpack('>I4s', data[offset:offset + 8])
+        yield (type, offset, size)
+        if type in CONTAINERS:
+            for atom in atoms(data, offset + 8, offset + size):
+                yield atom
+        offset += size
+
+
+class TestOnDemand(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        # A long MP4 served out of a local file
+        cls.file = tempfile.TemporaryFile()
+        cls.file.write(make_mp4(samples=20000))
+        cls.file.flush()
+        cls.data = mmap.mmap(cls.file.fileno(), 0, access=mmap.ACCESS_READ)
+        cls.moov_size = [size for type, offset, size in atoms(cls.data)
+                         if type == 'moov'][0]
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.data.close()
+        cls.file.close()
+    
+    def setUp(self):
+        self.backend = FakeBackend(self.data)
+        self.app = SwiftMp4Middleware(self.backend, {
+            'metadata_fetch': 'ondemand', 'ondemand_block_size': '4096',
+            'metadata_cache_size': '0'})
+    
+    def fetched(self, query):
+        # Returns the response to query and the bytes fetched ahead of
+        # the single request for its mdat data
+        self.backend.requests = []
+        (status, headers, body) = request(self.app, query)
+        self.assertEquals(status, 200)
+        fetched = 0
+        for value in self.backend.requests[:-1]:
+            (first, last) = value.split('=', 1)[1].split('-')
+            fetched += int(last) - int(first) + 1
+        return (body, fetched)
+    
+    def test_same_as_probe(self):
+        app = SwiftMp4Middleware(FakeBackend(self.data), {})
+        for query in ('start=1', 'start=400', 'start=790'):
+            self.assertEquals(self.fetched(query)[0],
+                              request(app, query)[2])
+    
+    def test_if_range_date(self):
+        # The date of the Object is known without a probe fetch too
+        (status, headers, body) = request(
+            self.app, 'start=1', range='bytes=0-99',
+            if_range=self.backend.last_modified)
+        self.assertEquals(status, 206)
+        self.assertEquals(len(body), 100)
+    
+    def test_bytes_per_seek(self):
+        # Late seeks skip most of the sample tables, only the entries kept
+        # are read
+        (body, early) = self.fetched('start=1')
+        (body, late) = self.fetched('start=790')
+        self.assertTrue(early <= self.moov_size + 65536, early)
+        self.assertTrue(late < self.moov_size * 2 / 3, late)
+        self.assertTrue(late < early)
+    
+    def test_tables_are_not_probed(self):
+        # Knowing its size, a source is never read just to find out whether
+        # a sample table is complete
+        reads = []
+    
+        def fetch(start, stop):
+            reads.append((start, stop))
+            return self.data[start:stop]
+    
+        source = RangeByteSource(fetch, len(self.data))
+        mp4stream = SwiftStreamMp4(ByteSourceFile(source), source.size, 1)
+        mp4stream._parseMp4()
+        table_ends = set(offset + size - 1
+                         for type, offset, size in atoms(self.data)
+                         if type in ('stts', 'stss', 'ctts', 'stsc', 'stsz',
+                                     'stco'))
+        self.assertEquals([(start, stop) for start, stop in reads
+                           if start in table_ends], [])
+        self.assertTrue(sum(stop - start for start, stop in reads) < 1024)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
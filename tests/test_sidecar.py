@@ -0,0 +1,106 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from hashlib import md5
+from StringIO import StringIO
+
+from swiftmp4 import sidecar
+from swiftmp4.cache import Mp4Metadata
+from swiftmp4.middleware import SwiftMp4Middleware
+from tests.fakes import make_mp4, FakeBackend
+from tests.test_middleware import request
+
+
+def build(argv):
+    # Runs swiftmp4-sidecar quietly
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        return sidecar.main(argv)
+    finally:
+        sys.stdout = stdout
+
+
+class TestSidecar(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = make_mp4()
+        self.source = os.path.join(self.dir, 'o.mp4')
+        open(self.source, 'wb').write(self.data)
+        self.etag = md5(self.data).hexdigest()
+        self.sidecar_dir = os.path.join(self.dir, 'sidecars')
+        os.mkdir(self.sidecar_dir)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_round_trip(self):
+        metadata = sidecar.loads(sidecar.create(self.source, self.etag))
+        self.assertEquals(metadata.etag, self.etag)
+        self.assertEquals(metadata.content_length, len(self.data))
+        self.assertEquals(metadata.content_type, 'video/mp4')
+        self.assertEquals(len(metadata.seek_indexes), 2)
+    
+    def test_etag_required(self):
+        self.assertRaises(ValueError, sidecar.dumps,
+                          Mp4Metadata(None, 100, 'video/mp4', [(0, 'x')]))
+        data = sidecar.dumps(Mp4Metadata('abc', 100, 'video/mp4',
+                                         [(0, 'x')]))
+        # Blank out the ETag length
+        header = list(sidecar.HEADER.unpack_from(data, 0))
+        header[3] = 0
+        data = sidecar.HEADER.pack(*header) + data[sidecar.HEADER.size + 3:]
+        self.assertRaises(sidecar.InvalidSidecar, sidecar.loads, data)
+    
+    def test_main(self):
+        path = '/v1/AUTH_test/c/o.mp4'
+        self.assertEquals(build(['-d', self.sidecar_dir, '-p', path,
+                                 self.source]), 0)
+        metadata = sidecar.load(sidecar.sidecar_path(self.sidecar_dir, path))
+        self.assertEquals(metadata.etag, self.etag)
+        self.assertEquals(build([self.source]), 0)
+        metadata = sidecar.load(self.source + '.mp4idx')
+        self.assertEquals(metadata.etag, self.etag)
+    
+    def serve(self, backend):
+        app = SwiftMp4Middleware(backend, {'sidecar_dir': self.sidecar_dir,
+                                           'metadata_cache_size': '0'})
+        (status, headers, body) = request(app, 'start=3.3')
+        self.assertEquals(status, 200)
+        return body
+    
+    def test_middleware(self):
+        expected = self.serve(FakeBackend(self.data, self.etag))
+        build(['-d', self.sidecar_dir, '-p', '/v1/a/c/o.mp4', self.source])
+        # Only the probe and the mdat range are requested
+        backend = FakeBackend(self.data, self.etag)
+        self.assertEquals(self.serve(backend), expected)
+        self.assertEquals(len(backend.requests), 2)
+    
+    def test_if_range_date(self):
+        build(['-d', self.sidecar_dir, '-p', '/v1/a/c/o.mp4', self.source])
+        backend = FakeBackend(self.data, self.etag)
+        app = SwiftMp4Middleware(backend, {'sidecar_dir': self.sidecar_dir})
+        (status, headers, body) = request(app, 'start=3.3',
+                                          range='bytes=0-99',
+                                          if_range=backend.last_modified)
+        self.assertEquals(status, 206)
+        self.assertEquals(len(body), 100)
+    
+    def test_stale_sidecar(self):
+        build(['-d', self.sidecar_dir, '-p', '/v1/a/c/o.mp4', self.source])
+        # The Object was replaced after its sidecar was built
+        data = make_mp4(samples=700, seed=2)
+        expected = request(SwiftMp4Middleware(FakeBackend(data, 'def'), {}),
+                           'start=3.3')[2]
+        self.assertEquals(self.serve(FakeBackend(data, 'def')), expected)
+        # Neither is a sidecar without ETag used for an Object without one
+        self.assertEquals(self.serve(FakeBackend(data, '')), expected)
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from swiftmp4.streaming import StreamMp4
+from tests.fakes import make_mp4
+
+
+class TestCopyRange(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'source.mp4')
+        self.data = make_mp4()
+        open(self.source, 'wb').write(self.data)
+        self.sendfile = StreamMp4._sendfile
+        self.chunk_size = StreamMp4.COPY_CHUNK_SIZE
+    
+    def tearDown(self):
+        StreamMp4._sendfile = self.sendfile
+        StreamMp4.COPY_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.dir)
+    
+    def copy(self, offset, size):
+        # Copies behind a header, returns what ends up in the destination
+        destination = os.path.join(self.dir, 'destination')
+        source_file = open(self.source, 'rb')
+        destination_file = open(destination, 'wb')
+        try:
+            destination_file.write('header')
+            StreamMp4.copy_range(source_file, destination_file, offset, size)
+            destination_file.write('trailer')
+        finally:
+            source_file.close()
+            destination_file.close()
+        return open(destination, 'rb').read()
+    
+    def push(self, start):
+        destination = os.path.join(self.dir, 'stream.mp4')
+        StreamMp4.StreamMp4(self.source, destination, start).pushToStream()
+        return open(destination, 'rb').read()
+    
+    @unittest.skipIf(StreamMp4._sendfile is None,
+                     'sendfile is not available')
+    def test_kernel_copy(self):
+        source_file = open(self.source, 'rb')
+        destination_file = open(os.path.join(self.dir, 'destination'), 'wb')
+        try:
+            self.assertEquals(StreamMp4._kernel_copy(
+                source_file.fileno(), destination_file.fileno(), 1000,
+                50000), 50000)
+        finally:
+            source_file.close()
+            destination_file.close()
+        self.assertEquals(self.copy(1000, 50000),
+                          'header' + self.data[1000:51000] + 'trailer')
+    
+    def test_chunked_copy(self):
+        StreamMp4._sendfile = None
+        StreamMp4.COPY_CHUNK_SIZE = 4096
+        self.assertEquals(self.copy(1000, 50000),
+                          'header' + self.data[1000:51000] + 'trailer')
+        # A source shorter than size ends the copy
+        self.assertEquals(self.copy(len(self.data) - 10, 100),
+                          'header' + self.data[-10:] + 'trailer')
+    
+    def test_push_to_stream(self):
+        streamed = self.push(3.3)
+        StreamMp4._sendfile = None
+        StreamMp4.COPY_CHUNK_SIZE = 4096
+        self.assertEquals(self.push(3.3), streamed)
+        self.assertEquals(streamed[-4096:], self.data[-4096:])
+    
+
+
+if __name__ == '__main__':
+    unittest.main()